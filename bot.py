@@ -1,25 +1,37 @@
+import argparse
 import asyncio
 import json
 import os
 import logging
 import re
 import datetime
+import functools
+import gzip
+import hashlib
+import heapq
+import itertools
+import struct
+import sys
+import time
+import zlib
 import asyncpg
 import ssl
 import certifi
 import redis
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.types import ChatPermissions, ChatMemberUpdated
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from dotenv import load_dotenv
 from telethon.sync import TelegramClient
 from telethon.tl.functions.channels import GetParticipantsRequest
 from telethon.tl.types import ChannelParticipantsSearch, Channel, Chat
 from telethon.errors import FloodWaitError
-from collections import deque
-from dataclasses import dataclass
+from array import array
+from collections import deque, OrderedDict
+from dataclasses import dataclass, field
 from typing import Optional
+from urllib.parse import urlsplit
 
 # Налаштування логування
 class DummyLogger:
@@ -51,6 +63,70 @@ REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
 REDIS_DB = int(os.getenv('REDIS_DB', 0))
 REDIS_PASSWORD = os.getenv('REDIS_PASSWORD')
+CHAT_CACHE_TTL = int(os.getenv('CHAT_CACHE_TTL', 6 * 60 * 60))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 60 * 60))
+USERNAME_NEGATIVE_TTL = int(os.getenv('USERNAME_NEGATIVE_TTL', 30 * 60))
+INFO_CONCURRENCY = int(os.getenv('INFO_CONCURRENCY', 8))
+INFO_SOURCE_TIMEOUT = float(os.getenv('INFO_SOURCE_TIMEOUT', 5))
+API_RATE_LIMIT = float(os.getenv('API_RATE_LIMIT', 20))
+INFO_PAGE_SIZE = int(os.getenv('INFO_PAGE_SIZE', 5))
+PUNISHMENTS_RETENTION_MONTHS = int(os.getenv('PUNISHMENTS_RETENTION_MONTHS', 12))
+PUNISHMENT_PARTITIONS_AHEAD = int(os.getenv('PUNISHMENT_PARTITIONS_AHEAD', 3))
+PUNISHMENTS_ARCHIVE_DIR = os.getenv('PUNISHMENTS_ARCHIVE_DIR', 'archive')
+PUNISHMENTS_EXPORT_DIR = os.getenv('PUNISHMENTS_EXPORT_DIR', 'exports')
+DB_CONNECT_TIMEOUT = float(os.getenv('DB_CONNECT_TIMEOUT', 5))
+DB_BREAKER_THRESHOLD = int(os.getenv('DB_BREAKER_THRESHOLD', 3))
+DB_BREAKER_RESET_SECONDS = float(os.getenv('DB_BREAKER_RESET_SECONDS', 30))
+DB_SPOOL_PATH = os.getenv('DB_SPOOL_PATH', 'db_spool.bin')
+DB_SPOOL_FSYNC_INTERVAL = float(os.getenv('DB_SPOOL_FSYNC_INTERVAL', 0.2))
+DB_SPOOL_FSYNC_BATCH = int(os.getenv('DB_SPOOL_FSYNC_BATCH', 32))
+DB_SPOOL_REPLAY_INTERVAL = float(os.getenv('DB_SPOOL_REPLAY_INTERVAL', 5))
+DB_REPLICA_DSNS = [dsn.strip() for dsn in os.getenv('DB_REPLICA_DSNS', '').split(',') if dsn.strip()]
+DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', 5))
+DB_REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_LAG_CHECK_INTERVAL', 10))
+DB_READ_STICKY_SECONDS = float(os.getenv('DB_READ_STICKY_SECONDS', 10))
+WARNINGS_FLUSH_INTERVAL = float(os.getenv('WARNINGS_FLUSH_INTERVAL', 2))
+WARNINGS_FLUSH_BATCH = int(os.getenv('WARNINGS_FLUSH_BATCH', 500))
+WARNINGS_RECONCILE_INTERVAL = int(os.getenv('WARNINGS_RECONCILE_INTERVAL', 60 * 60))
+MUTE_EXPIRY_POLL_INTERVAL = float(os.getenv('MUTE_EXPIRY_POLL_INTERVAL', 15))
+STATS_FLUSH_INTERVAL = float(os.getenv('STATS_FLUSH_INTERVAL', 60))
+STATS_DAILY_RETENTION_DAYS = int(os.getenv('STATS_DAILY_RETENTION_DAYS', 90))
+MASS_ACTION_MAX_USERS = int(os.getenv('MASS_ACTION_MAX_USERS', 500))
+MASS_ACTION_CONCURRENCY = int(os.getenv('MASS_ACTION_CONCURRENCY', 8))
+FORBIDDEN_WORDS_PATH = os.getenv('FORBIDDEN_WORDS_PATH', 'forbidden_words.txt')
+FORBIDDEN_WORDS_POLL_INTERVAL = float(os.getenv('FORBIDDEN_WORDS_POLL_INTERVAL', 5))
+BLOCKED_DOMAINS_PATH = os.getenv('BLOCKED_DOMAINS_PATH', 'blocked_domains.txt')
+CHAT_WORDS_CACHE_SIZE = int(os.getenv('CHAT_WORDS_CACHE_SIZE', 256))
+CHAT_WORDS_CACHE_TTL = float(os.getenv('CHAT_WORDS_CACHE_TTL', 60))
+SCANNED_MESSAGES_CACHE_SIZE = int(os.getenv('SCANNED_MESSAGES_CACHE_SIZE', 20000))
+VERDICT_CACHE_SIZE = int(os.getenv('VERDICT_CACHE_SIZE', 50000))
+VERDICT_CACHE_TTL = float(os.getenv('VERDICT_CACHE_TTL', 60 * 60))
+FLOOD_DEFAULT_LIMIT = int(os.getenv('FLOOD_DEFAULT_LIMIT', 8))
+FLOOD_DEFAULT_WINDOW = int(os.getenv('FLOOD_DEFAULT_WINDOW', 10))
+FLOOD_DEFAULT_MUTE_MINUTES = int(os.getenv('FLOOD_DEFAULT_MUTE_MINUTES', 30))
+FLOOD_MAX_LIMIT = 50
+FLOOD_MAX_TRACKED = int(os.getenv('FLOOD_MAX_TRACKED', 300000))
+FLOOD_SWEEP_INTERVAL = float(os.getenv('FLOOD_SWEEP_INTERVAL', 60))
+SPAM_WAVE_WINDOW = int(os.getenv('SPAM_WAVE_WINDOW', 10 * 60))
+SPAM_WAVE_MIN_CHATS = int(os.getenv('SPAM_WAVE_MIN_CHATS', 3))
+SPAM_WAVE_MIN_USERS = int(os.getenv('SPAM_WAVE_MIN_USERS', 5))
+SPAM_WAVE_MIN_LENGTH = int(os.getenv('SPAM_WAVE_MIN_LENGTH', 30))
+SPAM_WAVE_MAX_TEXT = 1024
+SPAM_WAVE_MAX_SHINGLES = 128
+SPAM_WAVE_MAX_DISTANCE = 3
+SPAM_WAVE_BUCKET_SIZE = int(os.getenv('SPAM_WAVE_BUCKET_SIZE', 200))
+SPAM_WAVE_MUTE_MINUTES = int(os.getenv('SPAM_WAVE_MUTE_MINUTES', 24 * 60))
+RAID_JOIN_LIMIT = int(os.getenv('RAID_JOIN_LIMIT', 10))
+RAID_JOIN_WINDOW = float(os.getenv('RAID_JOIN_WINDOW', 30))
+RAID_QUIET_SECONDS = float(os.getenv('RAID_QUIET_SECONDS', 60))
+RAID_LOCKDOWN = os.getenv('RAID_LOCKDOWN', '0') == '1'
+RAID_LOCKDOWN_MINUTES = int(os.getenv('RAID_LOCKDOWN_MINUTES', 30))
+RAID_REVIEW_TTL = int(os.getenv('RAID_REVIEW_TTL', 24 * 60 * 60))
+CHAT_RULES_MAX = int(os.getenv('CHAT_RULES_MAX', 50))
+CHAT_RULE_MAX_PATTERN = 300
+CHAT_RULE_MAX_TEXT = 4096
+MAX_WARNINGS = 3
 
 redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, password=REDIS_PASSWORD, decode_responses=True, ssl=True)
 
@@ -59,70 +135,841 @@ telethon_client = TelegramClient(SESSION_PATH, API_ID, API_HASH) if API_ID and A
 
 @dataclass
 class ModerationTask:
-    task_type: str  # 'ban', 'kick', 'mute', 'warn'
+    task_type: str  # 'ban', 'kick', 'mute', 'warn', 'massban', 'massmute'
     user_id: int
     username: Optional[str]
     reason: str
     chat_id: int
     moderator_id: int
     duration_minutes: Optional[int] = None
+    user_ids: Optional[list] = None  # для 'massban' / 'massmute'
+    targets: Optional[list] = None  # для 'massmute' по різних чатах: [chat_id, user_id, message_id]
 
-# Ініціалізація бази даних PostgreSQL
-async def init_db():
-    try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
+# Кешовані метадані чату (назва, username, тип, права бота)
+@dataclass
+class ChatInfo:
+    chat_id: int
+    title: Optional[str] = None
+    username: Optional[str] = None
+    chat_type: Optional[str] = None
+    bot_status: Optional[str] = None
+    bot_can_restrict: Optional[bool] = None
+    bot_can_delete: Optional[bool] = None
+    updated_at: Optional[datetime.datetime] = None
+    flood_limit: Optional[int] = None
+    flood_window_seconds: Optional[int] = None
+    flood_mute_minutes: Optional[int] = None
+
+    def is_stale(self) -> bool:
+        if self.updated_at is None:
+            return True
+        return datetime.datetime.utcnow() - self.updated_at > datetime.timedelta(seconds=CHAT_CACHE_TTL)
+
+    # Поріг флуду чату: (повідомлень, за секунд, хвилин мута); 0 повідомлень — вимкнено
+    def flood_settings(self) -> tuple[int, int, int]:
+        limit = FLOOD_DEFAULT_LIMIT if self.flood_limit is None else self.flood_limit
+        window = self.flood_window_seconds or FLOOD_DEFAULT_WINDOW
+        mute_minutes = self.flood_mute_minutes or FLOOD_DEFAULT_MUTE_MINUTES
+        return min(limit, FLOOD_MAX_LIMIT), window, mute_minutes
+
+    def display_name(self) -> str:
+        if self.title:
+            return self.title
+        if self.username:
+            return f"@{self.username}"
+        return f"ID: {self.chat_id}"
+
+# Кеш метаданих чатів: chat_id -> ChatInfo
+chat_cache: dict[int, ChatInfo] = {}
+
+# LRU-кеш з обмеженням розміру та часом життя записів
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key) -> bool:
+        item = self._data.get(key)
+        return item is not None and item[0] >= time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+# Обмежувач частоти запитів до Bot API (token bucket)
+class RateLimiter:
+    def __init__(self, rate: float, burst: int | None = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+api_rate_limiter = RateLimiter(API_RATE_LIMIT)
+
+# Профіль користувача для згадок (дзеркало таблиці telegramuser)
+@dataclass
+class UserProfile:
+    user_id: int
+    username: Optional[str] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+
+# Кеш профілів: user_id -> UserProfile
+user_profile_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# Індекс username (у нижньому регістрі) -> user_id та зворотний індекс для зміни username
+username_index: dict[str, int] = {}
+username_by_user: dict[int, str] = {}
+# Негативний кеш username, які не знайшов навіть Telethon
+username_negative_cache = TTLCache(USER_CACHE_SIZE, USERNAME_NEGATIVE_TTL)
+
+# Додавання користувача до індексу username
+def index_username(user_id: int, username: str | None):
+    if not username:
+        return
+    key = username.lower()
+    old_key = username_by_user.get(user_id)
+    if old_key == key:
+        return
+    if old_key is not None and username_index.get(old_key) == user_id:
+        del username_index[old_key]
+    username_index[key] = user_id
+    username_by_user[user_id] = key
+    username_negative_cache.pop(key)
+
+# База даних недоступна (circuit breaker відкритий)
+class DatabaseUnavailable(Exception):
+    pass
+
+# Помилки, після яких вважаємо, що база даних недоступна, а не що запит некоректний
+DB_UNAVAILABLE_ERRORS = (DatabaseUnavailable, OSError, asyncio.TimeoutError,
+                         asyncpg.PostgresConnectionError, asyncpg.InterfaceError)
+
+# Circuit breaker: після DB_BREAKER_THRESHOLD помилок поспіль перестаємо ходити в базу
+# на DB_BREAKER_RESET_SECONDS, потім пропускаємо одну пробну спробу
+class CircuitBreaker:
+    def __init__(self, threshold: int, reset_seconds: float):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow_request(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.trial_in_flight or time.monotonic() - self.opened_at < self.reset_seconds:
+            return False
+        self.trial_in_flight = True
+        return True
 
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("З'єднання з базою даних відновлено, circuit breaker закрито.")
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.error(f"База даних недоступна після {self.failures} спроб, circuit breaker відкрито.")
+            self.opened_at = time.monotonic()
+
+db_breaker = CircuitBreaker(DB_BREAKER_THRESHOLD, DB_BREAKER_RESET_SECONDS)
+
+# SSL-контекст для підключень до бази даних
+def db_ssl_context():
+    if DB_SSLMODE != 'require':
+        return None
+    ssl_context = ssl.create_default_context(cafile=certifi.where())
+    ssl_context.check_hostname = True
+    ssl_context.verify_mode = ssl.CERT_REQUIRED
+    return ssl_context
+
+# Репліка для читання зі своїм circuit breaker і останнім виміряним лагом
+@dataclass
+class ReplicaState:
+    dsn: str
+    breaker: CircuitBreaker
+    lag: float = 0.0
+    lag_checked_at: float = float('-inf')
+
+db_replicas = [ReplicaState(dsn, CircuitBreaker(DB_BREAKER_THRESHOLD, DB_BREAKER_RESET_SECONDS)) for dsn in DB_REPLICA_DSNS]
+replica_cursor = 0
+
+# Лаг репліки в секундах (0, якщо весь отриманий WAL уже застосовано)
+REPLICA_LAG_SQL = '''
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+    END
+'''
+
+# Read-your-writes: після запису ключ (chat_id або назва таблиці) на короткий час читається з primary
+recent_writes = {}
+
+def mark_recent_write(key):
+    recent_writes[key] = time.monotonic() + DB_READ_STICKY_SECONDS
+
+def is_sticky(key) -> bool:
+    expires_at = recent_writes.get(key)
+    if expires_at is None:
+        return False
+    if expires_at < time.monotonic():
+        del recent_writes[key]
+        return False
+    return True
+
+# Підключення до наступної живої репліки з допустимим лагом (round-robin), або None
+async def connect_replica():
+    global replica_cursor
+    for _ in range(len(db_replicas)):
+        replica = db_replicas[replica_cursor % len(db_replicas)]
+        replica_cursor += 1
+        lag_is_fresh = time.monotonic() - replica.lag_checked_at < DB_REPLICA_LAG_CHECK_INTERVAL
+        if lag_is_fresh and replica.lag > DB_REPLICA_MAX_LAG:
+            continue
+        if not replica.breaker.allow_request():
+            continue
+        conn = None
+        try:
+            conn = await asyncpg.connect(dsn=replica.dsn, ssl=db_ssl_context(), timeout=DB_CONNECT_TIMEOUT)
+            if not lag_is_fresh:
+                replica.lag = float(await conn.fetchval(REPLICA_LAG_SQL) or 0)
+                replica.lag_checked_at = time.monotonic()
+        except DB_UNAVAILABLE_ERRORS as e:
+            replica.breaker.record_failure()
+            logger.warning(f"Репліка недоступна: {e}")
+            if conn is not None:
+                await conn.close()
+            continue
+        replica.breaker.record_success()
+        if replica.lag > DB_REPLICA_MAX_LAG:
+            logger.warning(f"Репліка відстає на {replica.lag:.1f} с, читання йде на primary")
+            await conn.close()
+            continue
+        return conn
+    return None
+
+# Підключення до бази даних через circuit breaker.
+# readonly=True читає з репліки, якщо вона є, не відстає і ключ не записувався щойно.
+async def db_connect(readonly: bool = False, sticky_key=None):
+    if readonly and db_replicas and not is_sticky(sticky_key):
+        conn = await connect_replica()
+        if conn is not None:
+            return conn
+    if not db_breaker.allow_request():
+        raise DatabaseUnavailable("circuit breaker відкритий")
+    try:
         conn = await asyncpg.connect(
             host=DB_HOST,
             port=DB_PORT,
             database=DB_NAME,
             user=DB_USER,
             password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
+            ssl=db_ssl_context(),
+            timeout=DB_CONNECT_TIMEOUT
         )
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS moderators (
-                user_id BIGINT PRIMARY KEY,
-                username TEXT
-            )
-        ''')
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS warnings (
-                user_id BIGINT,
-                chat_id BIGINT,
-                warn_count INTEGER DEFAULT 0,
-                PRIMARY KEY (user_id, chat_id)
-            )
-        ''')
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS bans (
-                user_id BIGINT,
-                chat_id BIGINT,
-                reason TEXT,
-                PRIMARY KEY (user_id, chat_id)
-            )
-        ''')
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS punishments (
-                id SERIAL PRIMARY KEY,
+    except DB_UNAVAILABLE_ERRORS:
+        db_breaker.record_failure()
+        raise
+    db_breaker.record_success()
+    return conn
+
+# Локальний append-only журнал записів, які не вдалося виконати в базі.
+# Формат запису: 4 байти довжини (big-endian) + JSON {id, op, at, args}; id робить відтворення ідемпотентним.
+# Позиція вже відтворених записів зберігається у файлі <path>.offset.
+class WriteSpool:
+    HEADER = struct.Struct('>I')
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.dead_letter_path = path + '.dead'
+        self.file = None
+        self.pending = 0
+        self.unsynced = 0
+        self.fsync_handle = None
+
+    def open(self):
+        self.file = open(self.path, 'a+b')
+        offset = self.read_offset()
+        self.file.seek(0)
+        valid_end, count = 0, 0
+        while True:
+            header = self.file.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                break
+            (length,) = self.HEADER.unpack(header)
+            if len(self.file.read(length)) < length:
+                break
+            valid_end = self.file.tell()
+            if valid_end > offset:
+                count += 1
+        if self.file.seek(0, os.SEEK_END) != valid_end:
+            logger.warning(f"Обрізано пошкоджений хвіст журналу {self.path} до {valid_end} байт")
+            self.file.truncate(valid_end)
+        self.pending = count
+        if count:
+            logger.info(f"У журналі {self.path} {count} невідтворених записів")
+
+    def read_offset(self) -> int:
+        try:
+            with open(self.offset_path) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def write_offset(self, offset: int):
+        tmp_path = self.offset_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.offset_path)
+
+    def append(self, op: str, at: datetime.datetime, args: tuple):
+        if self.file is None:
+            self.open()
+        record = {'id': os.urandom(16).hex(), 'op': op, 'at': at.isoformat(), 'args': list(args)}
+        payload = json.dumps(record, ensure_ascii=False).encode('utf-8')
+        self.file.write(self.HEADER.pack(len(payload)) + payload)
+        self.file.flush()
+        self.pending += 1
+        self.unsynced += 1
+        if self.unsynced >= DB_SPOOL_FSYNC_BATCH:
+            self.sync()
+        elif self.fsync_handle is None:
+            self.fsync_handle = asyncio.get_running_loop().call_later(DB_SPOOL_FSYNC_INTERVAL, self.sync)
+
+    def sync(self):
+        if self.fsync_handle is not None:
+            self.fsync_handle.cancel()
+            self.fsync_handle = None
+        if self.file is not None and self.unsynced:
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+
+    # Невідтворені записи по порядку: (offset кінця запису, сирий JSON запису)
+    def records(self):
+        if self.file is None:
+            self.open()
+        offset = self.read_offset()
+        self.file.seek(offset)
+        while True:
+            header = self.file.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                return
+            (length,) = self.HEADER.unpack(header)
+            payload = self.file.read(length)
+            offset = self.file.tell()
+            yield offset, payload
+            self.file.seek(offset)
+
+    # Запис, який база відхилила не через з'єднання, зберігається окремо для ручного розбору
+    def dead_letter(self, payload: bytes, error: Exception):
+        entry = {'record': payload.decode('utf-8', errors='replace'), 'error': repr(error),
+                 'failed_at': datetime.datetime.utcnow().isoformat()}
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    # Підтвердження count відтворених записів до offset (одне оновлення offset на пакет)
+    def commit(self, offset: int, count: int = 1):
+        self.pending = max(self.pending - count, 0)
+        if self.pending == 0:
+            self.sync()
+            self.file.truncate(0)
+            self.write_offset(0)
+        else:
+            self.write_offset(offset)
+
+write_spool = WriteSpool(DB_SPOOL_PATH)
+
+# Операції запису, які можна відкласти в журнал: ім'я -> async fn(conn, at, *args)
+SPOOLABLE_WRITES = {}
+
+def spoolable_write(name: str):
+    def decorator(func):
+        SPOOLABLE_WRITES[name] = func
+        return func
+    return decorator
+
+# Виконання запису в базі; при недоступній базі запис іде в журнал і відтворюється пізніше.
+# Поки журнал не порожній, нові записи теж ідуть у журнал, щоб зберегти порядок.
+async def execute_write(op: str, *args, sticky_key=None):
+    at = datetime.datetime.utcnow()
+    if sticky_key is not None:
+        mark_recent_write(sticky_key)
+    if write_spool.pending or db_breaker.is_open:
+        write_spool.append(op, at, args)
+        return None
+    try:
+        conn = await db_connect()
+        return await SPOOLABLE_WRITES[op](conn, at, *args)
+    except DB_UNAVAILABLE_ERRORS as e:
+        if 'conn' in locals():
+            db_breaker.record_failure()
+        logger.warning(f"Запис {op} відкладено в журнал: {e}")
+        write_spool.append(op, at, args)
+        return None
+    except Exception as e:
+        logger.error(f"Помилка запису {op}: {e}")
+        return None
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+# Позначка відтвореного запису журналу; None, якщо запис з таким id уже застосовано
+SPOOL_APPLIED_SQL = 'INSERT INTO spool_applied (record_id) VALUES ($1) ON CONFLICT DO NOTHING RETURNING true'
+
+# Відтворення журналу по порядку; зупиняється при першій помилці з'єднання.
+# Записи, які база відхилила з іншої причини, переносяться в dead-letter файл, а не губляться.
+# Offset фіксується пакетами по DB_SPOOL_FSYNC_BATCH записів і перед виходом. Позначка id комітиться
+# в одній транзакції із самим записом, тож записи, повторені після падіння до фіксації offset, пропускаються.
+async def replay_write_spool():
+    replayed, uncommitted, last_offset = 0, 0, None
+    try:
+        conn = await db_connect()
+        for offset, payload in write_spool.records():
+            try:
+                record = json.loads(payload)
+                op, at, args = record['op'], datetime.datetime.fromisoformat(record['at']), record['args']
+                async with conn.transaction():
+                    if record.get('id') is None or await conn.fetchval(SPOOL_APPLIED_SQL, record['id']):
+                        await SPOOLABLE_WRITES[op](conn, at, *args)
+            except DB_UNAVAILABLE_ERRORS:
+                db_breaker.record_failure()
+                raise
+            except Exception as e:
+                logger.error(f"Запис журналу перенесено в {write_spool.dead_letter_path}: {e}")
+                write_spool.dead_letter(payload, e)
+            last_offset = offset
+            uncommitted += 1
+            replayed += 1
+            if uncommitted >= DB_SPOOL_FSYNC_BATCH:
+                write_spool.commit(last_offset, uncommitted)
+                uncommitted = 0
+        if replayed:
+            logger.info(f"Відтворено {replayed} записів журналу, залишилось {write_spool.pending - uncommitted}")
+            await conn.execute("DELETE FROM spool_applied WHERE applied_at < NOW() - INTERVAL '1 day'")
+    except DB_UNAVAILABLE_ERRORS as e:
+        logger.warning(f"Відтворення журналу відкладено: {e}")
+    finally:
+        if uncommitted:
+            write_spool.commit(last_offset, uncommitted)
+        if 'conn' in locals():
+            await conn.close()
+
+# Фонова задача відтворення журналу після відновлення бази
+async def spool_replayer():
+    while True:
+        await asyncio.sleep(DB_SPOOL_REPLAY_INTERVAL)
+        if write_spool.pending or db_breaker.is_open:
+            await replay_write_spool()
+
+# Крок міграції, який створює індекс CONCURRENTLY (виконується поза транзакцією)
+@dataclass
+class ConcurrentIndex:
+    name: str
+    sql: str
+
+# Крок міграції, який переносить рядки пакетами по batch_size у власних транзакціях,
+# поки запит не поверне 0 рядків або таблиця-джерело не зникне (виконується поза транзакцією)
+@dataclass
+class BatchedStep:
+    source_table: str
+    sql: str
+    batch_size: int = 10000
+
+# Версійна міграція схеми
+@dataclass
+class Migration:
+    version: int
+    description: str
+    steps: list
+
+# Міграції схеми; нові кроки додаються тільки в кінець списку з наступною версією
+MIGRATIONS = [
+    Migration(1, "Базові таблиці", [
+        '''
+        CREATE TABLE IF NOT EXISTS moderators (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS warnings (
+            user_id BIGINT,
+            chat_id BIGINT,
+            warn_count INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, chat_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS bans (
+            user_id BIGINT,
+            chat_id BIGINT,
+            reason TEXT,
+            PRIMARY KEY (user_id, chat_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS punishments (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            chat_id BIGINT,
+            punishment_type TEXT,
+            reason TEXT,
+            timestamp TIMESTAMP,
+            duration_minutes INTEGER,
+            moderator_id BIGINT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id BIGINT PRIMARY KEY,
+            filter_enabled BOOLEAN DEFAULT TRUE
+        )
+        ''',
+    ]),
+    Migration(2, "Таблиця telegramuser", [
+        '''
+        CREATE TABLE IF NOT EXISTS telegramuser (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            last_seen TIMESTAMP
+        )
+        ''',
+    ]),
+    Migration(3, "Метадані чатів у chat_settings", [
+        '''
+        ALTER TABLE chat_settings
+            ADD COLUMN IF NOT EXISTS chat_title TEXT,
+            ADD COLUMN IF NOT EXISTS chat_username TEXT,
+            ADD COLUMN IF NOT EXISTS chat_type TEXT,
+            ADD COLUMN IF NOT EXISTS bot_status TEXT,
+            ADD COLUMN IF NOT EXISTS bot_can_restrict BOOLEAN,
+            ADD COLUMN IF NOT EXISTS bot_can_delete BOOLEAN,
+            ADD COLUMN IF NOT EXISTS metadata_updated_at TIMESTAMP
+        ''',
+    ]),
+    Migration(4, "Лічильники покарань за типами", [
+        '''
+        CREATE TABLE IF NOT EXISTS punishment_totals (
+            user_id BIGINT,
+            chat_id BIGINT,
+            punishment_type TEXT,
+            total INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, chat_id, punishment_type)
+        )
+        ''',
+        '''
+        INSERT INTO punishment_totals (user_id, chat_id, punishment_type, total)
+        SELECT user_id, chat_id, punishment_type, COUNT(*)
+        FROM punishments
+        GROUP BY user_id, chat_id, punishment_type
+        ON CONFLICT DO NOTHING
+        ''',
+    ]),
+    Migration(5, "Індекси для гарячих запитів", [
+        ConcurrentIndex(
+            "punishments_user_chat_ts_idx",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS punishments_user_chat_ts_idx "
+            "ON punishments (user_id, chat_id, timestamp DESC, id DESC)"
+        ),
+        ConcurrentIndex(
+            "punishments_chat_ts_idx",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS punishments_chat_ts_idx "
+            "ON punishments (chat_id, timestamp DESC)"
+        ),
+        ConcurrentIndex(
+            "telegramuser_username_lower_idx",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS telegramuser_username_lower_idx "
+            "ON telegramuser (lower(username))"
+        ),
+    ]),
+    Migration(6, "Помісячне партиціювання punishments", [
+        # Структура створюється один раз: повторний запуск після перерваної міграції бачить,
+        # що punishments уже партиційована, і переходить до перенесення рядків.
+        # Партиції наперед — на той самий горизонт, що й у ensure_punishment_partitions, інакше нові рядки
+        # осіли б у punishments_default і створення партиції на ці місяці потім завершилося б помилкою
+        f'''
+        DO $$
+        DECLARE
+            month_start DATE;
+            last_month DATE := (date_trunc('month', NOW()) + INTERVAL '{PUNISHMENT_PARTITIONS_AHEAD} months')::date;
+        BEGIN
+            IF (SELECT relkind FROM pg_class WHERE oid = 'punishments'::regclass) = 'p' THEN
+                RETURN;
+            END IF;
+            ALTER TABLE punishments RENAME TO punishments_legacy;
+            ALTER TABLE punishments_legacy RENAME CONSTRAINT punishments_pkey TO punishments_legacy_pkey;
+            ALTER INDEX IF EXISTS punishments_user_chat_ts_idx RENAME TO punishments_legacy_user_chat_ts_idx;
+            ALTER INDEX IF EXISTS punishments_chat_ts_idx RENAME TO punishments_legacy_chat_ts_idx;
+            ALTER SEQUENCE punishments_id_seq OWNED BY NONE;
+            CREATE TABLE punishments (
+                id BIGINT NOT NULL DEFAULT nextval('punishments_id_seq'),
                 user_id BIGINT,
                 chat_id BIGINT,
                 punishment_type TEXT,
                 reason TEXT,
-                timestamp TIMESTAMP,
+                timestamp TIMESTAMP NOT NULL DEFAULT NOW(),
                 duration_minutes INTEGER,
-                moderator_id BIGINT
+                moderator_id BIGINT,
+                PRIMARY KEY (id, timestamp)
+            ) PARTITION BY RANGE (timestamp);
+            ALTER SEQUENCE punishments_id_seq OWNED BY punishments.id;
+            CREATE TABLE punishments_default PARTITION OF punishments DEFAULT;
+            month_start := date_trunc('month', COALESCE((SELECT MIN(timestamp) FROM punishments_legacy), NOW()))::date;
+            WHILE month_start <= last_month LOOP
+                EXECUTE format(
+                    'CREATE TABLE IF NOT EXISTS %I PARTITION OF punishments FOR VALUES FROM (%L) TO (%L)',
+                    'punishments_p' || to_char(month_start, 'YYYYMM'),
+                    month_start,
+                    (month_start + INTERVAL '1 month')::date
+                );
+                month_start := (month_start + INTERVAL '1 month')::date;
+            END LOOP;
+            CREATE INDEX punishments_user_chat_ts_idx ON punishments (user_id, chat_id, timestamp DESC, id DESC);
+            CREATE INDEX punishments_chat_ts_idx ON punishments (chat_id, timestamp DESC);
+        END $$
+        ''',
+        BatchedStep(
+            "punishments_legacy",
+            '''
+            WITH batch AS (
+                DELETE FROM punishments_legacy
+                WHERE id IN (SELECT id FROM punishments_legacy ORDER BY id LIMIT $1)
+                RETURNING id, user_id, chat_id, punishment_type, reason, timestamp, duration_minutes, moderator_id
             )
-        ''')
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS chat_settings (
-                chat_id BIGINT PRIMARY KEY,
-                filter_enabled BOOLEAN DEFAULT TRUE
+            INSERT INTO punishments (id, user_id, chat_id, punishment_type, reason, timestamp, duration_minutes, moderator_id)
+            SELECT id, user_id, chat_id, punishment_type, reason, COALESCE(timestamp, 'epoch'::timestamp),
+                   duration_minutes, moderator_id
+            FROM batch
+            '''
+        ),
+        'DROP TABLE IF EXISTS punishments_legacy',
+    ]),
+    Migration(7, "Реєстр активних обмежень", [
+        '''
+        CREATE TABLE IF NOT EXISTS restrictions (
+            user_id BIGINT,
+            chat_id BIGINT,
+            restriction_type TEXT NOT NULL DEFAULT 'mute',
+            reason TEXT,
+            moderator_id BIGINT,
+            created_at TIMESTAMP NOT NULL,
+            expires_at TIMESTAMP,
+            PRIMARY KEY (user_id, chat_id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS restrictions_expires_at_idx ON restrictions (expires_at)',
+    ]),
+    Migration(8, "Зведена статистика модерації", [
+        '''
+        CREATE TABLE IF NOT EXISTS moderation_stats (
+            chat_id BIGINT,
+            moderator_id BIGINT NOT NULL DEFAULT 0,
+            punishment_type TEXT,
+            day DATE,
+            total INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, moderator_id, punishment_type, day)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS chat_message_stats (
+            chat_id BIGINT,
+            day DATE,
+            messages INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, day)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS punishment_totals_chat_idx ON punishment_totals (chat_id)',
+        '''
+        INSERT INTO moderation_stats (chat_id, moderator_id, punishment_type, day, total)
+        SELECT chat_id, COALESCE(moderator_id, 0), punishment_type, timestamp::date, COUNT(*)
+        FROM punishments
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT DO NOTHING
+        ''',
+    ]),
+    Migration(9, "Списки заборонених слів для окремих чатів", [
+        '''
+        CREATE TABLE IF NOT EXISTS chat_forbidden_words (
+            chat_id BIGINT,
+            word TEXT,
+            mode TEXT NOT NULL DEFAULT 'add',
+            added_by BIGINT,
+            added_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (chat_id, word)
+        )
+        ''',
+    ]),
+    Migration(10, "Пороги флуду в chat_settings", [
+        'ALTER TABLE chat_settings ADD COLUMN IF NOT EXISTS flood_limit INTEGER',
+        'ALTER TABLE chat_settings ADD COLUMN IF NOT EXISTS flood_window_seconds INTEGER',
+        'ALTER TABLE chat_settings ADD COLUMN IF NOT EXISTS flood_mute_minutes INTEGER',
+    ]),
+    Migration(11, "Правила доменів для окремих чатів", [
+        '''
+        CREATE TABLE IF NOT EXISTS chat_domain_rules (
+            chat_id BIGINT,
+            domain TEXT,
+            mode TEXT NOT NULL DEFAULT 'block',
+            added_by BIGINT,
+            added_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (chat_id, domain)
+        )
+        ''',
+    ]),
+    Migration(12, "Regex-правила чатів", [
+        '''
+        CREATE TABLE IF NOT EXISTS chat_rules (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            pattern TEXT NOT NULL,
+            action TEXT NOT NULL,
+            duration_minutes INTEGER,
+            priority INTEGER NOT NULL DEFAULT 0,
+            hits BIGINT NOT NULL DEFAULT 0,
+            added_by BIGINT,
+            added_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS chat_rules_chat_id_idx ON chat_rules (chat_id)',
+    ]),
+    Migration(13, "Відтворені записи журналу", [
+        '''
+        CREATE TABLE IF NOT EXISTS spool_applied (
+            record_id TEXT PRIMARY KEY,
+            applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        ''',
+    ]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1].version
+MIGRATION_LOCK_ID = 4170520261
+
+# Поточна версія схеми (0, якщо таблиці schema_version ще немає)
+async def get_schema_version(conn) -> int:
+    if not await conn.fetchval("SELECT to_regclass('schema_version') IS NOT NULL"):
+        return 0
+    return await conn.fetchval('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+
+# Застосування однієї міграції
+async def apply_migration(conn, migration: Migration):
+    if any(isinstance(step, (ConcurrentIndex, BatchedStep)) for step in migration.steps):
+        # CREATE INDEX CONCURRENTLY не може виконуватися в транзакції, а пакетне перенесення
+        # не повинно тримати блокування на всю таблицю; кожен крок має бути ідемпотентним
+        for step in migration.steps:
+            if isinstance(step, BatchedStep):
+                moved = 0
+                while await conn.fetchval('SELECT to_regclass($1) IS NOT NULL', step.source_table):
+                    status = await conn.execute(step.sql, step.batch_size)
+                    count = int(status.split()[-1])
+                    if count == 0:
+                        break
+                    moved += count
+                logger.info(f"Перенесено {moved} рядків із {step.source_table}")
+            elif isinstance(step, ConcurrentIndex):
+                valid = await conn.fetchval(
+                    'SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)', step.name
+                )
+                if valid is False:
+                    logger.warning(f"Індекс {step.name} невалідний після перерваної міграції, перестворюємо")
+                    await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {step.name}')
+                await conn.execute(step.sql)
+            else:
+                await conn.execute(step)
+        await conn.execute(
+            'INSERT INTO schema_version (version, description) VALUES ($1, $2)',
+            migration.version, migration.description
+        )
+    else:
+        async with conn.transaction():
+            for step in migration.steps:
+                await conn.execute(step)
+            await conn.execute(
+                'INSERT INTO schema_version (version, description) VALUES ($1, $2)',
+                migration.version, migration.description
             )
-        ''')
+    logger.info(f"Застосовано міграцію {migration.version}: {migration.description}")
+
+# Ініціалізація бази даних PostgreSQL (версійні міграції під advisory lock)
+async def init_db():
+    try:
+        conn = await db_connect()
+        if await get_schema_version(conn) >= SCHEMA_VERSION:
+            logger.info(f"Схема бази даних актуальна (версія {SCHEMA_VERSION}).")
+            return
+        await conn.execute('SELECT pg_advisory_lock($1)', MIGRATION_LOCK_ID)
+        try:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP DEFAULT NOW()
+                )
+            ''')
+            # Інший інстанс міг застосувати міграції, поки ми чекали на lock
+            current_version = await get_schema_version(conn)
+            for migration in MIGRATIONS:
+                if migration.version > current_version:
+                    await apply_migration(conn, migration)
+        finally:
+            await conn.execute('SELECT pg_advisory_unlock($1)', MIGRATION_LOCK_ID)
         logger.info("База даних ініціалізована успішно.")
     except Exception as e:
         logger.error(f"Помилка ініціалізації бази даних: {e}")
@@ -134,14 +981,7 @@ async def init_db():
 # Завантаження модераторів із бази даних
 async def load_moderators():
     try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        conn = await asyncpg.connect(
-            host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
-        )
+        conn = await db_connect(readonly=True, sticky_key='moderators')
         rows = await conn.fetch('SELECT user_id FROM moderators')
         moderators = {row['user_id'] for row in rows}
         return moderators
@@ -155,18 +995,12 @@ async def load_moderators():
 # Додавання модератора до бази даних
 async def add_moderator_to_db(user_id: int, username: str = None):
     try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        conn = await asyncpg.connect(
-            host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
-        )
+        conn = await db_connect()
         await conn.execute(
             'INSERT INTO moderators (user_id, username) VALUES ($1, $2) ON CONFLICT (user_id) DO NOTHING',
             user_id, username
         )
+        mark_recent_write('moderators')
         logger.info(f"Додано модератора до бази: user_id={user_id}, username={username}")
     except Exception as e:
         logger.error(f"Помилка додавання модератора до бази: {e}")
@@ -177,15 +1011,9 @@ async def add_moderator_to_db(user_id: int, username: str = None):
 # Видалення модератора з бази даних
 async def remove_moderator_from_db(user_id: int):
     try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        conn = await asyncpg.connect(
-            host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
-        )
+        conn = await db_connect()
         await conn.execute('DELETE FROM moderators WHERE user_id = $1', user_id)
+        mark_recent_write('moderators')
         logger.info(f"Видалено модератора з бази: user_id={user_id}")
     except Exception as e:
         logger.error(f"Помилка видалення модератора з бази: {e}")
@@ -196,14 +1024,7 @@ async def remove_moderator_from_db(user_id: int):
 # Перевірка, чи є користувач модератором
 async def is_moderator(user_id: int) -> bool:
     try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        conn = await asyncpg.connect(
-            host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
-        )
+        conn = await db_connect(readonly=True, sticky_key='moderators')
         result = await conn.fetchval('SELECT 1 FROM moderators WHERE user_id = $1', user_id)
         return bool(result)
     except Exception as e:
@@ -216,14 +1037,7 @@ async def is_moderator(user_id: int) -> bool:
 # Отримання username модератора
 async def get_moderator_username(user_id: int) -> str | None:
     try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        conn = await asyncpg.connect(
-            host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
-        )
+        conn = await db_connect(readonly=True, sticky_key='moderators')
         result = await conn.fetchval('SELECT username FROM moderators WHERE user_id = $1', user_id)
         return result
     except Exception as e:
@@ -235,14 +1049,7 @@ async def get_moderator_username(user_id: int) -> str | None:
 
 async def upsert_chat_settings(chat_id: int, chat_title: str = None, filter_enabled: bool = True):
     try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        conn = await asyncpg.connect(
-            host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
-        )
+        conn = await db_connect()
         if chat_title:  # оновлюємо тільки якщо є назва
             await conn.execute(
                 '''
@@ -264,12 +1071,148 @@ async def upsert_chat_settings(chat_id: int, chat_title: str = None, filter_enab
                 ''',
                 chat_id, filter_enabled
             )
+        mark_recent_write(chat_id)
     except Exception as e:
         logger.error(f"Помилка запису chat_settings: {e}")
     finally:
         if 'conn' in locals():
             await conn.close()
 
+# Завантаження кешу метаданих чатів із chat_settings
+async def load_chat_cache():
+    try:
+        conn = await db_connect(readonly=True)
+        rows = await conn.fetch('''
+            SELECT chat_id, chat_title, chat_username, chat_type, bot_status,
+                   bot_can_restrict, bot_can_delete, metadata_updated_at,
+                   flood_limit, flood_window_seconds, flood_mute_minutes
+            FROM chat_settings
+        ''')
+        for row in rows:
+            chat_cache[row['chat_id']] = ChatInfo(
+                chat_id=row['chat_id'],
+                title=row['chat_title'],
+                username=row['chat_username'],
+                chat_type=row['chat_type'],
+                bot_status=row['bot_status'],
+                bot_can_restrict=row['bot_can_restrict'],
+                bot_can_delete=row['bot_can_delete'],
+                updated_at=row['metadata_updated_at'],
+                flood_limit=row['flood_limit'],
+                flood_window_seconds=row['flood_window_seconds'],
+                flood_mute_minutes=row['flood_mute_minutes']
+            )
+        logger.info(f"Завантажено кеш чатів: {len(chat_cache)} записів")
+    except Exception as e:
+        logger.error(f"Помилка завантаження кешу чатів: {e}")
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+# Збереження метаданих чату в chat_settings
+async def save_chat_info(info: ChatInfo):
+    try:
+        conn = await db_connect()
+        await conn.execute(
+            '''
+            INSERT INTO chat_settings (chat_id, chat_title, chat_username, chat_type, bot_status,
+                                       bot_can_restrict, bot_can_delete, metadata_updated_at)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+            ON CONFLICT (chat_id) DO UPDATE SET
+                chat_title = COALESCE(EXCLUDED.chat_title, chat_settings.chat_title),
+                chat_username = EXCLUDED.chat_username,
+                chat_type = COALESCE(EXCLUDED.chat_type, chat_settings.chat_type),
+                bot_status = COALESCE(EXCLUDED.bot_status, chat_settings.bot_status),
+                bot_can_restrict = COALESCE(EXCLUDED.bot_can_restrict, chat_settings.bot_can_restrict),
+                bot_can_delete = COALESCE(EXCLUDED.bot_can_delete, chat_settings.bot_can_delete),
+                metadata_updated_at = EXCLUDED.metadata_updated_at
+            ''',
+            info.chat_id, info.title, info.username, info.chat_type, info.bot_status,
+            info.bot_can_restrict, info.bot_can_delete, info.updated_at
+        )
+    except Exception as e:
+        logger.error(f"Помилка збереження метаданих чату {info.chat_id}: {e}")
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+# Оновлення кешу з об'єкта чату, який прийшов в апдейті (без запиту до API)
+async def remember_chat(chat: types.Chat) -> ChatInfo:
+    info = chat_cache.get(chat.id)
+    if info is None:
+        info = ChatInfo(chat_id=chat.id)
+        chat_cache[chat.id] = info
+    changed = (info.title != chat.title or info.username != chat.username or info.chat_type != chat.type)
+    info.title = chat.title
+    info.username = chat.username
+    info.chat_type = chat.type
+    if changed or info.is_stale():
+        info.updated_at = datetime.datetime.utcnow()
+        await save_chat_info(info)
+    return info
+
+# Оновлення прав бота в кеші за об'єктом ChatMember
+async def remember_bot_member(chat_id: int, chat_member) -> ChatInfo:
+    info = chat_cache.get(chat_id)
+    if info is None:
+        info = ChatInfo(chat_id=chat_id)
+        chat_cache[chat_id] = info
+    status = chat_member.status
+    info.bot_status = status
+    info.bot_can_restrict = status == "creator" or bool(getattr(chat_member, 'can_restrict_members', False))
+    info.bot_can_delete = status == "creator" or bool(getattr(chat_member, 'can_delete_messages', False))
+    await save_chat_info(info)
+    return info
+
+# Отримання метаданих чату: з кешу, а після закінчення TTL — через get_chat
+async def get_chat_info(chat_id: int, force_refresh: bool = False) -> ChatInfo:
+    info = chat_cache.get(chat_id)
+    if info is not None and (info.title or info.username) and not info.is_stale() and not force_refresh:
+        return info
+    try:
+        chat = await bot.get_chat(chat_id)
+        return await remember_chat(chat)
+    except TelegramBadRequest as e:
+        logger.warning(f"Не вдалося оновити інформацію про чат {chat_id}: {e}")
+    except Exception as e:
+        logger.error(f"Невідома помилка при оновленні чату {chat_id}: {e}")
+    return info if info is not None else ChatInfo(chat_id=chat_id)
+
+# Пакетне завантаження профілів із telegramuser для тих, кого немає в кеші
+async def load_user_profiles(user_ids) -> dict[int, UserProfile]:
+    profiles = {}
+    missing = []
+    for user_id in set(user_ids):
+        profile = user_profile_cache.get(user_id)
+        if profile is not None:
+            profiles[user_id] = profile
+        else:
+            missing.append(user_id)
+    if not missing:
+        return profiles
+    try:
+        conn = await db_connect(readonly=True)
+        rows = await conn.fetch(
+            'SELECT user_id, username, first_name, last_name FROM telegramuser WHERE user_id = ANY($1::bigint[])',
+            missing
+        )
+        for row in rows:
+            profile = UserProfile(
+                user_id=row['user_id'],
+                username=row['username'],
+                first_name=row['first_name'],
+                last_name=row['last_name']
+            )
+            user_profile_cache.set(profile.user_id, profile)
+            profiles[profile.user_id] = profile
+        logger.info(f"Завантажено профілі з telegramuser: {len(rows)} із {len(missing)}")
+    except Exception as e:
+        logger.error(f"Помилка завантаження профілів користувачів: {e}")
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+    return profiles
+
 
 # Функція для отримання всіх груп, де є бот
 async def get_bot_chats():
@@ -318,6 +1261,7 @@ async def get_bot_chats():
 
                     try:
                         chat_member = await bot.get_chat_member(chat_id=chat_id, user_id=bot_id)
+                        await remember_bot_member(chat_id, chat_member)
                         if chat_member.status in ["administrator", "creator"]:
                             bot_chats.append(chat_id)
                             logger.info(f"Додано чат до списку: ID={chat_id}, Title={dialog_title}")
@@ -344,6 +1288,13 @@ async def get_bot_chats():
     logger.info(f"Знайдено {len(bot_chats)} чатів, де бот є адміністратором: {bot_chats}")
     return bot_chats
 
+# Чати, де бот є адміністратором, за кешем метаданих (без ітерації діалогів Telethon)
+async def get_known_bot_chats() -> list:
+    bot_chats = [chat_id for chat_id, info in chat_cache.items() if info.bot_status in ["administrator", "creator"]]
+    if bot_chats:
+        return bot_chats
+    return await get_bot_chats()
+
 # Функція для перевірки, чи є користувач у чаті
 async def is_user_in_chat(chat_id: int, user_id: int) -> bool:
     try:
@@ -357,192 +1308,510 @@ async def is_user_in_chat(chat_id: int, user_id: int) -> bool:
         logger.error(f"Помилка при перевірці присутності користувача {user_id} у чаті {chat_id}: {e}")
         return False
 
-# Додавання попередження
-async def add_warning(user_id: int, chat_id: int) -> int:
+# Лічильники попереджень у Redis: хеш warnings:{chat_id} (user_id -> кількість).
+# Змінені пари "chat_id:user_id" потрапляють у множину warnings_dirty і пакетами дзеркаляться в Postgres.
+WARNINGS_DIRTY_KEY = 'warnings_dirty'
+WARNINGS_SEEDED_KEY = 'warnings_seeded'
+WARNINGS_MIRROR_LOCK_ID = 4170520262
+
+def warnings_key(chat_id: int) -> str:
+    return f"warnings:{chat_id}"
+
+# Повертає {нова кількість, 1 якщо досягнуто поріг ескалації}
+WARN_SCRIPT = redis_client.register_script('''
+    local count = redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+    redis.call('SADD', KEYS[2], ARGV[2])
+    local escalate = 0
+    if count >= tonumber(ARGV[3]) then
+        escalate = 1
+    end
+    return {count, escalate}
+''')
+
+# Повертає нову кількість або -1, якщо попереджень не було
+UNWARN_SCRIPT = redis_client.register_script('''
+    local count = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+    if count <= 0 then
+        return -1
+    end
+    count = count - 1
+    if count == 0 then
+        redis.call('HDEL', KEYS[1], ARGV[1])
+    else
+        redis.call('HSET', KEYS[1], ARGV[1], count)
+    end
+    redis.call('SADD', KEYS[2], ARGV[2])
+    return count
+''')
+
+# Додавання попередження; повертає (кількість, чи потрібна ескалація) або None при збої Redis
+def add_warning(user_id: int, chat_id: int) -> tuple[int, bool] | None:
     try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        conn = await asyncpg.connect(
-            host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
-        )
+        warn_count, escalate = WARN_SCRIPT(keys=[warnings_key(chat_id), WARNINGS_DIRTY_KEY],
+                                           args=[user_id, f"{chat_id}:{user_id}", MAX_WARNINGS])
+        logger.info(f"Додано попередження: user_id={user_id}, chat_id={chat_id}, warn_count={warn_count}")
+        return warn_count, bool(escalate)
+    except redis.RedisError as e:
+        logger.error(f"Помилка додавання попередження: {e}")
+        return None
+
+# Попередження, видані через таблицю warnings, поки Redis був недоступний: (chat_id, user_id) -> приріст.
+# warning_mirror переносить прирости в Redis, щоб наступне дзеркалювання не перезаписало їх старим значенням.
+pending_warning_deltas: dict[tuple[int, int], int] = {}
+
+# Запасний шлях add_warning без Redis: лічильник збільшується прямо в дзеркалі Postgres
+async def add_warning_in_db(user_id: int, chat_id: int) -> tuple[int, bool]:
+    try:
+        conn = await db_connect()
         warn_count = await conn.fetchval('''
-            INSERT INTO warnings (user_id, chat_id, warn_count)
-            VALUES ($1, $2, 1)
-            ON CONFLICT (user_id, chat_id)
-            DO UPDATE SET warn_count = warnings.warn_count + 1
+            INSERT INTO warnings (user_id, chat_id, warn_count) VALUES ($1, $2, 1)
+            ON CONFLICT (user_id, chat_id) DO UPDATE SET warn_count = warnings.warn_count + 1
             RETURNING warn_count
         ''', user_id, chat_id)
-        logger.info(f"Додано попередження: user_id={user_id}, chat_id={chat_id}, warn_count={warn_count}")
-        return warn_count
+        key = (chat_id, user_id)
+        pending_warning_deltas[key] = pending_warning_deltas.get(key, 0) + 1
+        logger.warning(f"Попередження записано в обхід Redis: user_id={user_id}, chat_id={chat_id}, warn_count={warn_count}")
+        return warn_count, warn_count >= MAX_WARNINGS
     except Exception as e:
-        logger.error(f"Помилка додавання попередження: {e}")
-        return 0
+        logger.error(f"Помилка запасного запису попередження: {e}")
+        return 0, False
     finally:
         if 'conn' in locals():
             await conn.close()
 
-# Зняття попередження
-async def remove_warning(user_id: int, chat_id: int) -> int:
+# Перенесення приростів, накопичених без Redis
+def apply_pending_warning_deltas():
+    global pending_warning_deltas
+    if not pending_warning_deltas:
+        return
+    deltas, pending_warning_deltas = pending_warning_deltas, {}
     try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        conn = await asyncpg.connect(
-            host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
-        )
-        warn_count = await conn.fetchval('''
-            UPDATE warnings
-            SET warn_count = warn_count - 1
-            WHERE user_id = $1 AND chat_id = $2 AND warn_count > 0
-            RETURNING warn_count
-        ''', user_id, chat_id)
-        if warn_count is None:
-            return 0
-        if warn_count == 0:
-            await conn.execute('DELETE FROM warnings WHERE user_id = $1 AND chat_id = $2', user_id, chat_id)
+        pipe = redis_client.pipeline()
+        for (chat_id, user_id), delta in deltas.items():
+            pipe.hincrby(warnings_key(chat_id), user_id, delta)
+            pipe.sadd(WARNINGS_DIRTY_KEY, f"{chat_id}:{user_id}")
+        pipe.execute()
+        logger.info(f"Перенесено в Redis {len(deltas)} лічильників попереджень, виданих без Redis")
+    except redis.RedisError as e:
+        for key, delta in deltas.items():
+            pending_warning_deltas[key] = pending_warning_deltas.get(key, 0) + delta
+        logger.error(f"Не вдалося перенести попередження в Redis: {e}")
+
+# Зняття попередження; повертає нову кількість, -1, якщо попереджень не було, або None при збої Redis
+def remove_warning(user_id: int, chat_id: int) -> int | None:
+    try:
+        warn_count = UNWARN_SCRIPT(keys=[warnings_key(chat_id), WARNINGS_DIRTY_KEY],
+                                   args=[user_id, f"{chat_id}:{user_id}"])
         logger.info(f"Знято попередження: user_id={user_id}, chat_id={chat_id}, warn_count={warn_count}")
         return warn_count
-    except Exception as e:
+    except redis.RedisError as e:
         logger.error(f"Помилка зняття попередження: {e}")
+        return None
+
+# Пакетне дзеркалювання змінених лічильників у таблицю warnings.
+# Значення читаються з Redis під advisory lock, тому паралельні воркери не перезапишуть новіше старішим.
+async def flush_warning_counts() -> int:
+    # Без позначки засіву Redis міг втратити дані: спершу reconcile_warnings, інакше неповні
+    # лічильники з Redis перезаписали б таблицю
+    if not redis_client.exists(WARNINGS_SEEDED_KEY):
+        return 0
+    members = redis_client.spop(WARNINGS_DIRTY_KEY, WARNINGS_FLUSH_BATCH)
+    if not members:
+        return 0
+    try:
+        pairs = [tuple(int(part) for part in member.split(':')) for member in members]
+        conn = await db_connect()
+        async with conn.transaction():
+            await conn.execute('SELECT pg_advisory_xact_lock($1)', WARNINGS_MIRROR_LOCK_ID)
+            pipe = redis_client.pipeline()
+            for chat_id, user_id in pairs:
+                pipe.hget(warnings_key(chat_id), user_id)
+            counts = pipe.execute()
+            upserts = [(user_id, chat_id, int(count)) for (chat_id, user_id), count in zip(pairs, counts) if count]
+            deletes = [(user_id, chat_id) for (chat_id, user_id), count in zip(pairs, counts) if not count]
+            if upserts:
+                await conn.executemany('''
+                    INSERT INTO warnings (user_id, chat_id, warn_count) VALUES ($1, $2, $3)
+                    ON CONFLICT (user_id, chat_id) DO UPDATE SET warn_count = EXCLUDED.warn_count
+                ''', upserts)
+            if deletes:
+                await conn.executemany('DELETE FROM warnings WHERE user_id = $1 AND chat_id = $2', deletes)
+        logger.info(f"Збережено лічильники попереджень: оновлено {len(upserts)}, видалено {len(deletes)}")
+        return len(members)
+    except Exception as e:
+        redis_client.sadd(WARNINGS_DIRTY_KEY, *members)
+        logger.error(f"Помилка збереження лічильників попереджень, повторимо пізніше: {e}")
         return 0
     finally:
         if 'conn' in locals():
             await conn.close()
 
-# Додавання бана
-async def add_ban(user_id: int, chat_id: int, reason: str):
+# Засів після втрати даних Redis: значення з таблиці додаються (HINCRBY) до того, що Redis
+# устиг нарахувати після втрати, тому попередження, видані в цей проміжок, не губляться.
+# Позначка засіву ставиться в тому ж скрипті, тож засів виконується рівно один раз.
+SEED_WARNINGS_SCRIPT = redis_client.register_script('''
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        return 0
+    end
+    for i = 2, #KEYS do
+        redis.call('HINCRBY', KEYS[i], ARGV[2 * i - 3], ARGV[2 * i - 2])
+    end
+    redis.call('SET', KEYS[1], 1)
+    return 1
+''')
+
+# Звірка Redis і Postgres: якщо Redis втратив дані, лічильники засіваються з таблиці (див. вище),
+# після чого всі розбіжності позначаються як змінені й перезаписуються значеннями з Redis
+async def reconcile_warnings():
     try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        conn = await asyncpg.connect(
-            host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
-        )
-        await conn.execute(
-            'INSERT INTO bans (user_id, chat_id, reason) VALUES ($1, $2, $3) ON CONFLICT (user_id, chat_id) DO UPDATE SET reason = $3',
-            user_id, chat_id, reason
-        )
-        logger.info(f"Додано бан: user_id={user_id}, chat_id={chat_id}, reason={reason}")
+        conn = await db_connect()
+        rows = await conn.fetch('SELECT user_id, chat_id, warn_count FROM warnings')
+        db_counts = {(row['chat_id'], row['user_id']): row['warn_count'] for row in rows}
+        if not redis_client.exists(WARNINGS_SEEDED_KEY):
+            # Прирости без Redis уже враховані в таблиці, з якої йде засів
+            pending_warning_deltas.clear()
+            keys, args = [WARNINGS_SEEDED_KEY], []
+            for (chat_id, user_id), count in db_counts.items():
+                keys.append(warnings_key(chat_id))
+                args += [user_id, count]
+            if SEED_WARNINGS_SCRIPT(keys=keys, args=args):
+                logger.info(f"Лічильники попереджень засіяно з таблиці: {len(db_counts)}")
+        redis_counts = {}
+        for key in redis_client.scan_iter(match='warnings:*'):
+            chat_id = int(key.split(':', 1)[1])
+            for user_id, count in redis_client.hgetall(key).items():
+                redis_counts[(chat_id, int(user_id))] = int(count)
+        mismatched = [f"{chat_id}:{user_id}" for chat_id, user_id in db_counts.keys() | redis_counts.keys()
+                      if db_counts.get((chat_id, user_id)) != redis_counts.get((chat_id, user_id))]
+        if mismatched:
+            redis_client.sadd(WARNINGS_DIRTY_KEY, *mismatched)
+            logger.warning(f"Звірка попереджень: {len(mismatched)} розбіжностей буде перезаписано")
     except Exception as e:
-        logger.error(f"Помилка додавання бана: {e}")
+        logger.error(f"Помилка звірки лічильників попереджень: {e}")
     finally:
         if 'conn' in locals():
             await conn.close()
 
+# Фонове дзеркалювання лічильників попереджень і періодична звірка
+async def warning_mirror():
+    last_reconcile = time.monotonic()
+    while True:
+        await asyncio.sleep(WARNINGS_FLUSH_INTERVAL)
+        try:
+            if not redis_client.exists(WARNINGS_SEEDED_KEY):
+                await reconcile_warnings()
+                last_reconcile = time.monotonic()
+            apply_pending_warning_deltas()
+        except redis.RedisError as e:
+            logger.error(f"Redis недоступний для дзеркалювання попереджень: {e}")
+            continue
+        while await flush_warning_counts() >= WARNINGS_FLUSH_BATCH:
+            pass
+        if time.monotonic() - last_reconcile >= WARNINGS_RECONCILE_INTERVAL:
+            await reconcile_warnings()
+            last_reconcile = time.monotonic()
+
+# Додавання бана
+@spoolable_write('add_ban')
+async def add_ban_op(conn, at: datetime.datetime, user_id: int, chat_id: int, reason: str):
+    await conn.execute(
+        'INSERT INTO bans (user_id, chat_id, reason) VALUES ($1, $2, $3) ON CONFLICT (user_id, chat_id) DO UPDATE SET reason = $3',
+        user_id, chat_id, reason
+    )
+    logger.info(f"Додано бан: user_id={user_id}, chat_id={chat_id}, reason={reason}")
+
+async def add_ban(user_id: int, chat_id: int, reason: str):
+    await execute_write('add_ban', user_id, chat_id, reason, sticky_key=chat_id)
+
 # Зняття бана
+@spoolable_write('remove_ban')
+async def remove_ban_op(conn, at: datetime.datetime, user_id: int, chat_id: int):
+    await conn.execute('DELETE FROM bans WHERE user_id = $1 AND chat_id = $2', user_id, chat_id)
+    logger.info(f"Знято бан: user_id={user_id}, chat_id={chat_id}")
+
 async def remove_ban(user_id: int, chat_id: int):
+    await execute_write('remove_ban', user_id, chat_id, sticky_key=chat_id)
+
+# Реєстр обмежень: таблиця restrictions + дзеркало в Redis ZSET mutes:expiry
+# (учасник "chat_id:user_id", score — unix-час закінчення)
+MUTES_EXPIRY_KEY = 'mutes:expiry'
+
+def restriction_member(user_id: int, chat_id: int) -> str:
+    return f"{chat_id}:{user_id}"
+
+RECORD_RESTRICTION_SQL = '''
+    INSERT INTO restrictions (user_id, chat_id, restriction_type, reason, moderator_id, created_at, expires_at)
+    VALUES ($1, $2, $3, $4, $5, $6, $6 + make_interval(mins => $7))
+    ON CONFLICT (user_id, chat_id) DO UPDATE SET
+        restriction_type = EXCLUDED.restriction_type,
+        reason = EXCLUDED.reason,
+        moderator_id = EXCLUDED.moderator_id,
+        created_at = EXCLUDED.created_at,
+        expires_at = EXCLUDED.expires_at
+'''
+
+@spoolable_write('record_restriction')
+async def record_restriction_op(conn, at: datetime.datetime, user_id: int, chat_id: int, restriction_type: str,
+                                reason: str, moderator_id: int | None, duration_minutes: int):
+    await conn.execute(RECORD_RESTRICTION_SQL, user_id, chat_id, restriction_type, reason, moderator_id, at, duration_minutes)
+    logger.info(f"Записано обмеження: user_id={user_id}, chat_id={chat_id}, type={restriction_type}, duration={duration_minutes}")
+
+# Запис активного обмеження (мута) в реєстр
+async def record_restriction(user_id: int, chat_id: int, reason: str, duration_minutes: int,
+                             moderator_id: int | None = None, restriction_type: str = 'mute'):
     try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        conn = await asyncpg.connect(
-            host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
-        )
-        await conn.execute('DELETE FROM bans WHERE user_id = $1 AND chat_id = $2', user_id, chat_id)
-        logger.info(f"Знято бан: user_id={user_id}, chat_id={chat_id}")
-    except Exception as e:
-        logger.error(f"Помилка зняття бана: {e}")
-    finally:
-        if 'conn' in locals():
-            await conn.close()
+        redis_client.zadd(MUTES_EXPIRY_KEY, {restriction_member(user_id, chat_id): time.time() + duration_minutes * 60})
+    except redis.RedisError as e:
+        logger.error(f"Помилка запису обмеження в Redis: {e}")
+    await execute_write('record_restriction', user_id, chat_id, restriction_type, reason, moderator_id,
+                        duration_minutes, sticky_key=chat_id)
+
+# Зняття мута: видалення з реєстру обмежень
+@spoolable_write('remove_mute')
+async def remove_mute_op(conn, at: datetime.datetime, user_id: int, chat_id: int):
+    await conn.execute('DELETE FROM restrictions WHERE user_id = $1 AND chat_id = $2', user_id, chat_id)
+    logger.info(f"Знято мут: user_id={user_id}, chat_id={chat_id}")
 
 async def remove_mute(user_id: int, chat_id: int):
     try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        conn = await asyncpg.connect(
-            host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
-        )
-        await conn.execute(
-            "DELETE FROM punishments WHERE user_id = $1 AND chat_id = $2 AND punishment_type = 'mute'",
-            user_id, chat_id
-        )
-        logger.info(f"Знято мут: user_id={user_id}, chat_id={chat_id}")
+        redis_client.zrem(MUTES_EXPIRY_KEY, restriction_member(user_id, chat_id))
+    except redis.RedisError as e:
+        logger.error(f"Помилка видалення обмеження з Redis: {e}")
+    await execute_write('remove_mute', user_id, chat_id, sticky_key=chat_id)
+
+# Видалення обмеження, що закінчилося (не чіпає повторний мут, виданий пізніше)
+@spoolable_write('expire_restriction')
+async def expire_restriction_op(conn, at: datetime.datetime, user_id: int, chat_id: int):
+    await conn.execute(
+        'DELETE FROM restrictions WHERE user_id = $1 AND chat_id = $2 AND expires_at <= $3',
+        user_id, chat_id, at
+    )
+
+# Час закінчення активного обмеження (UTC) або None — без звернень до Telegram API
+def get_active_restriction(user_id: int, chat_id: int) -> datetime.datetime | None:
+    try:
+        expires_at = redis_client.zscore(MUTES_EXPIRY_KEY, restriction_member(user_id, chat_id))
+    except redis.RedisError as e:
+        logger.error(f"Помилка отримання обмеження з Redis: {e}")
+        return None
+    if expires_at is None or expires_at <= time.time():
+        return None
+    return datetime.datetime.utcfromtimestamp(expires_at)
+
+# Відновлення ZSET з таблиці restrictions (після втрати даних Redis або при старті)
+async def load_restrictions():
+    try:
+        conn = await db_connect(readonly=True)
+        rows = await conn.fetch('''
+            SELECT user_id, chat_id, EXTRACT(EPOCH FROM expires_at) AS expires_at
+            FROM restrictions WHERE expires_at IS NOT NULL
+        ''')
+        if rows:
+            redis_client.zadd(MUTES_EXPIRY_KEY, {
+                restriction_member(row['user_id'], row['chat_id']): float(row['expires_at']) for row in rows
+            }, nx=True)
+        logger.info(f"Завантажено {len(rows)} обмежень у Redis")
     except Exception as e:
-        logger.error(f"Помилка зняття мута: {e}")
+        logger.error(f"Помилка завантаження обмежень: {e}")
     finally:
         if 'conn' in locals():
             await conn.close()
 
 # Отримання кількості попереджень
-async def get_warning_count(user_id: int, chat_id: int) -> int:
+def get_warning_count(user_id: int, chat_id: int) -> int:
     try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        conn = await asyncpg.connect(
-            host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
-        )
-        result = await conn.fetchval(
-            'SELECT warn_count FROM warnings WHERE user_id = $1 AND chat_id = $2', user_id, chat_id
-        )
-        return result if result is not None else 0
-    except Exception as e:
+        return int(redis_client.hget(warnings_key(chat_id), user_id) or 0)
+    except redis.RedisError as e:
         logger.error(f"Помилка отримання попереджень: {e}")
         return 0
-    finally:
-        if 'conn' in locals():
-            await conn.close()
 
 # Логування покарань
+LOG_PUNISHMENT_SQL = '''
+        WITH logged AS (
+            INSERT INTO punishments (user_id, chat_id, punishment_type, reason, timestamp, duration_minutes, moderator_id)
+            VALUES ($1, $2, $3, $4, $7, $5, $6)
+            RETURNING user_id, chat_id, punishment_type, moderator_id, timestamp
+        ), totals AS (
+            INSERT INTO punishment_totals (user_id, chat_id, punishment_type, total)
+            SELECT user_id, chat_id, punishment_type, 1 FROM logged
+            ON CONFLICT (user_id, chat_id, punishment_type)
+            DO UPDATE SET total = punishment_totals.total + 1
+        ), stats AS (
+            INSERT INTO moderation_stats (chat_id, moderator_id, punishment_type, day, total)
+            SELECT chat_id, COALESCE(moderator_id, 0), punishment_type, timestamp::date, COUNT(*) FROM logged
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT (chat_id, moderator_id, punishment_type, day)
+            DO UPDATE SET total = moderation_stats.total + EXCLUDED.total
+        )
+        SELECT 0
+'''
+
+@spoolable_write('log_punishment')
+async def log_punishment_op(conn, at: datetime.datetime, user_id: int, chat_id: int, punishment_type: str, reason: str,
+                            duration_minutes: int | None = None, moderator_id: int | None = None):
+    await conn.execute(LOG_PUNISHMENT_SQL, user_id, chat_id, punishment_type, reason, duration_minutes, moderator_id, at)
+    logger.info(
+        f"Залоговано покарання: user_id={user_id}, chat_id={chat_id}, type={punishment_type}, reason={reason}, duration={duration_minutes}, moderator_id={moderator_id}")
+
 async def log_punishment(user_id: int, chat_id: int, punishment_type: str, reason: str,
                          duration_minutes: int | None = None, moderator_id: int | None = None):
-    try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        conn = await asyncpg.connect(
-            host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
+    await execute_write('log_punishment', user_id, chat_id, punishment_type, reason, duration_minutes, moderator_id,
+                        sticky_key=chat_id)
+
+# CTE-запити, які записують усю модераторську дію одним зверненням до бази:
+# рядок bans, записи в punishments, punishment_totals і moderation_stats (лічильник попереджень живе в Redis)
+MODERATION_ACTION_SQL = {
+    'ban': '''
+        WITH banned AS (
+            INSERT INTO bans (user_id, chat_id, reason) VALUES ($1, $2, $3)
+            ON CONFLICT (user_id, chat_id) DO UPDATE SET reason = EXCLUDED.reason
+        ), logged AS (
+            INSERT INTO punishments (user_id, chat_id, punishment_type, reason, timestamp, duration_minutes, moderator_id)
+            VALUES ($1, $2, 'ban', $3, $6, $5, $4)
+            RETURNING user_id, chat_id, punishment_type, moderator_id, timestamp
+        ), totals AS (
+            INSERT INTO punishment_totals (user_id, chat_id, punishment_type, total)
+            SELECT user_id, chat_id, punishment_type, 1 FROM logged
+            ON CONFLICT (user_id, chat_id, punishment_type)
+            DO UPDATE SET total = punishment_totals.total + 1
+        ), stats AS (
+            INSERT INTO moderation_stats (chat_id, moderator_id, punishment_type, day, total)
+            SELECT chat_id, COALESCE(moderator_id, 0), punishment_type, timestamp::date, COUNT(*) FROM logged
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT (chat_id, moderator_id, punishment_type, day)
+            DO UPDATE SET total = moderation_stats.total + EXCLUDED.total
         )
-        await conn.execute('''
+        SELECT 0
+    ''',
+    'warn': '''
+        WITH logged AS (
             INSERT INTO punishments (user_id, chat_id, punishment_type, reason, timestamp, duration_minutes, moderator_id)
-            VALUES ($1, $2, $3, $4, NOW(), $5, $6)
-        ''', user_id, chat_id, punishment_type, reason, duration_minutes, moderator_id)
-        logger.info(
-            f"Залоговано покарання: user_id={user_id}, chat_id={chat_id}, type={punishment_type}, reason={reason}, duration={duration_minutes}, moderator_id={moderator_id}")
-    except Exception as e:
-        logger.error(
-            f"Помилка логування покарання для user_id={user_id}, chat_id={chat_id}, type={punishment_type}: {e}")
-    finally:
-        if 'conn' in locals():
-            await conn.close()
+            SELECT $1::bigint, $2::bigint, 'warn', $3::text, $6::timestamp, $5::integer, $4::bigint
+            UNION ALL
+            SELECT $1::bigint, $2::bigint, 'kick', $8::text, $6::timestamp, NULL, $4::bigint
+            WHERE $7::boolean
+            RETURNING user_id, chat_id, punishment_type, moderator_id, timestamp
+        ), totals AS (
+            INSERT INTO punishment_totals (user_id, chat_id, punishment_type, total)
+            SELECT user_id, chat_id, punishment_type, COUNT(*) FROM logged
+            GROUP BY user_id, chat_id, punishment_type
+            ON CONFLICT (user_id, chat_id, punishment_type)
+            DO UPDATE SET total = punishment_totals.total + EXCLUDED.total
+        ), stats AS (
+            INSERT INTO moderation_stats (chat_id, moderator_id, punishment_type, day, total)
+            SELECT chat_id, COALESCE(moderator_id, 0), punishment_type, timestamp::date, COUNT(*) FROM logged
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT (chat_id, moderator_id, punishment_type, day)
+            DO UPDATE SET total = moderation_stats.total + EXCLUDED.total
+        )
+        SELECT 0
+    ''',
+}
+
+# Атомарний запис модераторської дії ('ban', 'warn', 'kick', 'mute') за один round trip.
+# Для 'warn' лічильник збільшується в Redis, а escalate=True одразу логує кік за MAX_WARNINGS попереджень.
+@spoolable_write('record_moderation_action')
+async def record_moderation_action_op(conn, at: datetime.datetime, action: str, user_id: int, chat_id: int, reason: str,
+                                      moderator_id: int | None = None, duration_minutes: int | None = None,
+                                      escalate: bool = False):
+    if action not in MODERATION_ACTION_SQL:
+        await log_punishment_op(conn, at, user_id, chat_id, action, reason, duration_minutes, moderator_id)
+        return
+    args = [user_id, chat_id, reason, moderator_id, duration_minutes, at]
+    if action == 'warn':
+        args += [escalate, f"{MAX_WARNINGS} попередження"]
+    await conn.execute(MODERATION_ACTION_SQL[action], *args)
+    logger.info(f"Записано дію {action}: user_id={user_id}, chat_id={chat_id}, reason={reason}, moderator_id={moderator_id}, escalate={escalate}")
+
+# Для 'warn' повертає новий лічильник попереджень, для інших дій 0
+async def record_moderation_action(action: str, user_id: int, chat_id: int, reason: str,
+                                   moderator_id: int | None = None, duration_minutes: int | None = None) -> int:
+    warn_count, escalate = 0, False
+    if action == 'warn':
+        warning = add_warning(user_id, chat_id)
+        warn_count, escalate = warning if warning is not None else await add_warning_in_db(user_id, chat_id)
+    await execute_write('record_moderation_action', action, user_id, chat_id, reason,
+                        moderator_id, duration_minutes, escalate, sticky_key=chat_id)
+    return warn_count
+
+# Пакетний запис масової дії: усі рядки bans / punishments / restrictions одним executemany на таблицю.
+# rows — список [user_id, chat_id, reason] для успішних викликів Telegram API.
+@spoolable_write('record_mass_action')
+async def record_mass_action_op(conn, at: datetime.datetime, action: str, rows: list,
+                                moderator_id: int | None, duration_minutes: int | None):
+    async with conn.transaction():
+        if action == 'ban':
+            await conn.executemany(MODERATION_ACTION_SQL['ban'], [
+                (user_id, chat_id, reason, moderator_id, None, at) for user_id, chat_id, reason in rows
+            ])
+        else:
+            await conn.executemany(LOG_PUNISHMENT_SQL, [
+                (user_id, chat_id, action, reason, duration_minutes, moderator_id, at) for user_id, chat_id, reason in rows
+            ])
+            await conn.executemany(RECORD_RESTRICTION_SQL, [
+                (user_id, chat_id, action, reason, moderator_id, at, duration_minutes) for user_id, chat_id, reason in rows
+            ])
+    logger.info(f"Записано масову дію {action}: {len(rows)} рядків, moderator_id={moderator_id}")
 
-# Отримання історії покарань
-async def get_punishments(user_id: int, chat_id: int) -> list:
+# Курсор сторінки історії покарань: "<мікросекунди від epoch>_<id>"
+PUNISHMENT_CURSOR_EPOCH = datetime.datetime(1970, 1, 1)
+
+def encode_punishment_cursor(timestamp: datetime.datetime, row_id: int) -> str:
+    return f"{(timestamp - PUNISHMENT_CURSOR_EPOCH) // datetime.timedelta(microseconds=1)}_{row_id}"
+
+def decode_punishment_cursor(cursor: str) -> tuple[datetime.datetime, int]:
+    micros, row_id = cursor.split('_')
+    return PUNISHMENT_CURSOR_EPOCH + datetime.timedelta(microseconds=int(micros)), int(row_id)
+
+# Отримання сторінки історії покарань (keyset-пагінація за (timestamp, id))
+# Повертає (записи, курсор наступної сторінки, курсор попередньої сторінки).
+# Межі за timestamp дозволяють планувальнику відсікати партиції поза гарячим вікном.
+async def get_punishments(user_id: int, chat_id: int, cursor: str | None = None, direction: str = 'next',
+                          limit: int = INFO_PAGE_SIZE) -> tuple[list, str | None, str | None]:
+    since = punishment_history_since()
     try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        conn = await asyncpg.connect(
-            host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
-        )
-        rows = await conn.fetch('''
-            SELECT punishment_type, reason, timestamp, duration_minutes, moderator_id
-            FROM punishments
-            WHERE user_id = $1 AND chat_id = $2
-            ORDER BY timestamp DESC
-        ''', user_id, chat_id)
-        logger.info(f"Отримано історію покарань для user_id={user_id}, chat_id={chat_id}: {len(rows)} записів")
-        return [
+        conn = await db_connect(readonly=True, sticky_key=chat_id)
+        if cursor is None:
+            rows = await conn.fetch('''
+                SELECT id, punishment_type, reason, timestamp, duration_minutes, moderator_id
+                FROM punishments
+                WHERE user_id = $1 AND chat_id = $2 AND timestamp >= $3
+                ORDER BY timestamp DESC, id DESC
+                LIMIT $4
+            ''', user_id, chat_id, since, limit + 1)
+        elif direction == 'next':
+            cursor_timestamp, cursor_id = decode_punishment_cursor(cursor)
+            rows = await conn.fetch('''
+                SELECT id, punishment_type, reason, timestamp, duration_minutes, moderator_id
+                FROM punishments
+                WHERE user_id = $1 AND chat_id = $2 AND (timestamp, id) < ($3, $4)
+                  AND timestamp <= $3 AND timestamp >= $5
+                ORDER BY timestamp DESC, id DESC
+                LIMIT $6
+            ''', user_id, chat_id, cursor_timestamp, cursor_id, since, limit + 1)
+        else:
+            cursor_timestamp, cursor_id = decode_punishment_cursor(cursor)
+            rows = await conn.fetch('''
+                SELECT id, punishment_type, reason, timestamp, duration_minutes, moderator_id
+                FROM punishments
+                WHERE user_id = $1 AND chat_id = $2 AND (timestamp, id) > ($3, $4)
+                  AND timestamp >= $3 AND timestamp >= $5
+                ORDER BY timestamp ASC, id ASC
+                LIMIT $6
+            ''', user_id, chat_id, cursor_timestamp, cursor_id, since, limit + 1)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if cursor is not None and direction == 'prev':
+            rows.reverse()
+            prev_cursor = encode_punishment_cursor(rows[0]['timestamp'], rows[0]['id']) if has_more else None
+            next_cursor = encode_punishment_cursor(rows[-1]['timestamp'], rows[-1]['id']) if rows else None
+        else:
+            next_cursor = encode_punishment_cursor(rows[-1]['timestamp'], rows[-1]['id']) if has_more else None
+            prev_cursor = encode_punishment_cursor(rows[0]['timestamp'], rows[0]['id']) if cursor and rows else None
+        logger.info(f"Отримано сторінку історії покарань для user_id={user_id}, chat_id={chat_id}: {len(rows)} записів")
+        punishments = [
             {
+                "id": row['id'],
                 "type": row['punishment_type'],
                 "reason": row['reason'],
                 "timestamp": row['timestamp'].strftime('%Y-%m-%d %H:%M') if row['timestamp'] is not None else "невідомо",
@@ -550,24 +1819,332 @@ async def get_punishments(user_id: int, chat_id: int) -> list:
                 "moderator_id": row['moderator_id']
             } for row in rows
         ]
+        return punishments, next_cursor, prev_cursor
     except Exception as e:
         logger.error(f"Помилка отримання історії покарань: {e}")
-        return []
+        return [], None, None
     finally:
         if 'conn' in locals():
             await conn.close()
 
+# Підсумок покарань за типами (з лічильників punishment_totals, без COUNT по журналу)
+async def get_punishment_totals(user_id: int, chat_id: int) -> dict[str, int]:
+    try:
+        conn = await db_connect(readonly=True, sticky_key=chat_id)
+        rows = await conn.fetch(
+            'SELECT punishment_type, total FROM punishment_totals WHERE user_id = $1 AND chat_id = $2 AND total > 0',
+            user_id, chat_id
+        )
+        return {row['punishment_type']: row['total'] for row in rows}
+    except Exception as e:
+        logger.error(f"Помилка отримання підсумку покарань: {e}")
+        return {}
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+# Перший день місяця, зсунутого на months від місяця дати
+def shift_month(day: datetime.date, months: int) -> datetime.date:
+    index = day.year * 12 + day.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+# Межа гарячого вікна історії (None, якщо зберігаємо все)
+def punishment_retention_cutoff() -> datetime.datetime | None:
+    if PUNISHMENTS_RETENTION_MONTHS <= 0:
+        return None
+    cutoff = shift_month(datetime.datetime.utcnow().date(), -PUNISHMENTS_RETENTION_MONTHS)
+    return datetime.datetime.combine(cutoff, datetime.time())
+
+# Створення партицій punishments на поточний і наступні місяці
+async def ensure_punishment_partitions():
+    try:
+        conn = await db_connect()
+        current_month = shift_month(datetime.datetime.utcnow().date(), 0)
+        for offset in range(PUNISHMENT_PARTITIONS_AHEAD + 1):
+            month_start = shift_month(current_month, offset)
+            partition = f"punishments_p{month_start:%Y%m}"
+            await conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {partition} PARTITION OF punishments "
+                f"FOR VALUES FROM ('{month_start}') TO ('{shift_month(month_start, 1)}')"
+            )
+        logger.info(f"Партиції punishments створено на {PUNISHMENT_PARTITIONS_AHEAD} місяців наперед")
+    except Exception as e:
+        logger.error(f"Помилка створення партицій punishments: {e}")
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+# Шлях до архіву партиції на локальному диску
+def punishment_archive_path(partition: str) -> str:
+    return os.path.join(PUNISHMENTS_ARCHIVE_DIR, f"{partition}.csv.gz")
+
+# Позначка партиції, повернутої з архіву: такі партиції не архівуються повторно
+RESTORED_PARTITION_COMMENT = 'restored from archive'
+
+# Повернуті з архіву партиції; джерело істини — коментар таблиці в базі,
+# набір оновлюється кожним проходом архівації (зокрема одразу після старту)
+restored_partitions: set[str] = set()
+
+# Нижня межа історії для /info: гаряче вікно, розширене до найстарішої повернутої партиції
+def punishment_history_since() -> datetime.datetime:
+    since = punishment_retention_cutoff() or PUNISHMENT_CURSOR_EPOCH
+    if restored_partitions:
+        oldest = datetime.datetime.strptime(min(restored_partitions)[-6:], '%Y%m')
+        since = min(since, oldest)
+    return since
+
+# Експорт старих партицій у стиснений CSV, потім від'єднання і видалення в одній транзакції.
+# Від'єднані таблиці punishments_p*, що залишилися від перерваних запусків, теж архівуються.
+async def archive_old_punishment_partitions():
+    global restored_partitions
+    cutoff = punishment_retention_cutoff()
+    if cutoff is None:
+        return
+    try:
+        conn = await db_connect()
+        rows = await conn.fetch('''
+            SELECT c.relname, i.inhrelid IS NOT NULL AS attached,
+                   obj_description(c.oid, 'pg_class') = $1 AS restored
+            FROM pg_class c
+            LEFT JOIN pg_inherits i ON i.inhrelid = c.oid AND i.inhparent = 'punishments'::regclass
+            WHERE c.relkind = 'r' AND c.relname ~ '^punishments_p[0-9]{6}$'
+        ''', RESTORED_PARTITION_COMMENT)
+        restored_partitions = {row['relname'] for row in rows if row['attached'] and row['restored']}
+        os.makedirs(PUNISHMENTS_ARCHIVE_DIR, exist_ok=True)
+        for row in sorted(rows, key=lambda r: r['relname']):
+            partition = row['relname']
+            month_start = datetime.datetime.strptime(partition[-6:], '%Y%m')
+            if row['attached'] and (shift_month(month_start.date(), 1) > cutoff.date() or row['restored']):
+                continue
+            path = punishment_archive_path(partition)
+            tmp_path = path + '.tmp'
+            with gzip.open(tmp_path, 'wb') as archive:
+                async def write_chunk(chunk: bytes):
+                    archive.write(chunk)
+                await conn.copy_from_table(partition, output=write_chunk, format='csv')
+            with open(tmp_path, 'rb') as archive:
+                os.fsync(archive.fileno())
+            os.replace(tmp_path, path)
+            async with conn.transaction():
+                if row['attached']:
+                    await conn.execute(f'ALTER TABLE punishments DETACH PARTITION {partition}')
+                await conn.execute(f'DROP TABLE {partition}')
+            logger.info(f"Партицію {partition} заархівовано в {path}")
+    except Exception as e:
+        logger.error(f"Помилка архівації партицій punishments: {e}")
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+# Повернення заархівованої партиції (month у форматі YYYY-MM)
+async def restore_punishment_partition(month: str) -> bool:
+    month_start = datetime.datetime.strptime(month, '%Y-%m').date()
+    partition = f"punishments_p{month_start:%Y%m}"
+    path = punishment_archive_path(partition)
+    if not os.path.exists(path):
+        logger.warning(f"Архів {path} не знайдено")
+        return False
+    try:
+        conn = await db_connect()
+        async with conn.transaction():
+            await conn.execute(f'CREATE TABLE {partition} (LIKE punishments INCLUDING DEFAULTS)')
+            with gzip.open(path, 'rb') as archive:
+                await conn.copy_to_table(partition, source=archive, format='csv')
+            await conn.execute(
+                f"ALTER TABLE punishments ATTACH PARTITION {partition} "
+                f"FOR VALUES FROM ('{month_start}') TO ('{shift_month(month_start, 1)}')"
+            )
+            await conn.execute(f"COMMENT ON TABLE {partition} IS '{RESTORED_PARTITION_COMMENT}'")
+        restored_partitions.add(partition)
+        logger.info(f"Партицію {partition} відновлено з архіву {path}")
+        return True
+    except Exception as e:
+        logger.error(f"Помилка відновлення партиції {partition}: {e}")
+        return False
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+# Лічильники повідомлень у пам'яті: (chat_id, день) -> кількість; періодично додаються до chat_message_stats
+chat_message_counts: dict[tuple[int, datetime.date], int] = {}
+
+def count_chat_message(chat_id: int):
+    key = (chat_id, datetime.datetime.utcnow().date())
+    chat_message_counts[key] = chat_message_counts.get(key, 0) + 1
+
+# Збереження накопичених лічильників повідомлень (додаванням, тому безпечно для кількох воркерів)
+async def flush_message_stats():
+    global chat_message_counts
+    if not chat_message_counts:
+        return
+    counts, chat_message_counts = chat_message_counts, {}
+    try:
+        conn = await db_connect()
+        await conn.executemany('''
+            INSERT INTO chat_message_stats (chat_id, day, messages) VALUES ($1, $2, $3)
+            ON CONFLICT (chat_id, day) DO UPDATE SET messages = chat_message_stats.messages + EXCLUDED.messages
+        ''', [(chat_id, day, count) for (chat_id, day), count in counts.items()])
+    except Exception as e:
+        for key, count in counts.items():
+            chat_message_counts[key] = chat_message_counts.get(key, 0) + count
+        logger.error(f"Помилка збереження лічильників повідомлень: {e}")
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+# Компактизація статистики: денні рядки старші за STATS_DAILY_RETENTION_DAYS згортаються в місячні
+# (день = перше число місяця)
+async def compact_moderation_stats():
+    cutoff = datetime.datetime.utcnow().date() - datetime.timedelta(days=STATS_DAILY_RETENTION_DAYS)
+    try:
+        conn = await db_connect()
+        async with conn.transaction():
+            await conn.execute('''
+                WITH old AS (
+                    DELETE FROM moderation_stats
+                    WHERE day < $1 AND day <> date_trunc('month', day)::date
+                    RETURNING chat_id, moderator_id, punishment_type, day, total
+                )
+                INSERT INTO moderation_stats (chat_id, moderator_id, punishment_type, day, total)
+                SELECT chat_id, moderator_id, punishment_type, date_trunc('month', day)::date, SUM(total)
+                FROM old GROUP BY 1, 2, 3, 4
+                ON CONFLICT (chat_id, moderator_id, punishment_type, day)
+                DO UPDATE SET total = moderation_stats.total + EXCLUDED.total
+            ''', cutoff)
+            await conn.execute('''
+                WITH old AS (
+                    DELETE FROM chat_message_stats
+                    WHERE day < $1 AND day <> date_trunc('month', day)::date
+                    RETURNING chat_id, day, messages
+                )
+                INSERT INTO chat_message_stats (chat_id, day, messages)
+                SELECT chat_id, date_trunc('month', day)::date, SUM(messages)
+                FROM old GROUP BY 1, 2
+                ON CONFLICT (chat_id, day)
+                DO UPDATE SET messages = chat_message_stats.messages + EXCLUDED.messages
+            ''', cutoff)
+        logger.info(f"Статистику модерації до {cutoff} згорнуто по місяцях")
+    except Exception as e:
+        logger.error(f"Помилка компактизації статистики: {e}")
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+# Фонове збереження лічильників повідомлень і щоденна компактизація статистики
+async def stats_maintainer():
+    last_compaction = float('-inf')
+    while True:
+        await asyncio.sleep(STATS_FLUSH_INTERVAL)
+        await flush_message_stats()
+        await flush_rule_hits()
+        if time.monotonic() - last_compaction >= 24 * 60 * 60:
+            await compact_moderation_stats()
+            last_compaction = time.monotonic()
+
+# Статистика чату за останні days днів — тільки зі зведених таблиць, без агрегацій по punishments
+async def get_chat_stats(chat_id: int, days: int) -> dict | None:
+    try:
+        since = datetime.datetime.utcnow().date() - datetime.timedelta(days=days - 1)
+        conn = await db_connect(readonly=True, sticky_key=chat_id)
+        top_moderators = await conn.fetch('''
+            SELECT moderator_id, SUM(total) AS total FROM moderation_stats
+            WHERE chat_id = $1 AND day >= $2 AND moderator_id <> 0
+            GROUP BY moderator_id ORDER BY total DESC LIMIT 5
+        ''', chat_id, since)
+        top_users = await conn.fetch('''
+            SELECT user_id, SUM(total) AS total FROM punishment_totals
+            WHERE chat_id = $1
+            GROUP BY user_id ORDER BY total DESC LIMIT 5
+        ''', chat_id)
+        filter_hits = await conn.fetchval(
+            'SELECT COALESCE(SUM(total), 0) FROM moderation_stats WHERE chat_id = $1 AND day >= $2 AND moderator_id = 0',
+            chat_id, since
+        )
+        messages = await conn.fetchval(
+            'SELECT COALESCE(SUM(messages), 0) FROM chat_message_stats WHERE chat_id = $1 AND day >= $2',
+            chat_id, since
+        )
+        messages += sum(count for (count_chat_id, day), count in chat_message_counts.items()
+                        if count_chat_id == chat_id and day >= since)
+        return {
+            'top_moderators': [(row['moderator_id'], row['total']) for row in top_moderators],
+            'top_users': [(row['user_id'], row['total']) for row in top_users],
+            'filter_hits': filter_hits,
+            'messages': messages,
+        }
+    except Exception as e:
+        logger.error(f"Помилка отримання статистики для chat_id={chat_id}: {e}")
+        return None
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+# Запит для експорту історії покарань з необов'язковими фільтрами (until — виключна межа)
+def build_punishment_export_query(chat_id: int | None = None, moderator_id: int | None = None,
+                                  since: datetime.datetime | None = None,
+                                  until: datetime.datetime | None = None) -> tuple[str, list]:
+    conditions, args = [], []
+    for column, operator, value in (('chat_id', '=', chat_id), ('moderator_id', '=', moderator_id),
+                                    ('timestamp', '>=', since), ('timestamp', '<', until)):
+        if value is not None:
+            args.append(value)
+            conditions.append(f"{column} {operator} ${len(args)}")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    query = f'''
+        SELECT id, user_id, chat_id, punishment_type, reason, timestamp, duration_minutes, moderator_id
+        FROM punishments {where}
+        ORDER BY timestamp, id
+    '''
+    return query, args
+
+# Потоковий експорт історії покарань через COPY у стиснений CSV або JSONL.
+# Рядки не проходять через Python-об'єкти: COPY віддає готові байти частинами прямо в gzip.
+async def export_punishments(fmt: str = 'csv', chat_id: int | None = None, moderator_id: int | None = None,
+                             since: datetime.datetime | None = None, until: datetime.datetime | None = None,
+                             output_path: str | None = None) -> tuple[str, int] | None:
+    query, args = build_punishment_export_query(chat_id, moderator_id, since, until)
+    if fmt == 'jsonl':
+        # JSON не містить сирих \x01/\x02, тому CSV з такими лапками й роздільником віддає рядки без змін
+        query = f"SELECT row_to_json(export)::text FROM ({query}) export"
+        copy_options = {'format': 'csv', 'quote': '\x01', 'delimiter': '\x02'}
+    else:
+        copy_options = {'format': 'csv', 'header': True}
+    if output_path is None:
+        scope = chat_id if chat_id is not None else 'all'
+        stamp = datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+        output_path = os.path.join(PUNISHMENTS_EXPORT_DIR, f"punishments_{scope}_{stamp}.{fmt}.gz")
+    tmp_path = output_path + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        conn = await db_connect(readonly=True)
+        with gzip.open(tmp_path, 'wb', compresslevel=6) as export_file:
+            async def write_chunk(chunk: bytes):
+                export_file.write(chunk)
+            status = await conn.copy_from_query(query, *args, output=write_chunk, **copy_options)
+        os.replace(tmp_path, output_path)
+        rows = int(status.split()[-1])
+        logger.info(f"Експортовано {rows} покарань у {output_path}")
+        return output_path, rows
+    except Exception as e:
+        logger.error(f"Помилка експорту покарань: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+# Щоденне обслуговування партицій: нові місяці наперед і архівація старих
+async def punishment_partition_maintainer():
+    while True:
+        await ensure_punishment_partitions()
+        await archive_old_punishment_partitions()
+        await asyncio.sleep(24 * 60 * 60)
+
 # Отримання статусу фільтра
 async def get_filter_status(chat_id: int) -> bool:
     try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        conn = await asyncpg.connect(
-            host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
-        )
+        conn = await db_connect(readonly=True, sticky_key=chat_id)
         result = await conn.fetchval('SELECT filter_enabled FROM chat_settings WHERE chat_id = $1', chat_id)
         return result if result is not None else True
     except Exception as e:
@@ -580,18 +2157,12 @@ async def get_filter_status(chat_id: int) -> bool:
 # Встановлення статусу фільтра
 async def set_filter_status(chat_id: int, enabled: bool):
     try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        conn = await asyncpg.connect(
-            host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
-        )
+        conn = await db_connect()
         await conn.execute(
             'INSERT INTO chat_settings (chat_id, filter_enabled) VALUES ($1, $2) ON CONFLICT (chat_id) DO UPDATE SET filter_enabled = $2',
             chat_id, enabled
         )
+        mark_recent_write(chat_id)
         logger.info(f"Оновлено статус фільтра для chat_id={chat_id}: {enabled}")
     except Exception as e:
         logger.error(f"Помилка збереження статусу фільтра для chat_id={chat_id}: {e}")
@@ -600,7 +2171,7 @@ async def set_filter_status(chat_id: int, enabled: bool):
             await conn.close()
 
 # Зчитування заборонених слів із файлу
-def load_forbidden_words(file_path='forbidden_words.txt'):
+def load_forbidden_words(file_path=FORBIDDEN_WORDS_PATH):
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
             return {word.strip().lower() for word in f.readlines() if word.strip()}
@@ -611,12 +2182,712 @@ def load_forbidden_words(file_path='forbidden_words.txt'):
         logger.error(f"Помилка зчитування заборонених слів: {e}")
         return set()
 
+# Регулярний вираз із префіксного дерева слів: спільні префікси перевіряються один раз,
+# тому пошук не сповільнюється лінійно зі збільшенням списку
+def build_trie_pattern(words) -> str:
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def render(node: dict) -> str:
+        alternatives = [re.escape(char) + render(child) for char, child in sorted(node.items()) if char]
+        if not alternatives:
+            return ''
+        body = alternatives[0] if len(alternatives) == 1 else '(?:' + '|'.join(alternatives) + ')'
+        if '' in node:
+            return '(?:' + body + ')?'
+        return body
+
+    return render(trie)
+
+# Скелет тексту будується по словах (частинах між пробілами) окремо для кожної писемності:
+# чисто латинське слово лишається латинським, чисто кириличне — кириличним, і лише в змішаному слові
+# ("пiдор", "p1dor", "eблaн") візуальні двійники й leet-символи зводяться до писемності більшості літер.
+# Тому латинські записи списку ("pido") не збігаються з українськими словами ("підозра").
+LATIN_TO_CYRILLIC = str.maketrans({
+    'a': 'а', 'b': 'в', 'c': 'с', 'e': 'е', 'h': 'н', 'i': 'і', 'k': 'к', 'm': 'м', 'n': 'п', 'o': 'о',
+    'p': 'р', 'r': 'г', 't': 'т', 'u': 'и', 'x': 'х', 'y': 'у',
+    '0': 'о', '1': 'і', '3': 'з', '4': 'ч', '6': 'б', '8': 'в', '@': 'а', '$': 'с', '|': 'л',
+})
+CYRILLIC_TO_LATIN = str.maketrans({
+    'а': 'a', 'в': 'b', 'с': 'c', 'е': 'e', 'н': 'h', 'і': 'i', 'к': 'k', 'м': 'm', 'о': 'o', 'р': 'p',
+    'т': 't', 'х': 'x', 'у': 'y', 'ї': 'i',
+    '0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't', '@': 'a', '$': 's', '|': 'l',
+})
+# Варіанти кириличних літер, щоб російські й українські написання мали спільний скелет
+CYRILLIC_VARIANTS = str.maketrans({
+    'і': 'и', 'ї': 'и', 'й': 'и', 'ы': 'и', 'ё': 'е', 'є': 'е', 'э': 'е', 'ґ': 'г', 'ъ': 'ь',
+})
+LEET_SYMBOLS = frozenset('@$|')
+# Мінімальна довжина серії однолітерних слів, яка вважається розставленим словом ("п е д и к");
+# коротші серії — звичайні прийменники й сполучники ("я і ти")
+SPACED_LETTERS_MIN_RUN = 3
+
+def is_cyrillic(char: str) -> bool:
+    return '\u0400' <= char <= '\u04ff'
+
+# Нормалізований текст і відображення кожного його символу на позицію в оригіналі
+@dataclass
+class NormalizedText:
+    text: str
+    offsets: list
+    source: str
+
+    def original_fragment(self, start: int, end: int) -> str:
+        return self.source[self.offsets[start]:self.offsets[end - 1] + 1]
+
+# Скелет одного слова: (символи, позиції в оригіналі). Роздільники всередині слова ("п.е.д.и.к")
+# відкидаються, повтори стискаються ("пиииидор").
+def normalize_token(source: str, start: int, end: int) -> tuple[list, list]:
+    chars, offsets = [], []
+    cyrillic = latin = symbols = 0
+    for index in range(start, end):
+        char = source[index]
+        if char.isalpha():
+            char = char.lower()[0]
+            if is_cyrillic(char):
+                cyrillic += 1
+            elif 'a' <= char <= 'z':
+                latin += 1
+        elif char.isdigit() or char in LEET_SYMBOLS:
+            symbols += 1
+        else:
+            continue
+        chars.append(char)
+        offsets.append(index)
+    # Цифри й символи вважаються leet-підміною, лише коли літер у слові більше ("п1дор", але не "2024р")
+    if cyrillic and latin or 0 < symbols < cyrillic + latin:
+        table = LATIN_TO_CYRILLIC if cyrillic >= latin else CYRILLIC_TO_LATIN
+        chars = [char.translate(table) for char in chars]
+    if cyrillic >= latin:
+        chars = [char.translate(CYRILLIC_VARIANTS) for char in chars]
+    result, result_offsets = [], []
+    for char, offset in zip(chars, offsets):
+        if not char.isalnum() and char not in LEET_SYMBOLS:
+            continue
+        if result and result[-1] == char:
+            continue
+        result.append(char)
+        result_offsets.append(offset)
+    return result, result_offsets
+
+# Нормалізація за один прохід по словах; серії з SPACED_LETTERS_MIN_RUN і більше однолітерних слів
+# склеюються в одне слово
+def normalize_text(source: str) -> NormalizedText:
+    tokens = []
+    for match in re.finditer(r'\S+', source):
+        chars, offsets = normalize_token(source, match.start(), match.end())
+        if chars:
+            tokens.append((chars, offsets, match.end()))
+    merged = []
+    index = 0
+    while index < len(tokens):
+        run_end = index
+        while run_end < len(tokens) and len(tokens[run_end][0]) == 1:
+            run_end += 1
+        if run_end - index >= SPACED_LETTERS_MIN_RUN:
+            chars = [token[0][0] for token in tokens[index:run_end]]
+            offsets = [token[1][0] for token in tokens[index:run_end]]
+            merged.append((chars, offsets, tokens[run_end - 1][2]))
+            index = run_end
+        else:
+            merged.append(tokens[index])
+            index += 1
+    chars, offsets = [], []
+    previous_end = 0
+    for token_chars, token_offsets, token_end in merged:
+        if chars:
+            chars.append(' ')
+            offsets.append(previous_end)
+        chars += token_chars
+        offsets += token_offsets
+        previous_end = token_end
+    return NormalizedText(''.join(chars), offsets, source)
+
+WORD_AFFIX_PATTERN = re.compile(r'\\w[*+]')
+
+# Унікальні ключі matcher-ів для кешу вердиктів (id() об'єкта може повторитися після збирання сміття)
+matcher_keys = itertools.count(1)
+
+# Скомпільований незмінний набір заборонених слів; новий список — новий об'єкт з наступною версією.
+# Слова нормалізуються так само, як повідомлення, тому варіанти написання не потрібно додавати в список.
+class ForbiddenWordMatcher:
+    def __init__(self, words, version: int = 0):
+        self.words = frozenset(words)
+        self.version = version
+        self.cache_key = next(matcher_keys)
+        self.skeletons = {}
+        for word in self.words:
+            # Обгортки "\w*" у файлі означали "частина слова" — пошук і так шукає підрядки
+            skeleton = normalize_text(WORD_AFFIX_PATTERN.sub('', word)).text
+            if skeleton:
+                self.skeletons.setdefault(skeleton, word)
+        self.pattern = re.compile(build_trie_pattern(self.skeletons)) if self.skeletons else None
+
+    # Перше заборонене слово в нормалізованому тексті: (слово зі списку, початок, кінець) або None
+    def find(self, normalized: NormalizedText, position: int = 0) -> tuple[str, int, int] | None:
+        if self.pattern is None:
+            return None
+        match = self.pattern.search(normalized.text, position)
+        if match is None:
+            return None
+        return self.skeletons[match.group(0)], match.start(), match.end()
+
+# Поточний matcher; заміна — одне присвоєння, тому обробник, який уже взяв посилання, бачить цілісну версію
+forbidden_word_matcher = ForbiddenWordMatcher(load_forbidden_words(), version=1)
+forbidden_words_mtime = None
+
+def file_stamp(path: str):
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+# Перечитування і компіляція списку у фоновому потоці, потім атомарна заміна
+async def reload_forbidden_words() -> ForbiddenWordMatcher:
+    global forbidden_word_matcher, forbidden_words_mtime
+    stamp = file_stamp(FORBIDDEN_WORDS_PATH)
+    words = await asyncio.to_thread(load_forbidden_words)
+    matcher = await asyncio.to_thread(ForbiddenWordMatcher, words, forbidden_word_matcher.version + 1)
+    forbidden_word_matcher = matcher
+    forbidden_words_mtime = stamp
+    verdict_cache.clear()
+    logger.info(f"Список заборонених слів оновлено: {len(matcher.words)} слів, версія {matcher.version}")
+    return matcher
+
+# Фонове відстеження змін файлів заборонених слів і доменів (mtime polling)
+async def forbidden_words_watcher():
+    global forbidden_words_mtime, blocked_domains_mtime
+    forbidden_words_mtime = file_stamp(FORBIDDEN_WORDS_PATH)
+    blocked_domains_mtime = file_stamp(BLOCKED_DOMAINS_PATH)
+    while True:
+        await asyncio.sleep(FORBIDDEN_WORDS_POLL_INTERVAL)
+        if file_stamp(FORBIDDEN_WORDS_PATH) != forbidden_words_mtime:
+            try:
+                await reload_forbidden_words()
+            except Exception as e:
+                logger.error(f"Помилка оновлення списку заборонених слів: {e}")
+        if file_stamp(BLOCKED_DOMAINS_PATH) != blocked_domains_mtime:
+            try:
+                await reload_blocked_domains()
+            except Exception as e:
+                logger.error(f"Помилка оновлення списку доменів: {e}")
+
+# 128-бітний blake2b тексту для ключів кешів: колізії вбудованого hash() підставляли б чужий вердикт
+def text_digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+# Matcher чату: власні слова чату (mode='add') поверх спільного глобального matcher,
+# мінус глобальні слова, вимкнені для чату (mode='remove'). Глобальний список не копіюється.
+class ChatWordMatcher:
+    def __init__(self, base: ForbiddenWordMatcher, extra_words, excluded_words):
+        self.base = base
+        self.extra = ForbiddenWordMatcher(frozenset(extra_words) - base.words)
+        self.excluded = frozenset(excluded_words) & base.words
+        if self.extra.words or self.excluded:
+            # Версія набору слів чату стабільна між перебудовами matcher-а, тож вердикти не губляться
+            # після CHAT_WORDS_CACHE_TTL, а чати з однаковими змінами ділять записи кешу
+            overrides = '\n'.join(sorted(f"+{word}" for word in self.extra.words) + sorted(f"-{word}" for word in self.excluded))
+            self.cache_key = (base.cache_key, text_digest(overrides))
+        else:
+            self.cache_key = base.cache_key
+
+    def find(self, normalized: NormalizedText) -> tuple[str, int, int] | None:
+        match = self.extra.find(normalized)
+        if match is not None:
+            return match
+        position = 0
+        while True:
+            match = self.base.find(normalized, position)
+            if match is None or match[0] not in self.excluded:
+                return match
+            position = match[1] + 1
+
+# LRU-кеш matcher-ів чатів: chat_id -> ChatWordMatcher
+chat_word_matchers = TTLCache(CHAT_WORDS_CACHE_SIZE, CHAT_WORDS_CACHE_TTL)
+
+# Matcher для чату; перебудовується після зміни глобального списку або закінчення TTL
+async def get_chat_word_matcher(chat_id: int) -> ChatWordMatcher:
+    base = forbidden_word_matcher
+    matcher = chat_word_matchers.get(chat_id)
+    if matcher is not None and matcher.base is base:
+        return matcher
+    extra_words, excluded_words = [], []
+    try:
+        conn = await db_connect(readonly=True, sticky_key=chat_id)
+        rows = await conn.fetch('SELECT word, mode FROM chat_forbidden_words WHERE chat_id = $1', chat_id)
+        for row in rows:
+            (excluded_words if row['mode'] == 'remove' else extra_words).append(row['word'])
+    except Exception as e:
+        logger.error(f"Помилка завантаження заборонених слів для chat_id={chat_id}: {e}")
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+    matcher = ChatWordMatcher(base, extra_words, excluded_words)
+    chat_word_matchers.set(chat_id, matcher)
+    return matcher
+
+# Кеш вердиктів фільтра: (ключ matcher-а, blake2b нормалізованого тексту) -> (збіг або None,).
+# Однакові тексти під час спам-хвилі класифікуються без повторного сканування.
+verdict_cache = TTLCache(VERDICT_CACHE_SIZE, VERDICT_CACHE_TTL)
+
+def classify_text(matcher, normalized: NormalizedText) -> tuple[str, int, int] | None:
+    key = (matcher.cache_key, text_digest(normalized.text))
+    cached = verdict_cache.get(key)
+    if cached is not None:
+        return cached[0]
+    match = matcher.find(normalized)
+    verdict_cache.set(key, (match,))
+    return match
+
+# Додавання слова до списку чату; для вимкненого глобального слова знімає вимкнення
+async def add_chat_forbidden_word(chat_id: int, word: str, moderator_id: int) -> bool:
+    try:
+        conn = await db_connect()
+        if word in forbidden_word_matcher.words:
+            await conn.execute(
+                "DELETE FROM chat_forbidden_words WHERE chat_id = $1 AND word = $2 AND mode = 'remove'", chat_id, word
+            )
+        else:
+            await conn.execute('''
+                INSERT INTO chat_forbidden_words (chat_id, word, mode, added_by) VALUES ($1, $2, 'add', $3)
+                ON CONFLICT (chat_id, word) DO UPDATE SET mode = 'add', added_by = $3, added_at = NOW()
+            ''', chat_id, word, moderator_id)
+        mark_recent_write(chat_id)
+        chat_word_matchers.pop(chat_id)
+        logger.info(f"Додано заборонене слово для chat_id={chat_id}: {word}")
+        return True
+    except Exception as e:
+        logger.error(f"Помилка додавання забороненого слова для chat_id={chat_id}: {e}")
+        return False
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+# Видалення слова зі списку чату; глобальне слово вимикається тільки для цього чату
+async def remove_chat_forbidden_word(chat_id: int, word: str, moderator_id: int) -> bool:
+    try:
+        conn = await db_connect()
+        if word in forbidden_word_matcher.words:
+            await conn.execute('''
+                INSERT INTO chat_forbidden_words (chat_id, word, mode, added_by) VALUES ($1, $2, 'remove', $3)
+                ON CONFLICT (chat_id, word) DO UPDATE SET mode = 'remove', added_by = $3, added_at = NOW()
+            ''', chat_id, word, moderator_id)
+        else:
+            await conn.execute('DELETE FROM chat_forbidden_words WHERE chat_id = $1 AND word = $2', chat_id, word)
+        mark_recent_write(chat_id)
+        chat_word_matchers.pop(chat_id)
+        logger.info(f"Видалено заборонене слово для chat_id={chat_id}: {word}")
+        return True
+    except Exception as e:
+        logger.error(f"Помилка видалення забороненого слова для chat_id={chat_id}: {e}")
+        return False
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+# Префіксне дерево доменів за розвернутими мітками (com -> example -> www).
+# Правило "example.com" діє на домен і всі піддомени, "*.example.com" — лише на піддомени;
+# перемагає найглибше правило, тож "!shop.example.com" дозволяє піддомен заблокованого домену.
+# Пошук — O(кількість міток) незалежно від розміру списку.
+class DomainTrie:
+    def __init__(self, rules=()):
+        self.root = {}
+        self.size = 0
+        for rule, mode in rules:
+            self.add(rule, mode)
+
+    def add(self, rule: str, mode: str):
+        labels = rule.lower().strip().strip('.').split('.')
+        marker = ''
+        if labels[0] == '*':
+            marker = '*'
+            labels = labels[1:]
+        node = self.root
+        for label in reversed(labels):
+            node = node.setdefault(label, {})
+        node[marker] = mode
+        self.size += 1
+
+    # 'block', 'allow' або None, якщо жодне правило не підходить
+    def lookup(self, host: str) -> Optional[str]:
+        labels = host.lower().strip('.').split('.')
+        node = self.root
+        verdict = None
+        for depth, label in enumerate(reversed(labels)):
+            node = node.get(label)
+            if node is None:
+                break
+            if '' in node:
+                verdict = node['']
+            if '*' in node and depth < len(labels) - 1:
+                verdict = node['*']
+        return verdict
+
+# Запрошення в інші чати (t.me/+…, t.me/joinchat/…) перевіряються як окремий псевдодомен,
+# тому їх можна заблокувати правилом "+.t.me", не блокуючи решту посилань t.me
+TELEGRAM_LINK_HOSTS = {'t.me', 'telegram.me', 'telegram.dog'}
+TELEGRAM_INVITE_HOST = '+.t.me'
+
+# Рядок файлу: домен для блокування або "!домен" для винятку; "#" — коментар
+def parse_domain_rule(line: str) -> tuple[str, str] | None:
+    line = line.split('#', 1)[0].strip().lower()
+    if not line:
+        return None
+    if line.startswith('!'):
+        return line[1:].strip(), 'allow'
+    return line, 'block'
+
+def load_blocked_domains(file_path=BLOCKED_DOMAINS_PATH) -> list[tuple[str, str]]:
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return [rule for rule in map(parse_domain_rule, f) if rule is not None]
+    except FileNotFoundError:
+        logger.warning(f"Файл {file_path} не знайдено. Використовується порожній список доменів.")
+        return []
+    except Exception as e:
+        logger.error(f"Помилка зчитування списку доменів: {e}")
+        return []
+
+# Поточне дерево глобального списку; як і matcher слів, замінюється одним присвоєнням
+blocked_domains = DomainTrie(load_blocked_domains())
+blocked_domains_mtime = None
+
+async def reload_blocked_domains() -> DomainTrie:
+    global blocked_domains, blocked_domains_mtime
+    stamp = file_stamp(BLOCKED_DOMAINS_PATH)
+    rules = await asyncio.to_thread(load_blocked_domains)
+    blocked_domains = DomainTrie(rules)
+    blocked_domains_mtime = stamp
+    logger.info(f"Список доменів оновлено: {blocked_domains.size} правил")
+    return blocked_domains
+
+# Домени з посилань повідомлення. Telegram уже розібрав посилання в entities,
+# тому текст повторно не сканується: береться лише фрагмент 'url' або адреса 'text_link'.
+def extract_link_hosts(message: types.Message) -> list[str]:
+    text = message.text or message.caption or ''
+    hosts = []
+    for entity in (message.entities or message.caption_entities or []):
+        if entity.type == 'url':
+            url = entity.extract_from(text)
+        elif entity.type == 'text_link':
+            url = entity.url
+        else:
+            continue
+        try:
+            parts = urlsplit(url if '://' in url else f'http://{url}')
+            host = (parts.hostname or '').rstrip('.')
+        except ValueError:
+            continue
+        if not host:
+            continue
+        if host in TELEGRAM_LINK_HOSTS and (parts.path.startswith('/+') or parts.path.startswith('/joinchat/')):
+            host = TELEGRAM_INVITE_HOST
+        hosts.append(host)
+    return hosts
+
+# Фільтр доменів чату: спочатку правила чату, потім глобальний список
+class ChatDomainFilter:
+    def __init__(self, base: DomainTrie, rules):
+        self.base = base
+        self.chat = DomainTrie(rules)
+
+    def verdict(self, host: str) -> Optional[str]:
+        return self.chat.lookup(host) or self.base.lookup(host)
+
+    # Перший заблокований домен серед посилань або None
+    def first_blocked(self, hosts) -> Optional[str]:
+        for host in hosts:
+            if self.verdict(host) == 'block':
+                return host
+        return None
+
+chat_domain_filters = TTLCache(CHAT_WORDS_CACHE_SIZE, CHAT_WORDS_CACHE_TTL)
+
+async def get_chat_domain_filter(chat_id: int) -> ChatDomainFilter:
+    base = blocked_domains
+    domain_filter = chat_domain_filters.get(chat_id)
+    if domain_filter is not None and domain_filter.base is base:
+        return domain_filter
+    rules = []
+    try:
+        conn = await db_connect(readonly=True, sticky_key=chat_id)
+        rows = await conn.fetch('SELECT domain, mode FROM chat_domain_rules WHERE chat_id = $1', chat_id)
+        rules = [(row['domain'], row['mode']) for row in rows]
+    except Exception as e:
+        logger.error(f"Помилка завантаження правил доменів для chat_id={chat_id}: {e}")
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+    domain_filter = ChatDomainFilter(base, rules)
+    chat_domain_filters.set(chat_id, domain_filter)
+    return domain_filter
+
+# Правило домену для чату; mode=None видаляє правило
+async def set_chat_domain_rule(chat_id: int, domain: str, mode: Optional[str], moderator_id: int) -> bool:
+    try:
+        conn = await db_connect()
+        if mode is None:
+            await conn.execute('DELETE FROM chat_domain_rules WHERE chat_id = $1 AND domain = $2', chat_id, domain)
+        else:
+            await conn.execute('''
+                INSERT INTO chat_domain_rules (chat_id, domain, mode, added_by) VALUES ($1, $2, $3, $4)
+                ON CONFLICT (chat_id, domain) DO UPDATE SET mode = $3, added_by = $4, added_at = NOW()
+            ''', chat_id, domain, mode, moderator_id)
+        mark_recent_write(chat_id)
+        chat_domain_filters.pop(chat_id)
+        logger.info(f"Оновлено правило домену для chat_id={chat_id}: {domain} -> {mode}")
+        return True
+    except Exception as e:
+        logger.error(f"Помилка оновлення правила домену для chat_id={chat_id}: {e}")
+        return False
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+# Regex-правило чату: дія 'delete', 'warn', 'mute' (з тривалістю) або 'ban'; більший priority важливіший
+@dataclass
+class ChatRule:
+    id: int
+    pattern: str
+    action: str
+    duration_minutes: Optional[int] = None
+    priority: int = 0
+    hits: int = 0
+
+CHAT_RULE_ACTIONS = ('delete', 'warn', 'mute', 'ban')
+RULE_GLOBAL_FLAGS = re.compile(r'^\(\?([aiLmsux]+)\)')
+RULE_BACKREFERENCE = re.compile(r'\\([1-9][0-9]?)(?![0-9])|\\.', re.DOTALL)
+RULE_REPEAT = re.compile(r'[*+]|\{\d*,?\d*\}')
+RULE_GROUP_OPENING = re.compile(r'\(\?(?:[aiLmsux-]*:|[=!]|<[=!])|\(')
+CHAT_RULES_LOCK_ID = 4170520263
+
+# Шаблон правила як частина спільної альтернації: глобальні прапорці стають локальними,
+# а номери зворотних посилань зсуваються на номер групи-обгортки правила
+def rule_alternative(rule: ChatRule, group_number: int) -> str:
+    pattern = rule.pattern
+    flags = RULE_GLOBAL_FLAGS.match(pattern)
+    if flags:
+        pattern = f"(?{flags.group(1)}:{pattern[flags.end():]})"
+
+    def shift(match: re.Match) -> str:
+        if match.group(1) is None:
+            return match.group(0)
+        return f"\\{int(match.group(1)) + group_number}"
+
+    return f"(?P<rule_{rule.id}>{RULE_BACKREFERENCE.sub(shift, pattern)})"
+
+# Шаблони, на яких модуль re перебирає варіанти експоненційно довго на тексті без збігу:
+# повторювана група з квантифікатором усередині, як (a+)+ чи (\w+\s?)*, або повторювана альтернація,
+# гілки якої можуть почати збіг з того самого символу, як (a|a)* чи (\w|\d)+
+def has_catastrophic_repeat(pattern: str) -> bool:
+    frames = [{'quantified': False, 'firsts': [], 'expect_first': True}]
+    index = 0
+    while index < len(pattern):
+        frame = frames[-1]
+        char = pattern[index]
+        first = None
+        if char == ')' and len(frames) > 1:
+            inner = frames.pop()
+            if inner['expect_first']:
+                inner['firsts'].append(None)
+            if RULE_REPEAT.match(pattern, index + 1):
+                firsts = inner['firsts']
+                if inner['quantified']:
+                    return True
+                if len(firsts) > 1 and (None in firsts or len(set(firsts)) < len(firsts)):
+                    return True
+            frames[-1]['quantified'] = frames[-1]['quantified'] or inner['quantified']
+            index += 1
+            continue
+        if char == '|':
+            if frame['expect_first']:
+                frame['firsts'].append(None)
+            frame['expect_first'] = True
+            index += 1
+            continue
+        repeat = RULE_REPEAT.match(pattern, index)
+        if repeat or char == '?':
+            frame['quantified'] = frame['quantified'] or repeat is not None
+            index = repeat.end() if repeat else index + 1
+            continue
+        if char == '(':
+            frames.append({'quantified': False, 'firsts': [], 'expect_first': True})
+            index = RULE_GROUP_OPENING.match(pattern, index).end()
+        elif char == '\\':
+            escaped = pattern[index + 1:index + 2]
+            if escaped and not escaped.isalnum():
+                first = escaped
+            index += 2
+        elif char == '[':
+            index += 1
+            if pattern.startswith('^', index):
+                index += 1
+            if pattern.startswith(']', index):
+                index += 1
+            while index < len(pattern) and pattern[index] != ']':
+                index += 2 if pattern[index] == '\\' else 1
+            index += 1
+        else:
+            if char not in '.^$':
+                first = char.casefold()
+            index += 1
+        if frame['expect_first']:
+            frame['firsts'].append(first)
+            frame['expect_first'] = False
+    return False
+
+# Перевірка шаблону перед збереженням; повертає текст помилки або None
+def validate_rule_pattern(pattern: str) -> str | None:
+    if len(pattern) > CHAT_RULE_MAX_PATTERN:
+        return f"Шаблон довший за {CHAT_RULE_MAX_PATTERN} символів."
+    if '(?P<' in pattern or '(?P=' in pattern:
+        return "Іменовані групи не підтримуються, використовуйте нумеровані."
+    if has_catastrophic_repeat(pattern):
+        return "Повторювані групи на кшталт (a+)+ чи (a|a)* не підтримуються: такий шаблон може зависнути."
+    try:
+        re.compile(rule_alternative(ChatRule(id=0, pattern=pattern, action='delete'), 1))
+    except re.error as e:
+        return f"Некоректний шаблон: {e}"
+    return None
+
+# Усі правила чату, скомпільовані в одну альтернацію з іменованими групами rule_<id>:
+# повідомлення сканується один раз незалежно від кількості правил.
+# Кожна альтернатива — lookahead нульової ширини, тож збіг менш пріоритетного правила не поглинає
+# текст і кожне правило пробується з кожної позиції; перемагає найпріоритетніше правило.
+class ChatRuleSet:
+    def __init__(self, rules):
+        self.rules = sorted(rules, key=lambda rule: (-rule.priority, rule.id))
+        self.rank = {f"rule_{rule.id}": index for index, rule in enumerate(self.rules)}
+        self.pattern = None
+        alternatives = []
+        group_number = 1
+        for rule in self.rules:
+            error = validate_rule_pattern(rule.pattern)
+            if error is not None:
+                logger.error(f"Пропущено правило {rule.id}: {error}")
+                continue
+            groups = re.compile(rule_alternative(rule, 1)).groups - 1
+            alternatives.append(f"(?={rule_alternative(rule, group_number)})")
+            group_number += 1 + groups
+        if alternatives:
+            self.pattern = re.compile('|'.join(alternatives))
+
+    # Найпріоритетніше правило, що спрацювало, і знайдений фрагмент
+    def match(self, text: str) -> tuple[ChatRule, str] | None:
+        if self.pattern is None or not text:
+            return None
+        best = None
+        for match in self.pattern.finditer(text[:CHAT_RULE_MAX_TEXT]):
+            rank = self.rank[match.lastgroup]
+            if best is None or rank < best[0]:
+                best = (rank, match.group(match.lastgroup))
+                if rank == 0:
+                    break
+        if best is None:
+            return None
+        return self.rules[best[0]], best[1]
+
+chat_rule_sets = TTLCache(CHAT_WORDS_CACHE_SIZE, CHAT_WORDS_CACHE_TTL)
+# Лічильники спрацювань правил між скиданнями в БД: rule_id -> кількість
+rule_hit_counts = {}
+
+async def load_chat_rules(chat_id: int) -> list[ChatRule]:
+    try:
+        conn = await db_connect(readonly=True, sticky_key=chat_id)
+        rows = await conn.fetch('''
+            SELECT id, pattern, action, duration_minutes, priority, hits
+            FROM chat_rules WHERE chat_id = $1
+        ''', chat_id)
+        return [ChatRule(**dict(row)) for row in rows]
+    except Exception as e:
+        logger.error(f"Помилка завантаження правил для chat_id={chat_id}: {e}")
+        return []
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+async def get_chat_rule_set(chat_id: int) -> ChatRuleSet:
+    rule_set = chat_rule_sets.get(chat_id)
+    if rule_set is None:
+        rule_set = ChatRuleSet(await load_chat_rules(chat_id))
+        chat_rule_sets.set(chat_id, rule_set)
+    return rule_set
+
+async def add_chat_rule(chat_id: int, pattern: str, action: str, duration_minutes: Optional[int],
+                        priority: int, moderator_id: int) -> int | None:
+    try:
+        conn = await db_connect()
+        # Паралельні /addrule серіалізуються lock-ом, тож ліміт не обходиться двома одночасними вставками
+        async with conn.transaction():
+            await conn.execute('SELECT pg_advisory_xact_lock($1)', CHAT_RULES_LOCK_ID)
+            rule_id = await conn.fetchval('''
+                INSERT INTO chat_rules (chat_id, pattern, action, duration_minutes, priority, added_by)
+                SELECT $1, $2, $3, $4, $5, $6
+                WHERE (SELECT COUNT(*) FROM chat_rules WHERE chat_id = $1) < $7
+                RETURNING id
+            ''', chat_id, pattern, action, duration_minutes, priority, moderator_id, CHAT_RULES_MAX)
+        mark_recent_write(chat_id)
+        chat_rule_sets.pop(chat_id)
+        logger.info(f"Додано правило {rule_id} для chat_id={chat_id}: {action} /{pattern}/")
+        return rule_id
+    except Exception as e:
+        logger.error(f"Помилка додавання правила для chat_id={chat_id}: {e}")
+        return None
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+async def remove_chat_rule(chat_id: int, rule_id: int) -> bool:
+    try:
+        conn = await db_connect()
+        result = await conn.execute('DELETE FROM chat_rules WHERE chat_id = $1 AND id = $2', chat_id, rule_id)
+        mark_recent_write(chat_id)
+        chat_rule_sets.pop(chat_id)
+        rule_hit_counts.pop(rule_id, None)
+        logger.info(f"Видалено правило {rule_id} для chat_id={chat_id}")
+        return result != 'DELETE 0'
+    except Exception as e:
+        logger.error(f"Помилка видалення правила {rule_id} для chat_id={chat_id}: {e}")
+        return False
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+# Скидання лічильників спрацювань одним UPDATE
+async def flush_rule_hits():
+    global rule_hit_counts
+    if not rule_hit_counts:
+        return
+    counts, rule_hit_counts = rule_hit_counts, {}
+    try:
+        conn = await db_connect()
+        await conn.execute('''
+            UPDATE chat_rules SET hits = chat_rules.hits + v.hits
+            FROM unnest($1::int[], $2::bigint[]) AS v(id, hits)
+            WHERE chat_rules.id = v.id
+        ''', list(counts.keys()), list(counts.values()))
+    except Exception as e:
+        for rule_id, count in counts.items():
+            rule_hit_counts[rule_id] = rule_hit_counts.get(rule_id, 0) + count
+        logger.error(f"Помилка збереження лічильників правил: {e}")
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+def describe_rule_action(rule: ChatRule) -> str:
+    if rule.action == 'mute':
+        return f"мут на {rule.duration_minutes or 60} хв"
+    return {'delete': "видалення", 'warn': "попередження", 'ban': "бан"}[rule.action]
+
 # Ініціалізація бота
 bot = Bot(token=API_TOKEN)
 dp = Dispatcher()
 
-# Список заборонених слів
-FORBIDDEN_WORDS = load_forbidden_words()
 WELCOME_MESSAGE = True
 
 # Функція для екранування спеціальних символів у MarkdownV2
@@ -644,21 +2915,88 @@ def add_task_to_queue(task: ModerationTask):
 def get_queue_length():
     return redis_client.llen('moderation_queue')
 
-# Функція для створення згадки користувача
+# Завантаження індексу username із telegramuser
+async def load_username_index():
+    try:
+        conn = await db_connect(readonly=True)
+        rows = await conn.fetch(
+            'SELECT user_id, username FROM telegramuser WHERE username IS NOT NULL ORDER BY last_seen NULLS FIRST'
+        )
+        for row in rows:
+            index_username(row['user_id'], row['username'])
+        logger.info(f"Завантажено індекс username: {len(username_index)} записів")
+    except Exception as e:
+        logger.error(f"Помилка завантаження індексу username: {e}")
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+# Пошук user_id за username у telegramuser (регістронезалежно)
+async def find_user_id_by_username(username: str) -> int | None:
+    try:
+        conn = await db_connect(readonly=True)
+        return await conn.fetchval(
+            'SELECT user_id FROM telegramuser WHERE lower(username) = lower($1) ORDER BY last_seen DESC NULLS LAST LIMIT 1',
+            username
+        )
+    except Exception as e:
+        logger.error(f"Помилка пошуку username {username} у telegramuser: {e}")
+        return None
+    finally:
+        if 'conn' in locals():
+            await conn.close()
+
+# Визначення user_id за username: індекс -> telegramuser -> Telethon (тільки при промаху)
+async def resolve_username(username: str) -> int | None:
+    key = username.lstrip('@').lower()
+    if key in username_index:
+        return username_index[key]
+    if key in username_negative_cache:
+        logger.info(f"Username {username} у негативному кеші")
+        return None
+    user_id = await find_user_id_by_username(key)
+    if user_id is not None:
+        index_username(user_id, key)
+        return user_id
+    if not telethon_client:
+        return None
+    try:
+        async with telethon_client:
+            user = await telethon_client.get_entity(key)
+        user_id = user.id
+        index_username(user_id, getattr(user, 'username', None) or key)
+        logger.info(f"Отримано user_id={user_id} для username={username} через Telethon")
+        return user_id
+    except ValueError:
+        username_negative_cache.set(key, True)
+        logger.info(f"Username {username} не знайдено, додано до негативного кешу")
+        return None
+    except FloodWaitError as e:
+        logger.warning(f"FloodWaitError при пошуку username {username}: {e.seconds} секунд")
+        return None
+
+# Форматування згадки користувача з профілю
+def format_user_mention(profile: UserProfile) -> str:
+    if profile.username:
+        escaped_username = escape_markdown_v2(profile.username).replace('_', '\\_')
+        return f"@{escaped_username}"
+    escaped_name = escape_markdown_v2(profile.first_name or f"User {profile.user_id}")
+    return f"[{escaped_name}]"
+
+# Функція для створення згадки користувача (спершу кеш і telegramuser, API — тільки при промаху)
 async def get_user_mention(user_id: int, chat_id: int) -> str | None:
+    profile = (await load_user_profiles([user_id])).get(user_id)
+    if profile is not None:
+        return format_user_mention(profile)
     try:
         chat_member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
         user = chat_member.user
-        if user.username:
-            escaped_username = escape_markdown_v2(user.username).replace('_', '\\_')
-            mention = f"@{escaped_username}"
-            logger.info(f"Створено згадку: {mention} для user_id={user_id}, username={user.username}")
-            return mention
-        else:
-            escaped_name = escape_markdown_v2(user.first_name or f"User {user_id}")
-            mention = f"[{escaped_name}]"
-            logger.info(f"Username відсутній, використовується ім'я: {mention} для user_id={user_id}")
-            return mention
+        profile = UserProfile(user_id=user.id, username=user.username,
+                              first_name=user.first_name, last_name=user.last_name)
+        user_profile_cache.set(user_id, profile)
+        mention = format_user_mention(profile)
+        logger.info(f"Створено згадку через API: {mention} для user_id={user_id}")
+        return mention
     except TelegramBadRequest as e:
         logger.warning(f"Помилка при отриманні користувача {user_id} у чаті {chat_id}: {e}")
         return f"ID\\:{user_id}"
@@ -748,6 +3086,23 @@ async def get_all_participants(chat_id: int) -> list:
         logger.error(f"Помилка при отриманні учасників для чату {chat_id}: {str(e)}")
     return members
 
+# Індексація username з кожного апдейту, який бачить бот
+@dp.update.outer_middleware()
+async def index_update_users(handler, event: types.Update, data: dict):
+    user = data.get('event_from_user')
+    if user is not None:
+        index_username(user.id, user.username)
+    message = event.message or event.edited_message
+    if message is not None:
+        for related in (getattr(message.reply_to_message, 'from_user', None), message.forward_from,
+                        *(message.new_chat_members or [])):
+            if related is not None:
+                index_username(related.id, related.username)
+    if event.chat_member is not None:
+        member_user = event.chat_member.new_chat_member.user
+        index_username(member_user.id, member_user.username)
+    return await handler(event, data)
+
 # Обробники команд
 @dp.message(Command('welcome'))
 async def toggle_welcome(message: types.Message):
@@ -953,6 +3308,82 @@ async def cmd_ban(message: types.Message):
     await asyncio.sleep(10)
     await safe_delete_message(reply)
 
+# Розбір user_id для масових команд: числа на початку аргументів і всі ID з документа у відповіді
+MASS_USER_ID_PATTERN = re.compile(r'\b\d{5,}\b')
+
+async def parse_mass_targets(message: types.Message, args: list) -> tuple[list, str]:
+    user_ids = []
+    while args and args[0].isdigit():
+        user_ids.append(int(args.pop(0)))
+    reason = ' '.join(args) or "Масова модерація"
+    document = message.reply_to_message.document if message.reply_to_message else None
+    if document and (document.file_size or 0) <= 1024 * 1024:
+        content = await bot.download(document)
+        user_ids += [int(match) for match in MASS_USER_ID_PATTERN.findall(content.read().decode('utf-8', errors='ignore'))]
+    return list(dict.fromkeys(user_ids)), reason
+
+# Тривалість масового мута з явною одиницею ("30m", "2h", "7d") у хвилинах, не більше 366 днів.
+# Голе число не приймається, щоб перший user_id не став тривалістю.
+MUTE_DURATION_PATTERN = re.compile(r'^(\d{1,6})([mhd])$')
+MUTE_DURATION_UNITS = {'m': 1, 'h': 60, 'd': 24 * 60}
+MUTE_DURATION_MAX_MINUTES = 366 * 24 * 60
+
+def parse_mute_duration(token: str) -> int | None:
+    match = MUTE_DURATION_PATTERN.match(token.lower())
+    if not match:
+        return None
+    minutes = int(match.group(1)) * MUTE_DURATION_UNITS[match.group(2)]
+    return minutes if 0 < minutes <= MUTE_DURATION_MAX_MINUTES else None
+
+async def enqueue_mass_action(message: types.Message, task_type: str, usage: str):
+    if not await has_moderator_privileges(message.from_user.id):
+        reply = await message.reply("Ви не маєте прав для виконання цієї команди.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+    args = message.text.split()[1:]
+    duration = None
+    if task_type == 'massmute':
+        duration = parse_mute_duration(args.pop(0)) if args else None
+    user_ids, reason = await parse_mass_targets(message, args) if task_type == 'massban' or duration else ([], '')
+    if not user_ids or len(user_ids) > MASS_ACTION_MAX_USERS:
+        reply = await message.reply(f"{usage} Максимум {MASS_ACTION_MAX_USERS} користувачів.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+    task = ModerationTask(
+        task_type=task_type,
+        user_id=user_ids[0],
+        username=None,
+        reason=reason,
+        chat_id=message.chat.id,
+        moderator_id=message.from_user.id,
+        duration_minutes=duration,
+        user_ids=user_ids
+    )
+    add_task_to_queue(task)
+    queue_position = get_queue_length()
+    reply = await message.reply(f"Масове завдання на {len(user_ids)} користувачів додано до черги. Позиція: {queue_position}")
+    await safe_delete_message(message)
+    await asyncio.sleep(10)
+    await safe_delete_message(reply)
+
+@dp.message(Command('massban'))
+async def cmd_massban(message: types.Message):
+    await enqueue_mass_action(
+        message, 'massban',
+        "Вкажіть user_id у форматі /massban 123456789 987654321 причина або відповідайте на документ зі списком ID."
+    )
+
+@dp.message(Command('massmute'))
+async def cmd_massmute(message: types.Message):
+    await enqueue_mass_action(
+        message, 'massmute',
+        "Вкажіть час і user_id у форматі /massmute 60m 123456789 987654321 причина (одиниці m, h, d; до 366d) або відповідайте на документ зі списком ID."
+    )
+
 @dp.message(Command('warn'))
 async def cmd_warn(message: types.Message):
     if not await has_moderator_privileges(message.from_user.id):
@@ -1068,6 +3499,7 @@ async def unmute_user(message: types.Message):
                 can_send_other_messages=True
             )
         )
+        await remove_mute(user_id, message.chat.id)
         mention = f"@{username}" if username else f"ID\\:{user_id}"
         text = escape_markdown_v2(f"Знято мут із користувача {mention}.")
         reply = await message.reply(text, parse_mode="MarkdownV2")
@@ -1100,10 +3532,15 @@ async def unwarn_user(message: types.Message):
         return
 
     user_id, username, _ = user_data
-    warn_count = await remove_warning(user_id, message.chat.id)
+    warn_count = remove_warning(user_id, message.chat.id)
     mention = f"@{username}" if username else f"ID\\:{user_id}"
-    if warn_count >= 0:
-        text = escape_markdown_v2(f"Знято попередження з користувача {mention}. Залишилось {warn_count}/3.")
+    if warn_count is None:
+        reply = await message.reply("Не вдалося зняти попередження: сховище лічильників недоступне. Спробуйте пізніше.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+    elif warn_count >= 0:
+        text = escape_markdown_v2(f"Знято попередження з користувача {mention}. Залишилось {warn_count}/{MAX_WARNINGS}.")
         reply = await message.reply(text, parse_mode="MarkdownV2")
         await safe_delete_message(message)
         await asyncio.sleep(25)
@@ -1134,25 +3571,421 @@ async def unban_user(message: types.Message):
         await safe_delete_message(reply)
         return
 
-    user_id, username, _ = user_data
-    try:
-        await bot.unban_chat_member(chat_id=message.chat.id, user_id=user_id)
-        await remove_ban(user_id, message.chat.id)
-        mention = f"@{username}" if username else f"ID\\:{user_id}"
-        text = escape_markdown_v2(f"Знято бан із користувача {mention}.")
-        reply = await message.reply(text, parse_mode="MarkdownV2")
-        await safe_delete_message(message)
-        await asyncio.sleep(25)
-        await safe_delete_message(reply)
-    except TelegramBadRequest as e:
-        reply = await message.reply(f"Не вдалося зняти бан: {e.message}")
+    user_id, username, _ = user_data
+    try:
+        await bot.unban_chat_member(chat_id=message.chat.id, user_id=user_id)
+        await remove_ban(user_id, message.chat.id)
+        mention = f"@{username}" if username else f"ID\\:{user_id}"
+        text = escape_markdown_v2(f"Знято бан із користувача {mention}.")
+        reply = await message.reply(text, parse_mode="MarkdownV2")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+    except TelegramBadRequest as e:
+        reply = await message.reply(f"Не вдалося зняти бан: {e.message}")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+
+
+@dp.message(Command('info'))
+async def cmd_info(message: types.Message):
+    if not await has_moderator_privileges(message.from_user.id):
+        reply = await message.reply("Ви не маєте прав для виконання цієї команди.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    args = message.text.split()
+    if len(args) != 2 or not args[1].startswith('@'):
+        reply = await message.reply("Вкажіть username у форматі /info @username.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    username = args[1].lstrip('@')
+
+    # Створюємо завдання та додаємо до черги
+    task = ModerationTask(
+        task_type="info",
+        user_id=0,  # визначає worker
+        username=username,
+        reason="",
+        chat_id=message.chat.id,
+        moderator_id=message.from_user.id
+    )
+    add_task_to_queue(task)
+    queue_position = get_queue_length()
+    reply = await message.reply(f"Запит info про @{username} додано до черги. Позиція: {queue_position}")
+    await safe_delete_message(message)
+    await asyncio.sleep(10)
+    await safe_delete_message(reply)
+
+@dp.message(Command('restore_archive'))
+async def cmd_restore_archive(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        reply = await message.reply("Ви не маєте прав для виконання цієї команди.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    args = message.text.split()
+    if len(args) != 2 or not re.match(r'^\d{4}-\d{2}$', args[1]):
+        reply = await message.reply("Вкажіть місяць у форматі /restore_archive 2024-01.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    if await restore_punishment_partition(args[1]):
+        reply = await message.reply(f"Історію покарань за {args[1]} відновлено з архіву.")
+    else:
+        reply = await message.reply(f"Не вдалося відновити історію покарань за {args[1]}.")
+    await safe_delete_message(message)
+    await asyncio.sleep(25)
+    await safe_delete_message(reply)
+
+@dp.message(Command('stats'))
+async def cmd_stats(message: types.Message):
+    if not await has_moderator_privileges(message.from_user.id):
+        reply = await message.reply("Ви не маєте прав для виконання цієї команди.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    args = message.text.split()
+    days = int(args[1]) if len(args) > 1 and args[1].isdigit() and int(args[1]) > 0 else 30
+    # Денна статистика зберігається STATS_DAILY_RETENTION_DAYS днів, далі — лише місячні підсумки
+    days = min(days, STATS_DAILY_RETENTION_DAYS)
+    stats = await get_chat_stats(message.chat.id, days)
+    if stats is None:
+        reply = await message.reply("Не вдалося отримати статистику.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    semaphore = asyncio.Semaphore(INFO_CONCURRENCY)
+    user_ids = {moderator_id for moderator_id, _ in stats['top_moderators']} | {user_id for user_id, _ in stats['top_users']}
+    mentions = await resolve_moderator_mentions(user_ids, message.chat.id, semaphore)
+    lines = [f"📊 **Статистика чату за {days} дн\\.**", ""]
+    lines.append("👮 **Топ модераторів:**")
+    lines.extend([f"• {mentions.get(moderator_id)} \\- {total}" for moderator_id, total in stats['top_moderators']]
+                 or ["• немає даних"])
+    lines.extend(["", "🎯 **Найчастіше покарані \\(за весь час\\):**"])
+    lines.extend([f"• {mentions.get(user_id)} \\- {total}" for user_id, total in stats['top_users']]
+                 or ["• немає даних"])
+    hit_rate = stats['filter_hits'] / stats['messages'] * 100 if stats['messages'] else 0
+    lines.extend([
+        "",
+        f"🤖 **Автоматичні покарання:** {stats['filter_hits']} на {stats['messages']} повідомлень "
+        f"\\({escape_markdown_v2(f'{hit_rate:.2f}')}%\\)",
+    ])
+    lookups = verdict_cache.hits + verdict_cache.misses
+    cache_rate = verdict_cache.hits / lookups * 100 if lookups else 0
+    lines.append(f"🧠 **Кеш вердиктів фільтра:** {escape_markdown_v2(f'{cache_rate:.1f}')}% влучань, "
+                 f"{len(verdict_cache)} записів")
+    reply = await message.reply('\n'.join(lines), parse_mode="MarkdownV2")
+    await safe_delete_message(message)
+    await asyncio.sleep(25)
+    await safe_delete_message(reply)
+
+# Ліміт Telegram на розмір файлу, який бот може надіслати
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+
+@dp.message(Command('export'))
+async def cmd_export(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        reply = await message.reply("Ви не маєте прав для виконання цієї команди.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    # /export [chat_id|all] [moderator=ID] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [format=csv|jsonl]
+    options = {'chat': str(message.chat.id), 'format': 'csv'}
+    try:
+        for arg in message.text.split()[1:]:
+            key, _, value = arg.partition('=')
+            if not value:
+                key, value = 'chat', key
+            options[key] = value
+        chat_id = None if options['chat'] == 'all' else int(options['chat'])
+        moderator_id = int(options['moderator']) if 'moderator' in options else None
+        since = datetime.datetime.strptime(options['from'], '%Y-%m-%d') if 'from' in options else None
+        until = (datetime.datetime.strptime(options['to'], '%Y-%m-%d') + datetime.timedelta(days=1)
+                 if 'to' in options else None)
+        if options['format'] not in ('csv', 'jsonl'):
+            raise ValueError(options['format'])
+    except ValueError:
+        reply = await message.reply(
+            "Формат: /export [chat_id|all] [moderator=ID] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [format=csv|jsonl]."
+        )
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    result = await export_punishments(options['format'], chat_id, moderator_id, since, until)
+    if result is None:
+        reply = await message.reply("Не вдалося експортувати історію покарань.")
+    else:
+        path, rows = result
+        if os.path.getsize(path) > TELEGRAM_DOCUMENT_LIMIT:
+            reply = await message.reply(f"Експортовано {rows} записів. Файл завеликий для Telegram: {path}")
+        else:
+            try:
+                await bot.send_document(message.from_user.id, types.FSInputFile(path),
+                                        caption=f"Історія покарань: {rows} записів")
+                reply = await message.reply(f"Експорт ({rows} записів) надіслано в особисті повідомлення.")
+            except (TelegramBadRequest, TelegramForbiddenError) as e:
+                # TelegramForbiddenError — адміністратор ще не відкривав особистий чат з ботом
+                reply = await message.reply(f"Не вдалося надіслати файл: {e.message}. Файл збережено: {path}")
+    await safe_delete_message(message)
+    await asyncio.sleep(25)
+    await safe_delete_message(reply)
+
+async def change_chat_forbidden_word(message: types.Message, add: bool):
+    if not await has_moderator_privileges(message.from_user.id):
+        reply = await message.reply("Ви не маєте прав для виконання цієї команди.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    args = message.text.split(maxsplit=1)
+    command = "/addword" if add else "/delword"
+    if len(args) < 2 or not args[1].strip():
+        reply = await message.reply(f"Вкажіть слово у форматі {command} <слово>.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    word = args[1].strip().lower()
+    if add:
+        success = await add_chat_forbidden_word(message.chat.id, word, message.from_user.id)
+        text = "Слово додано до списку заборонених у цьому чаті." if success else "Не вдалося додати слово."
+    else:
+        success = await remove_chat_forbidden_word(message.chat.id, word, message.from_user.id)
+        text = "Слово більше не заборонене в цьому чаті." if success else "Не вдалося видалити слово."
+    reply = await message.reply(text)
+    await safe_delete_message(message)
+    await asyncio.sleep(25)
+    await safe_delete_message(reply)
+
+@dp.message(Command('addword'))
+async def cmd_addword(message: types.Message):
+    await change_chat_forbidden_word(message, add=True)
+
+@dp.message(Command('delword'))
+async def cmd_delword(message: types.Message):
+    await change_chat_forbidden_word(message, add=False)
+
+DOMAIN_COMMAND_MODES = {'block': 'block', 'allow': 'allow', 'remove': None}
+
+@dp.message(Command('domain'))
+async def cmd_domain(message: types.Message):
+    if not await has_moderator_privileges(message.from_user.id):
+        reply = await message.reply("Ви не маєте прав для виконання цієї команди.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    args = message.text.split()[1:]
+    if len(args) != 2 or args[0] not in DOMAIN_COMMAND_MODES or parse_domain_rule(args[1]) is None:
+        reply = await message.reply(
+            "Формат: /domain block|allow|remove <домен>. "
+            "*.example.com — лише піддомени, +.t.me — запрошення в інші чати Telegram."
+        )
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    domain = args[1].strip().lower().strip('.')
+    mode = DOMAIN_COMMAND_MODES[args[0]]
+    if await set_chat_domain_rule(message.chat.id, domain, mode, message.from_user.id):
+        text = {'block': f"Посилання на {domain} заборонені в цьому чаті.",
+                'allow': f"Посилання на {domain} дозволені в цьому чаті.",
+                None: f"Правило для {domain} видалено, діє глобальний список."}[mode]
+    else:
+        text = "Не вдалося зберегти правило домену."
+    reply = await message.reply(text)
+    await safe_delete_message(message)
+    await asyncio.sleep(25)
+    await safe_delete_message(reply)
+
+@dp.message(Command('addrule'))
+async def cmd_addrule(message: types.Message):
+    if not await has_moderator_privileges(message.from_user.id):
+        reply = await message.reply("Ви не маєте прав для виконання цієї команди.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    args = message.text.split(maxsplit=3)[1:]
+    action, _, duration = args[0].partition(':') if args else ('', '', '')
+    usage = ("Формат: /addrule <delete|warn|mute[:хвилин]|ban> <пріоритет> <regex>. "
+             "Приклад: /addrule mute:60 10 \\+?380\\d{9}. Без урахування регістру: (?i) на початку.")
+    error = None
+    if (len(args) < 3 or action not in CHAT_RULE_ACTIONS or not args[1].lstrip('-').isdigit()
+            or (duration and (action != 'mute' or not duration.isdigit()))):
+        error = usage
+    else:
+        error = validate_rule_pattern(args[2])
+    if error:
+        reply = await message.reply(error)
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    rule_id = await add_chat_rule(message.chat.id, args[2], action, int(duration) if duration else None,
+                                  int(args[1]), message.from_user.id)
+    if rule_id is None:
+        text = f"Не вдалося додати правило (максимум {CHAT_RULES_MAX} правил на чат)."
+    else:
+        text = f"Правило #{rule_id} додано."
+    reply = await message.reply(text)
+    await safe_delete_message(message)
+    await asyncio.sleep(25)
+    await safe_delete_message(reply)
+
+@dp.message(Command('delrule'))
+async def cmd_delrule(message: types.Message):
+    if not await has_moderator_privileges(message.from_user.id):
+        reply = await message.reply("Ви не маєте прав для виконання цієї команди.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    args = message.text.split()[1:]
+    if len(args) != 1 or not args[0].lstrip('#').isdigit():
+        text = "Формат: /delrule <номер правила>."
+    elif await remove_chat_rule(message.chat.id, int(args[0].lstrip('#'))):
+        text = "Правило видалено."
+    else:
+        text = "Правило не знайдено."
+    reply = await message.reply(text)
+    await safe_delete_message(message)
+    await asyncio.sleep(25)
+    await safe_delete_message(reply)
+
+@dp.message(Command('listrules'))
+async def cmd_listrules(message: types.Message):
+    if not await has_moderator_privileges(message.from_user.id):
+        reply = await message.reply("Ви не маєте прав для виконання цієї команди.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    rules = (await get_chat_rule_set(message.chat.id)).rules
+    if rules:
+        lines = [f"Правила чату ({len(rules)}):"]
+        for rule in rules:
+            hits = rule.hits + rule_hit_counts.get(rule.id, 0)
+            lines.append(f"#{rule.id} [{rule.priority}] {describe_rule_action(rule)}, спрацювань: {hits}\n{rule.pattern}")
+        text = "\n".join(lines)
+    else:
+        text = "У цьому чаті немає правил. Додайте їх через /addrule."
+    reply = await message.reply(text[:4000])
+    await safe_delete_message(message)
+    await asyncio.sleep(25)
+    await safe_delete_message(reply)
+
+@dp.message(Command('rules_test'))
+async def cmd_rules_test(message: types.Message):
+    if not await has_moderator_privileges(message.from_user.id):
+        reply = await message.reply("Ви не маєте прав для виконання цієї команди.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    args = message.text.split(maxsplit=1)
+    if message.reply_to_message:
+        sample = extract_message_text(message.reply_to_message)
+    else:
+        sample = args[1] if len(args) > 1 else ''
+    if not sample:
+        text = "Формат: /rules_test <текст> або у відповідь на повідомлення."
+    else:
+        result = (await get_chat_rule_set(message.chat.id)).match(sample)
+        if result is None:
+            text = "Жодне правило не спрацювало."
+        else:
+            rule, fragment = result
+            text = f"Спрацювало правило #{rule.id}: {describe_rule_action(rule)}. Збіг: {fragment[:200]}"
+    reply = await message.reply(text)
+    await safe_delete_message(message)
+    await asyncio.sleep(25)
+    await safe_delete_message(reply)
+
+@dp.message(Command('flood'))
+async def cmd_flood(message: types.Message):
+    if not await has_moderator_privileges(message.from_user.id):
+        reply = await message.reply("Ви не маєте прав для виконання цієї команди.")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    args = message.text.split()[1:]
+    if args == ['off']:
+        values = (0, FLOOD_DEFAULT_WINDOW, FLOOD_DEFAULT_MUTE_MINUTES)
+    elif len(args) == 3 and all(arg.isdigit() and int(arg) > 0 for arg in args) and 2 <= int(args[0]) <= FLOOD_MAX_LIMIT:
+        values = tuple(int(arg) for arg in args)
+    else:
+        limit, window, mute_minutes = (await get_chat_info(message.chat.id)).flood_settings()
+        current = f"{limit} повідомлень за {window} с, мут {mute_minutes} хв" if limit else "вимкнено"
+        reply = await message.reply(
+            f"Поточний поріг флуду: {current}.\n"
+            f"Формат: /flood <повідомлень від 2 до {FLOOD_MAX_LIMIT}> <секунд> <хвилин мута> або /flood off."
+        )
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+        return
+
+    if await set_flood_settings(message.chat.id, *values):
+        text = "Антифлуд вимкнено." if values[0] == 0 else (
+            f"Антифлуд: {values[0]} повідомлень за {values[1]} с, мут {values[2]} хв.")
+    else:
+        text = "Не вдалося зберегти налаштування антифлуду."
+    reply = await message.reply(text)
+    await safe_delete_message(message)
+    await asyncio.sleep(25)
+    await safe_delete_message(reply)
+
+@dp.message(Command('unlock'))
+async def cmd_unlock(message: types.Message):
+    if not await has_moderator_privileges(message.from_user.id):
+        reply = await message.reply("Ви не маєте прав для виконання цієї команди.")
         await safe_delete_message(message)
         await asyncio.sleep(25)
         await safe_delete_message(reply)
+        return
 
+    if await lift_lockdown(message.chat.id):
+        text = "Чат розблоковано, права учасників відновлено."
+    else:
+        text = "Чат не заблокований через рейд або не вдалося відновити права."
+    reply = await message.reply(text)
+    await safe_delete_message(message)
+    await asyncio.sleep(25)
+    await safe_delete_message(reply)
 
-@dp.message(Command('info'))
-async def cmd_info(message: types.Message):
+@dp.message(Command('review'))
+async def cmd_review(message: types.Message):
     if not await has_moderator_privileges(message.from_user.id):
         reply = await message.reply("Ви не маєте прав для виконання цієї команди.")
         await safe_delete_message(message)
@@ -1160,30 +3993,61 @@ async def cmd_info(message: types.Message):
         await safe_delete_message(reply)
         return
 
-    args = message.text.split()
-    if len(args) != 2 or not args[1].startswith('@'):
-        reply = await message.reply("Вкажіть username у форматі /info @username.")
+    chat_id = message.chat.id
+    args = message.text.split()[1:]
+    try:
+        user_ids = [int(user_id) for user_id in redis_client.zrange(raid_review_key(chat_id), 0, MASS_ACTION_MAX_USERS - 1)]
+        if args == ['ban'] and user_ids:
+            add_task_to_queue(ModerationTask(
+                task_type="massban",
+                user_id=user_ids[0],
+                username=None,
+                reason="Учасник рейду",
+                chat_id=chat_id,
+                moderator_id=message.from_user.id,
+                user_ids=user_ids
+            ))
+            redis_client.zrem(raid_review_key(chat_id), *[str(user_id) for user_id in user_ids])
+            text = f"Бан {len(user_ids)} учасників рейду додано до черги."
+        elif args == ['clear']:
+            redis_client.delete(raid_review_key(chat_id))
+            text = "Чергу перевірки очищено."
+        elif user_ids:
+            total = redis_client.zcard(raid_review_key(chat_id))
+            listed = ", ".join(str(user_id) for user_id in user_ids[:30])
+            text = (f"Черга перевірки: {total} новачків.\n{listed}\n"
+                    f"/review ban — забанити (до {MASS_ACTION_MAX_USERS} за раз), /review clear — очистити.")
+        else:
+            text = "Черга перевірки порожня."
+    except redis.RedisError as e:
+        logger.error(f"Помилка черги перевірки для chat_id={chat_id}: {e}")
+        text = "Не вдалося прочитати чергу перевірки."
+    reply = await message.reply(text)
+    await safe_delete_message(message)
+    await asyncio.sleep(25)
+    await safe_delete_message(reply)
+
+@dp.message(Command('reload_words'))
+async def cmd_reload_words(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        reply = await message.reply("Ви не маєте прав для виконання цієї команди.")
         await safe_delete_message(message)
         await asyncio.sleep(25)
         await safe_delete_message(reply)
         return
 
-    username = args[1].lstrip('@')
-
-    # Створюємо завдання та додаємо до черги
-    task = ModerationTask(
-        task_type="info",
-        user_id=0,  # визначає worker
-        username=username,
-        reason="",
-        chat_id=message.chat.id,
-        moderator_id=message.from_user.id
-    )
-    add_task_to_queue(task)
-    queue_position = get_queue_length()
-    reply = await message.reply(f"Запит info про @{username} додано до черги. Позиція: {queue_position}")
+    try:
+        matcher = await reload_forbidden_words()
+        domains = await reload_blocked_domains()
+        reply = await message.reply(
+            f"Список заборонених слів оновлено: {len(matcher.words)} слів, версія {matcher.version}. "
+            f"Правил доменів: {domains.size}."
+        )
+    except Exception as e:
+        logger.error(f"Помилка оновлення списку заборонених слів: {e}")
+        reply = await message.reply("Не вдалося оновити список заборонених слів.")
     await safe_delete_message(message)
-    await asyncio.sleep(10)
+    await asyncio.sleep(25)
     await safe_delete_message(reply)
 
 @dp.message(Command('ad'))
@@ -1291,6 +4155,120 @@ async def get_users(message: types.Message):
         if os.path.exists(filename):
             os.remove(filename)
 
+# Стан входів у чат: ковзне вікно (час, user_id), рейд, відкладені привітання, блокування чату
+@dataclass
+class RaidState:
+    joins: deque = field(default_factory=deque)
+    active: bool = False
+    last_join: float = 0.0
+    pending_welcomes: int = 0
+    locked_at: Optional[float] = None
+    saved_permissions: Optional[ChatPermissions] = None
+
+raid_states: dict[int, RaidState] = {}
+
+def raid_review_key(chat_id: int) -> str:
+    return f"raid_review:{chat_id}"
+
+# Новачки під час рейду чекають на перевірку модератором (/review)
+def queue_for_review(chat_id: int, user_ids: list[int]):
+    try:
+        pipe = redis_client.pipeline()
+        pipe.zadd(raid_review_key(chat_id), {str(user_id): time.time() for user_id in user_ids})
+        pipe.expire(raid_review_key(chat_id), RAID_REVIEW_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.error(f"Помилка додавання до черги перевірки для chat_id={chat_id}: {e}")
+
+# Облік входу; True, якщо чат зараз під рейдом і персональне привітання не надсилається
+async def register_join(chat_id: int, user_id: int) -> bool:
+    state = raid_states.setdefault(chat_id, RaidState())
+    now = time.monotonic()
+    state.last_join = now
+    state.joins.append((now, user_id))
+    while state.joins and now - state.joins[0][0] > RAID_JOIN_WINDOW:
+        state.joins.popleft()
+    if state.active:
+        state.pending_welcomes += 1
+        queue_for_review(chat_id, [user_id])
+        return True
+    if len(state.joins) < RAID_JOIN_LIMIT:
+        return False
+
+    state.active = True
+    state.pending_welcomes = 1
+    queue_for_review(chat_id, [joined_user_id for _, joined_user_id in state.joins])
+    logger.warning(f"Виявлено рейд у chat_id={chat_id}: {len(state.joins)} входів за {RAID_JOIN_WINDOW:.0f} с")
+    notice = "🚨 Виявлено масовий вхід у чат. Привітання призупинено, новачки додані до черги перевірки (/review)."
+    if state.locked_at is not None:
+        notice += " Чат досі в режимі лише для читання (/unlock — зняти)."
+    elif RAID_LOCKDOWN and await start_lockdown(chat_id):
+        notice += " Чат тимчасово переведено в режим лише для читання (/unlock — зняти)."
+    try:
+        await bot.send_message(chat_id, notice)
+    except TelegramBadRequest as e:
+        logger.warning(f"Не вдалося надіслати сповіщення про рейд у chat_id={chat_id}: {e}")
+    asyncio.create_task(raid_monitor(chat_id))
+    return True
+
+# Переведення чату в режим лише для читання зі збереженням поточних прав учасників
+async def start_lockdown(chat_id: int) -> bool:
+    state = raid_states[chat_id]
+    try:
+        chat = await bot.get_chat(chat_id)
+        state.saved_permissions = chat.permissions
+        await bot.set_chat_permissions(chat_id, ChatPermissions(can_send_messages=False))
+        state.locked_at = time.monotonic()
+        logger.warning(f"Чат {chat_id} заблоковано через рейд")
+        return True
+    except TelegramBadRequest as e:
+        logger.error(f"Не вдалося заблокувати чат {chat_id}: {e}")
+        return False
+
+# Повернення збережених прав учасників
+async def lift_lockdown(chat_id: int) -> bool:
+    state = raid_states.get(chat_id)
+    if state is None or state.locked_at is None:
+        return False
+    permissions = state.saved_permissions or ChatPermissions(
+        can_send_messages=True,
+        can_send_media_messages=True,
+        can_send_polls=True,
+        can_send_other_messages=True,
+        can_add_web_page_previews=True,
+        can_invite_users=True
+    )
+    try:
+        await bot.set_chat_permissions(chat_id, permissions)
+        state.locked_at = None
+        state.saved_permissions = None
+        logger.info(f"Чат {chat_id} розблоковано")
+        return True
+    except TelegramBadRequest as e:
+        logger.error(f"Не вдалося розблокувати чат {chat_id}: {e}")
+        return False
+
+# Завершення рейду після RAID_QUIET_SECONDS без входів: одне спільне привітання і зняття блокування за таймером
+async def raid_monitor(chat_id: int):
+    state = raid_states[chat_id]
+    while (idle := time.monotonic() - state.last_join) < RAID_QUIET_SECONDS:
+        await asyncio.sleep(RAID_QUIET_SECONDS - idle)
+    state.active = False
+    welcomed, state.pending_welcomes = state.pending_welcomes, 0
+    state.joins.clear()
+    logger.info(f"Рейд у chat_id={chat_id} завершено, непривітаних новачків: {welcomed}")
+    if WELCOME_MESSAGE and welcomed:
+        info = await get_chat_info(chat_id)
+        chat_username = f"@{info.username}" if info.username else info.display_name()
+        try:
+            await bot.send_message(chat_id, f"Вітаємо {welcomed} нових учасників у {chat_username}! 😊")
+        except TelegramBadRequest as e:
+            logger.warning(f"Не вдалося надіслати спільне привітання у chat_id={chat_id}: {e}")
+    if state.locked_at is not None:
+        await asyncio.sleep(max(0.0, RAID_LOCKDOWN_MINUTES * 60 - (time.monotonic() - state.locked_at)))
+        if not state.active:
+            await lift_lockdown(chat_id)
+
 @dp.chat_member()
 async def welcome_new_member(update: ChatMemberUpdated):
     user = update.new_chat_member.user
@@ -1298,12 +4276,15 @@ async def welcome_new_member(update: ChatMemberUpdated):
     new_status = update.new_chat_member.status
     logger.info(
         f"Отримано подію chat_member: user_id={user.id}, old_status={old_status}, new_status={new_status}, chat_id={update.chat.id}")
-    if (WELCOME_MESSAGE and new_status in ["member", "restricted"] and
-            (update.old_chat_member is None or old_status in ["left", "kicked"])):
+    chat_info = await remember_chat(update.chat)
+    if new_status not in ["member", "restricted"] or old_status not in ["none", "left", "kicked"]:
+        return
+    if await register_join(update.chat.id, user.id):
+        return
+    if WELCOME_MESSAGE:
         try:
             mention = f"@{user.username}" if user.username else f"ID\\:{user.id}"
-            chat = await bot.get_chat(update.chat.id)
-            chat_username = f"@{chat.username}" if chat.username else f"ID:{update.chat.first_name}"
+            chat_username = f"@{chat_info.username}" if chat_info.username else chat_info.display_name()
             text = escape_markdown_v2(f"Вітаємо, {mention}! Ласкаво просимо до {chat_username}! 😊")
             await bot.send_message(
                 chat_id=update.chat.id,
@@ -1313,6 +4294,19 @@ async def welcome_new_member(update: ChatMemberUpdated):
         except Exception as e:
             pass
 
+# Зміна статусу самого бота в чаті: оновлюємо права в кеші
+@dp.my_chat_member()
+async def track_bot_membership(update: ChatMemberUpdated):
+    await remember_chat(update.chat)
+    await remember_bot_member(update.chat.id, update.new_chat_member)
+    logger.info(f"Оновлено статус бота в чаті {update.chat.id}: {update.new_chat_member.status}")
+
+# Сервісні повідомлення про зміну назви чату
+@dp.message(F.new_chat_title)
+async def chat_title_changed(message: types.Message):
+    await remember_chat(message.chat)
+    logger.info(f"Оновлено назву чату {message.chat.id}: {message.chat.title}")
+
 
 @dp.message(Command('rules'))
 async def show_rules(message: types.Message):
@@ -1364,10 +4358,26 @@ async def show_help(message: types.Message):
             "⚠️ /warn <user_id> <причина> - Видати попередження користувачу.\n"
             "🚫 /ban <user_id> <причина> - Забанити користувача.\n"
             "🔇 /mute <user_id> <хвилини> <причина> - Видати мут користувачу.\n"
+            "🚫 /massban <user_id...> <причина> - Масовий бан у всіх чатах (або відповідь на документ зі списком ID).\n"
+            "🔇 /massmute <час: 30m|2h|1d> <user_id...> <причина> - Масовий мут у цьому чаті.\n"
             "🔊 /unmute <user_id> - Зняти мут із користувача.\n"
             "✅ /unwarn <user_id> - Зняти попередження з користувача.\n"
             "🔓 /unban <user_id> - Зняти бан із користувача.\n"
             "ℹ️ /info @username - Переглянути інформацію про користувача та його покарання.\n"
+            "🗄 /restore_archive <YYYY-MM> - Повернути заархівовану історію покарань за місяць.(Тільки для адміністраторів)\n"
+            "📊 /stats [днів] - Статистика модерації чату.\n"
+            "🔓 /unlock - Зняти блокування чату після рейду.\n"
+            "🧾 /review [ban|clear] - Черга перевірки новачків, що зайшли під час рейду.\n"
+            "🔗 /domain block|allow|remove <домен> - Правила посилань у цьому чаті.\n"
+            "📐 /addrule <delete|warn|mute[:хв]|ban> <пріоритет> <regex> - Додати правило чату.\n"
+            "🗑 /delrule <номер> - Видалити правило чату.\n"
+            "📋 /listrules - Правила чату з лічильниками спрацювань.\n"
+            "🧪 /rules_test <текст> - Перевірити текст правилами без покарання.\n"
+            "🌊 /flood <повідомлень> <секунд> <хвилин> | off - Налаштувати антифлуд у цьому чаті.\n"
+            "➕ /addword <слово> - Заборонити слово в цьому чаті.\n"
+            "➖ /delword <слово> - Дозволити слово в цьому чаті.\n"
+            "🔄 /reload_words - Перечитати список заборонених слів.(Тільки для адміністраторів)\n"
+            "📤 /export [chat_id|all] [moderator=ID] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [format=csv|jsonl] - Експорт історії покарань.(Тільки для адміністраторів)\n"
             "📢 /ad <текст> - Зробити оголошення зі згадкою всіх учасників.\n"
             "📜 /rules - Переглянути правила чату.\n"
             "📋 /get_users - Отримати список учасників чату (тільки для дозволених користувачів).\n"
@@ -1393,80 +4403,383 @@ async def show_help(message: types.Message):
         await asyncio.sleep(25)
         await safe_delete_message(reply)
 
+@spoolable_write('upsert_telegram_user')
+async def upsert_telegram_user_op(conn, at: datetime.datetime, user_id: int, username: str | None,
+                                  first_name: str | None, last_name: str | None):
+    await conn.execute(
+        '''
+        INSERT INTO telegramuser (user_id, username, first_name, last_name, last_seen)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (user_id) DO UPDATE SET
+            username = $2,
+            first_name = $3,
+            last_name = $4,
+            last_seen = $5
+        ''',
+        user_id,
+        username,
+        first_name,
+        last_name,
+        at
+    )
+
 async def upsert_telegram_user(user: types.User):
+    index_username(user.id, user.username)
+    user_profile_cache.set(user.id, UserProfile(user_id=user.id, username=user.username,
+                                                first_name=user.first_name, last_name=user.last_name))
+    await execute_write('upsert_telegram_user', user.id, user.username, user.first_name, user.last_name)
+
+# Кільцевий буфер часу останніх limit повідомлень користувача в чаті
+class FloodBuffer:
+    __slots__ = ('timestamps', 'position', 'last_seen')
+
+    def __init__(self, limit: int):
+        self.timestamps = array('d', bytes(8 * limit))
+        self.position = 0
+        self.last_seen = 0.0
+
+# Детектор флуду: флуд, якщо limit повідомлень вкладаються у window секунд.
+# Кожне повідомлення — O(1): після запису найстаріший із limit останніх часів лежить у наступній комірці.
+class FloodDetector:
+    def __init__(self, max_tracked: int):
+        self.max_tracked = max_tracked
+        self.buffers: dict[tuple[int, int], FloodBuffer] = {}
+
+    def record(self, chat_id: int, user_id: int, limit: int, window: int, now: float | None = None) -> bool:
+        if limit <= 0:
+            return False
+        now = time.monotonic() if now is None else now
+        key = (chat_id, user_id)
+        buffer = self.buffers.get(key)
+        if buffer is None or len(buffer.timestamps) != limit:
+            if buffer is None and len(self.buffers) >= self.max_tracked:
+                del self.buffers[next(iter(self.buffers))]
+            buffer = FloodBuffer(limit)
+            self.buffers[key] = buffer
+        buffer.timestamps[buffer.position] = now
+        buffer.position = (buffer.position + 1) % limit
+        buffer.last_seen = now
+        oldest = buffer.timestamps[buffer.position]
+        if oldest and now - oldest <= window:
+            # Після спрацювання буфер очищується, щоб наступне повідомлення не спрацювало вдруге
+            self.buffers[key] = FloodBuffer(limit)
+            return True
+        return False
+
+    # Видалення записів, неактивних довше за max_idle секунд
+    def sweep(self, max_idle: float) -> int:
+        cutoff = time.monotonic() - max_idle
+        idle = [key for key, buffer in self.buffers.items() if buffer.last_seen < cutoff]
+        for key in idle:
+            del self.buffers[key]
+        return len(idle)
+
+flood_detector = FloodDetector(FLOOD_MAX_TRACKED)
+
+# Фонове очищення неактивних буферів флуду
+async def flood_sweeper():
+    while True:
+        await asyncio.sleep(FLOOD_SWEEP_INTERVAL)
+        max_window = max([info.flood_settings()[1] for info in chat_cache.values()] + [FLOOD_DEFAULT_WINDOW])
+        removed = flood_detector.sweep(max_window)
+        if removed:
+            logger.info(f"Очищено {removed} неактивних буферів флуду, залишилось {len(flood_detector.buffers)}")
+
+# Перевірка флуду; при спрацюванні ставить мут у ту ж чергу, що й /mute
+async def check_flood(message: types.Message, info: ChatInfo):
+    limit, window, mute_minutes = info.flood_settings()
+    if not flood_detector.record(message.chat.id, message.from_user.id, limit, window):
+        return
+    if await has_moderator_privileges(message.from_user.id):
+        return
+    task = ModerationTask(
+        task_type="mute",
+        user_id=message.from_user.id,
+        username=message.from_user.username,
+        reason=f"Флуд: {limit} повідомлень за {window} с",
+        chat_id=message.chat.id,
+        moderator_id=None,
+        duration_minutes=mute_minutes
+    )
+    add_task_to_queue(task)
+    logger.info(f"Виявлено флуд: user_id={message.from_user.id}, chat_id={message.chat.id}")
+
+# Збереження порогів флуду чату
+async def set_flood_settings(chat_id: int, limit: int, window: int, mute_minutes: int) -> bool:
     try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        if DB_SSLMODE == 'require':
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        conn = await asyncpg.connect(
-            host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            ssl=ssl_context if DB_SSLMODE == 'require' else None
-        )
-        await conn.execute(
-            '''
-            INSERT INTO telegramuser (user_id, username, first_name, last_name, last_seen)
-            VALUES ($1, $2, $3, $4, $5)
-            ON CONFLICT (user_id) DO UPDATE SET
-                username = $2,
-                first_name = $3,
-                last_name = $4,
-                last_seen = $5
-            ''',
-            user.id,
-            user.username,
-            user.first_name,
-            user.last_name,
-            datetime.datetime.utcnow()
-        )
+        conn = await db_connect()
+        await conn.execute('''
+            INSERT INTO chat_settings (chat_id, flood_limit, flood_window_seconds, flood_mute_minutes)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (chat_id) DO UPDATE SET
+                flood_limit = EXCLUDED.flood_limit,
+                flood_window_seconds = EXCLUDED.flood_window_seconds,
+                flood_mute_minutes = EXCLUDED.flood_mute_minutes
+        ''', chat_id, limit, window, mute_minutes)
+        mark_recent_write(chat_id)
+        info = chat_cache.setdefault(chat_id, ChatInfo(chat_id=chat_id))
+        info.flood_limit, info.flood_window_seconds, info.flood_mute_minutes = limit, window, mute_minutes
+        logger.info(f"Оновлено поріг флуду для chat_id={chat_id}: {limit}/{window}с, мут {mute_minutes} хв")
+        return True
     except Exception as e:
-        logger.error(f"Помилка запису telegramuser: {e}")
+        logger.error(f"Помилка збереження порогу флуду для chat_id={chat_id}: {e}")
+        return False
     finally:
         if 'conn' in locals():
             await conn.close()
 
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 4
+SIMHASH_BAND_BITS = SIMHASH_BITS // SIMHASH_BANDS
+
+# Рядок із 64 нулів як число: кожен біт значення стає окремим байтом-лічильником
+SIMHASH_ZERO_LANES = int.from_bytes(b'0' * SIMHASH_BITS, 'big')
+
+# 64-бітний SimHash за 4-символьними шинглами: схожі тексти дають відбитки з малою відстанню Хеммінга.
+# Береться не більше SPAM_WAVE_MAX_SHINGLES шинглів з найменшим crc32 (той самий вибір для схожих текстів),
+# а біти всіх значень рахуються разом у байтових лічильниках одного великого числа
+def simhash(text: str) -> int:
+    shingles = {text[i:i + 4].encode() for i in range(max(len(text) - 3, 1))}
+    sample = heapq.nsmallest(SPAM_WAVE_MAX_SHINGLES, shingles, key=zlib.crc32)
+    lanes = -len(sample) * SIMHASH_ZERO_LANES
+    for shingle in sample:
+        value = int.from_bytes(hashlib.blake2b(shingle, digest_size=8).digest(), 'big')
+        lanes += int.from_bytes(format(value, '064b').encode(), 'big')
+    counts = lanes.to_bytes(SIMHASH_BITS, 'big')
+    return int(''.join('1' if count * 2 > len(sample) else '0' for count in counts), 2)
+
+def simhash_distance(first: int, second: int) -> int:
+    return bin(first ^ second).count('1')
+
+# Індекс відбитків у Redis: по ZSET на кожну 16-бітну смугу відбитка, score — час повідомлення.
+# Відбитки на відстані до 3 біт мають принаймні одну спільну смугу, тож пошук — 4 обмежені бакети.
+SPAM_WAVE_INDEX_SCRIPT = redis_client.register_script('''
+    local now = tonumber(ARGV[2])
+    local window = tonumber(ARGV[3])
+    local seen = {}
+    local candidates = {}
+    for _, key in ipairs(KEYS) do
+        redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+        for _, member in ipairs(redis.call('ZRANGE', key, 0, -1)) do
+            if not seen[member] then
+                seen[member] = true
+                table.insert(candidates, member)
+            end
+        end
+        redis.call('ZADD', key, now, ARGV[1])
+        redis.call('ZREMRANGEBYRANK', key, 0, -tonumber(ARGV[4]) - 1)
+        redis.call('EXPIRE', key, window)
+    end
+    return candidates
+''')
+
+# Тривога по хвилі ставиться один раз на всі смуги відбитка
+SPAM_WAVE_ALERT_SCRIPT = redis_client.register_script('''
+    for _, key in ipairs(KEYS) do
+        if redis.call('EXISTS', key) == 1 then
+            return 0
+        end
+    end
+    for _, key in ipairs(KEYS) do
+        redis.call('SET', key, ARGV[1], 'EX', tonumber(ARGV[2]))
+    end
+    return 1
+''')
+
+def simhash_bands(fingerprint: int) -> list[int]:
+    mask = (1 << SIMHASH_BAND_BITS) - 1
+    return [fingerprint >> (band * SIMHASH_BAND_BITS) & mask for band in range(SIMHASH_BANDS)]
+
+# Запис відбитка в індекс і пошук схожих повідомлень за вікно: список (chat_id, user_id, message_id).
+# Синхронний виклик Redis — викликається через asyncio.to_thread
+def index_message_fingerprint(chat_id: int, user_id: int, message_id: int, fingerprint: int) -> list[tuple[int, int, int]]:
+    bands = simhash_bands(fingerprint)
+    keys = [f"spamwave:{band}:{value:04x}" for band, value in enumerate(bands)]
+    member = f"{chat_id}:{user_id}:{message_id}:{fingerprint:016x}"
+    candidates = SPAM_WAVE_INDEX_SCRIPT(keys=keys, args=[member, time.time(), SPAM_WAVE_WINDOW, SPAM_WAVE_BUCKET_SIZE])
+    matches = [(chat_id, user_id, message_id)]
+    for candidate in candidates:
+        other_chat_id, other_user_id, other_message_id, other_fingerprint = candidate.split(':')
+        if simhash_distance(int(other_fingerprint, 16), fingerprint) <= SPAM_WAVE_MAX_DISTANCE:
+            matches.append((int(other_chat_id), int(other_user_id), int(other_message_id)))
+    return matches
+
+# Виявлення однакового тексту в багатьох чатах або від багатьох користувачів.
+# Перша хвиля дає одне масове завдання на всіх учасників, пізніші повідомлення хвилі — завдання на відправника.
+async def check_spam_wave(message: types.Message):
+    text = extract_message_text(message)
+    if len(text) < SPAM_WAVE_MIN_LENGTH:
+        return
+    normalized = normalize_text(text[:SPAM_WAVE_MAX_TEXT])
+    if len(normalized.text) < SPAM_WAVE_MIN_LENGTH:
+        return
+    fingerprint = simhash(normalized.text)
+    try:
+        matches = await asyncio.to_thread(
+            index_message_fingerprint, message.chat.id, message.from_user.id, message.message_id, fingerprint
+        )
+        chats = {chat_id for chat_id, _, _ in matches}
+        users = {user_id for _, user_id, _ in matches}
+        if len(chats) < SPAM_WAVE_MIN_CHATS and len(users) < SPAM_WAVE_MIN_USERS:
+            return
+        # Розсилки модераторів по всіх чатах — не спам
+        if await has_moderator_privileges(message.from_user.id):
+            return
+        alert_keys = [f"spamwave:alert:{band}:{value:04x}" for band, value in enumerate(simhash_bands(fingerprint))]
+        first_alert = await asyncio.to_thread(
+            SPAM_WAVE_ALERT_SCRIPT, keys=alert_keys, args=[f"{fingerprint:016x}", SPAM_WAVE_WINDOW]
+        )
+    except redis.RedisError as e:
+        logger.error(f"Помилка індексу хвиль спаму: {e}")
+        return
+
+    if first_alert:
+        targets = []
+        moderator_checks = {}
+        for chat_id, user_id, message_id in matches:
+            if user_id not in moderator_checks:
+                moderator_checks[user_id] = user_id != message.from_user.id and await has_moderator_privileges(user_id)
+            if not moderator_checks[user_id]:
+                targets.append([chat_id, user_id, message_id])
+        logger.warning(f"Хвиля спаму {fingerprint:016x}: {len(chats)} чатів, {len(users)} користувачів")
+    else:
+        targets = [[message.chat.id, message.from_user.id, message.message_id]]
+    task = ModerationTask(
+        task_type="massmute",
+        user_id=message.from_user.id,
+        username=message.from_user.username,
+        reason=f"Хвиля спаму: однаковий текст у {len(chats)} чатах від {len(users)} користувачів",
+        chat_id=message.chat.id,
+        moderator_id=None,
+        duration_minutes=SPAM_WAVE_MUTE_MINUTES,
+        targets=targets
+    )
+    add_task_to_queue(task)
+
+# Увесь текст повідомлення, який перевіряє фільтр: текст або підпис до медіа (зокрема в пересланих
+# повідомленнях), питання й варіанти опитування, цитата з іншого повідомлення
+def extract_message_text(message: types.Message) -> str:
+    parts = [message.text, message.caption]
+    if message.poll:
+        parts.append(message.poll.question)
+        parts.extend(option.text for option in message.poll.options)
+    if message.quote:
+        parts.append(message.quote.text)
+    return '\n'.join(part for part in parts if part)
+
+# Хеші вже перевіреного вмісту: (chat_id, message_id) -> blake2b(text); повторне редагування з тим самим текстом не сканується
+scanned_message_hashes = TTLCache(SCANNED_MESSAGES_CACHE_SIZE, 24 * 60 * 60)
+
 @dp.message()
 async def filter_messages(message: types.Message):
     await upsert_telegram_user(message.from_user)
+    info = await remember_chat(message.chat)
+    count_chat_message(message.chat.id)
+    await check_flood(message, info)
+    # Статус фільтра читається один раз на повідомлення; особисті повідомлення боту не є хвилею спаму
+    if not await get_filter_status(message.chat.id):
+        return
+    if message.chat.type in ('group', 'supergroup'):
+        await check_spam_wave(message)
+    await apply_content_filters(message)
+
+@dp.edited_message()
+async def filter_edited_messages(message: types.Message):
+    if await get_filter_status(message.chat.id):
+        await apply_content_filters(message)
+
+# Правила чату, посилання і заборонені слова для чату з увімкненим фільтром
+async def apply_content_filters(message: types.Message):
+    if not await apply_chat_rules(message) and not await apply_link_filter(message):
+        await apply_forbidden_word_filter(message)
+
+async def apply_forbidden_word_filter(message: types.Message):
     chat_id = message.chat.id
-    if not await get_filter_status(chat_id) or not message.text:
+    text = extract_message_text(message)
+    if not text:
         return
-    message_text = message.text.lower()
-    for word in FORBIDDEN_WORDS:
-        if word in message_text:
-            try:
-                mute_until = datetime.datetime.now() + datetime.timedelta(hours=24)
-                await bot.restrict_chat_member(
-                    chat_id=message.chat.id,
-                    user_id=message.from_user.id,
-                    permissions=ChatPermissions(
-                        can_send_messages=False,
-                        can_send_media_messages=False,
-                        can_send_polls=False,
-                        can_send_other_messages=False
-                    ),
-                    until_date=mute_until
-                )
-                await log_punishment(
-                    message.from_user.id, message.chat.id, "mute",
-                    f"Використання забороненого слова: {word}", duration_minutes=24 * 60, moderator_id=None
-                )
-                mention = f"@{message.from_user.username}" if message.from_user.username else f"ID\\:{message.from_user.id}"
-                text = escape_markdown_v2(
-                    f"Користувач {mention} отримав мут на 24 години за використання забороненого слова.")
-                reply = await message.reply(text, parse_mode="MarkdownV2")
-                await safe_delete_message(message)
-                await asyncio.sleep(25)
-                await safe_delete_message(reply)
-            except TelegramBadRequest as e:
-                mention = await get_user_mention(message.from_user.id,
-                                                 message.chat.id) or f"User {message.from_user.id}"
-                error_text = escape_markdown_v2(f"Помилка при видачі мута для {mention}: {str(e)}")
-                reply = await bot.send_message(message.chat.id, error_text, parse_mode="MarkdownV2")
-                await safe_delete_message(message)
-                await asyncio.sleep(25)
-                await safe_delete_message(reply)
-            break
+    key = (chat_id, message.message_id)
+    digest = text_digest(text)
+    if scanned_message_hashes.get(key) == digest:
+        return
+    scanned_message_hashes.set(key, digest)
+    normalized = normalize_text(text)
+    match = classify_text(await get_chat_word_matcher(chat_id), normalized)
+    if match is not None:
+        word, start, end = match
+        logger.info(f"Заборонене слово '{word}' у chat_id={chat_id}: '{normalized.original_fragment(start, end)}'")
+        await apply_auto_mute(message, f"Використання забороненого слова: {word}", "використання забороненого слова")
+
+# Regex-правила чату; True, якщо правило спрацювало. Повідомлення видаляється одразу,
+# а покарання проходить через чергу ModerationTask, як і ручні команди
+async def apply_chat_rules(message: types.Message) -> bool:
+    chat_id = message.chat.id
+    result = (await get_chat_rule_set(chat_id)).match(extract_message_text(message))
+    if result is None or await has_moderator_privileges(message.from_user.id):
+        return False
+    rule, fragment = result
+    rule_hit_counts[rule.id] = rule_hit_counts.get(rule.id, 0) + 1
+    logger.info(f"Спрацювало правило {rule.id} у chat_id={chat_id}: '{fragment[:100]}'")
+    await safe_delete_message(message)
+    if rule.action != 'delete':
+        task = ModerationTask(
+            task_type=rule.action,
+            user_id=message.from_user.id,
+            username=message.from_user.username,
+            reason=f"Порушення правила чату #{rule.id}",
+            chat_id=chat_id,
+            moderator_id=None,
+            duration_minutes=rule.duration_minutes if rule.action == 'mute' else None
+        )
+        add_task_to_queue(task)
+    return True
+
+# Фільтр посилань; True, якщо повідомлення порушило правила і було оброблено
+async def apply_link_filter(message: types.Message) -> bool:
+    chat_id = message.chat.id
+    hosts = extract_link_hosts(message)
+    if not hosts:
+        return False
+    host = (await get_chat_domain_filter(chat_id)).first_blocked(hosts)
+    if host is None or await has_moderator_privileges(message.from_user.id):
+        return False
+    logger.info(f"Заборонене посилання на {host} у chat_id={chat_id}")
+    await apply_auto_mute(message, f"Заборонене посилання: {host}", "заборонене посилання")
+    return True
+
+# Автоматичний мут на 24 години від фільтрів: обмеження, запис покарання, видалення повідомлення
+async def apply_auto_mute(message: types.Message, reason: str, violation: str):
+    try:
+        mute_until = datetime.datetime.now() + datetime.timedelta(hours=24)
+        await bot.restrict_chat_member(
+            chat_id=message.chat.id,
+            user_id=message.from_user.id,
+            permissions=ChatPermissions(
+                can_send_messages=False,
+                can_send_media_messages=False,
+                can_send_polls=False,
+                can_send_other_messages=False
+            ),
+            until_date=mute_until
+        )
+        await log_punishment(
+            message.from_user.id, message.chat.id, "mute", reason, duration_minutes=24 * 60, moderator_id=None
+        )
+        await record_restriction(message.from_user.id, message.chat.id, reason, 24 * 60)
+        mention = f"@{message.from_user.username}" if message.from_user.username else f"ID\\:{message.from_user.id}"
+        text = escape_markdown_v2(f"Користувач {mention} отримав мут на 24 години за {violation}.")
+        reply = await message.reply(text, parse_mode="MarkdownV2")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
+    except TelegramBadRequest as e:
+        mention = await get_user_mention(message.from_user.id,
+                                         message.chat.id) or f"User {message.from_user.id}"
+        error_text = escape_markdown_v2(f"Помилка при видачі мута для {mention}: {str(e)}")
+        reply = await bot.send_message(message.chat.id, error_text, parse_mode="MarkdownV2")
+        await safe_delete_message(message)
+        await asyncio.sleep(25)
+        await safe_delete_message(reply)
 
 async def moderation_worker():
     while True:
@@ -1491,6 +4804,8 @@ async def moderation_worker():
                     await unmute_user_action(task)
                 elif task.task_type == 'unwarn':
                     await unwarn_user_action(task)
+                elif task.task_type in ('massban', 'massmute'):
+                    await mass_moderation_action(task)
             except Exception:
                 pass
         else:
@@ -1524,8 +4839,7 @@ async def ban_user_action(task: ModerationTask):
     # Бан у поточному чаті
     try:
         await bot.ban_chat_member(chat_id=chat_id, user_id=user_id, revoke_messages=True)
-        await add_ban(user_id, chat_id, reason)
-        await log_punishment(user_id, chat_id, "ban", reason, moderator_id=moderator_id)
+        await record_moderation_action("ban", user_id, chat_id, reason, moderator_id=moderator_id)
         text = escape_markdown_v2(f"Користувач {mention} забанений у цьому чаті. Причина: {reason}.")
         reply = await bot.send_message(chat_id=chat_id, text=text, parse_mode="MarkdownV2")
         logger.info(f"Забанено користувача: user_id={user_id}, username={username}, reason={reason}, chat_id={chat_id}")
@@ -1554,17 +4868,13 @@ async def ban_user_action(task: ModerationTask):
         if await is_user_in_chat(other_chat_id, user_id):
             try:
                 await bot.ban_chat_member(chat_id=other_chat_id, user_id=user_id, revoke_messages=True)
-                await add_ban(user_id, other_chat_id, f"Бан через команду в іншому чаті: {reason}")
-                await log_punishment(user_id, other_chat_id, "ban", f"Бан через команду в іншому чаті: {reason}", moderator_id=moderator_id)
+                await record_moderation_action("ban", user_id, other_chat_id,
+                                               f"Бан через команду в іншому чаті: {reason}", moderator_id=moderator_id)
                 logger.info(f"Забанено користувача {user_id} в чаті {other_chat_id} за причиною: {reason}")
 
                 # Відправка повідомлення в інший чат
-                chat_mention = f"ID\\:{other_chat_id}"
-                try:
-                    chat = await bot.get_chat(other_chat_id)
-                    chat_mention = f"@{chat.username}" if chat.username else f"{chat.title}"
-                except TelegramBadRequest as e:
-                    logger.warning(f"Не вдалося отримати інформацію про чат {other_chat_id}: {e}")
+                chat_info = await get_chat_info(other_chat_id)
+                chat_mention = f"@{chat_info.username}" if chat_info.username else chat_info.display_name()
 
                 text = escape_markdown_v2(f"Користувач {mention} забанений у чаті {chat_mention}. Причина: {reason}.")
                 await bot.send_message(chat_id=other_chat_id, text=text, parse_mode="MarkdownV2")
@@ -1576,6 +4886,84 @@ async def ban_user_action(task: ModerationTask):
 
     logger.info(f"ban_user_action: user_id={user_id}, chat_id={chat_id}")
 
+# Масовий бан (у всіх відомих чатах) або мут (у поточному чаті) одним пакетним завданням
+async def mass_moderation_action(task: ModerationTask):
+    user_ids = list(dict.fromkeys(task.user_ids or []))
+    is_ban = task.task_type == 'massban'
+    if task.targets:
+        pairs = list(dict.fromkeys((user_id, chat_id) for chat_id, user_id, _ in task.targets))
+        user_ids = list(dict.fromkeys(user_id for user_id, _ in pairs))
+        chat_ids = list(dict.fromkeys(chat_id for _, chat_id in pairs))
+    else:
+        chat_ids = [task.chat_id]
+        if is_ban:
+            chat_ids += [other_chat_id for other_chat_id in await get_known_bot_chats() if other_chat_id != task.chat_id]
+        pairs = [(user_id, chat_id) for user_id in user_ids for chat_id in chat_ids]
+    duration = task.duration_minutes or 60
+    mute_until = datetime.datetime.now() + datetime.timedelta(minutes=duration)
+    semaphore = asyncio.Semaphore(MASS_ACTION_CONCURRENCY)
+
+    async def apply(user_id: int, chat_id: int):
+        async with semaphore:
+            await api_rate_limiter.acquire()
+            if is_ban:
+                await bot.ban_chat_member(chat_id=chat_id, user_id=user_id, revoke_messages=True)
+            else:
+                await bot.restrict_chat_member(
+                    chat_id=chat_id,
+                    user_id=user_id,
+                    permissions=ChatPermissions(
+                        can_send_messages=False,
+                        can_send_media_messages=False,
+                        can_send_polls=False,
+                        can_send_other_messages=False
+                    ),
+                    until_date=mute_until
+                )
+
+    async def delete(chat_id: int, message_id: int):
+        async with semaphore:
+            await api_rate_limiter.acquire()
+            await bot.delete_message(chat_id=chat_id, message_id=message_id)
+
+    results = await asyncio.gather(*[apply(user_id, chat_id) for user_id, chat_id in pairs], return_exceptions=True)
+    if task.targets:
+        await asyncio.gather(*[delete(chat_id, message_id) for chat_id, _, message_id in task.targets if message_id],
+                             return_exceptions=True)
+    rows = []
+    for (user_id, chat_id), result in zip(pairs, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Помилка масової дії {task.task_type} для user_id={user_id} у чаті {chat_id}: {result}")
+            continue
+        reason = task.reason if chat_id == task.chat_id or not is_ban else f"Бан через команду в іншому чаті: {task.reason}"
+        rows.append([user_id, chat_id, reason])
+
+    if rows:
+        if not is_ban:
+            try:
+                expires_at = time.time() + duration * 60
+                redis_client.zadd(MUTES_EXPIRY_KEY, {restriction_member(user_id, chat_id): expires_at
+                                                     for user_id, chat_id, _ in rows})
+            except redis.RedisError as e:
+                logger.error(f"Помилка запису обмежень у Redis: {e}")
+        await execute_write('record_mass_action', 'ban' if is_ban else 'mute', rows, task.moderator_id,
+                            None if is_ban else duration, sticky_key=task.chat_id)
+
+    if is_ban:
+        action_text = f"Масовий бан у {len(chat_ids)} чатах"
+    elif len(chat_ids) > 1:
+        action_text = f"Масовий мут на {duration} хвилин у {len(chat_ids)} чатах"
+    else:
+        action_text = f"Масовий мут на {duration} хвилин"
+    text = escape_markdown_v2(
+        f"{action_text}: {len(user_ids)} користувачів. Успішно: {len(rows)}, помилок: {len(pairs) - len(rows)}. "
+        f"Причина: {task.reason}."
+    )
+    reply = await bot.send_message(task.chat_id, text, parse_mode="MarkdownV2")
+    logger.info(f"mass_moderation_action: type={task.task_type}, users={len(user_ids)}, chats={len(chat_ids)}, ok={len(rows)}")
+    await asyncio.sleep(25)
+    await safe_delete_message(reply)
+
 async def kick_user_action(task: ModerationTask):
     user_id = task.user_id
     username = task.username
@@ -1637,12 +5025,8 @@ async def kick_user_action(task: ModerationTask):
                 logger.info(f"Кікнуто користувача {user_id} з чату {other_chat_id} за причиною: {reason}")
 
                 # Відправка повідомлення в інший чат
-                chat_mention = f"ID\\:{other_chat_id}"
-                try:
-                    chat = await bot.get_chat(other_chat_id)
-                    chat_mention = f"@{chat.username}" if chat.username else f"{chat.title}"
-                except TelegramBadRequest as e:
-                    logger.warning(f"Не вдалося отримати інформацію про чат {other_chat_id}: {e}")
+                chat_info = await get_chat_info(other_chat_id)
+                chat_mention = f"@{chat_info.username}" if chat_info.username else chat_info.display_name()
 
                 text = escape_markdown_v2(f"Користувач {mention} кікнутий з чату {chat_mention}. Причина: {reason}.")
                 await bot.send_message(chat_id=other_chat_id, text=text, parse_mode="MarkdownV2")
@@ -1678,6 +5062,7 @@ async def mute_user_action(task: ModerationTask):
             until_date=mute_until
         )
         await log_punishment(user_id, chat_id, "mute", reason, duration_minutes=duration, moderator_id=moderator_id)
+        await record_restriction(user_id, chat_id, reason, duration, moderator_id=moderator_id)
         text = escape_markdown_v2(f"Користувач {mention} отримав мут на {duration} хвилин. Причина: {reason}.")
     except TelegramBadRequest as e:
         text = escape_markdown_v2(f"Не вдалося зам'ютити користувача: {e.message}")
@@ -1696,121 +5081,190 @@ async def warn_user_action(task: ModerationTask):
     moderator_id = task.moderator_id
     mention = f"@{username}" if username else f"ID\\:{user_id}"
 
-    warn_count = await add_warning(user_id, chat_id)
-    await log_punishment(user_id, chat_id, "warn", reason, moderator_id=moderator_id)
+    # Лічильник, попередження і (на порозі) кік записуються однією транзакцією
+    warn_count = await record_moderation_action("warn", user_id, chat_id, reason, moderator_id=moderator_id)
 
-    if warn_count >= 3:
+    if warn_count >= MAX_WARNINGS:
         try:
             await bot.ban_chat_member(chat_id=chat_id, user_id=user_id, revoke_messages=False)
-            await log_punishment(user_id, chat_id, "kick", "3 попередження", moderator_id=moderator_id)
-            text = escape_markdown_v2(f"Користувач {mention} отримав 3/3 попередження і кікнутий з чату. Причина: {reason}.")
+            text = escape_markdown_v2(f"Користувач {mention} отримав {MAX_WARNINGS}/{MAX_WARNINGS} попередження і кікнутий з чату. Причина: {reason}.")
         except TelegramBadRequest as e:
             text = escape_markdown_v2(f"Не вдалося кікнути користувача: {e.message}")
+    elif warn_count == 0:
+        # Redis недоступний: попередження залоговано, але лічильник невідомий
+        text = escape_markdown_v2(f"Користувач {mention} отримав попередження. Причина: {reason}.")
     else:
-        text = escape_markdown_v2(f"Користувач {mention} отримав попередження {warn_count}/3. Причина: {reason}.")
+        text = escape_markdown_v2(f"Користувач {mention} отримав попередження {warn_count}/{MAX_WARNINGS}. Причина: {reason}.")
     reply = await bot.send_message(chat_id, text, parse_mode="MarkdownV2")
     await asyncio.sleep(25)
     await safe_delete_message(reply)
     logger.info(f"warn_user_action: user_id={user_id}, warn_count={warn_count}, chat_id={chat_id}")
 
 
+# Статуси учасника для звіту /info
+INFO_STATUS_MAP = {
+    "creator": "👑 Власник",
+    "administrator": "🛡️ Адміністратор",
+    "member": "✅ Учасник",
+    "restricted": "🚫 Обмежений",
+    "left": "❌ Покинув чат",
+    "kicked": "🦵 Кікнутий"
+}
+
+# Виклик одного джерела даних для /info з обмеженням паралельності, rate limit і тайм-аутом
+async def call_info_source(factory, semaphore: asyncio.Semaphore):
+    async def limited():
+        async with semaphore:
+            await api_rate_limiter.acquire()
+            return await factory()
+    return await asyncio.wait_for(limited(), INFO_SOURCE_TIMEOUT)
+
+# Перевірка членства користувача в одному чаті: (назва чату, статус) або None
+async def fetch_chat_membership(chat_id: int, user_id: int, semaphore: asyncio.Semaphore):
+    chat_member = await call_info_source(
+        functools.partial(bot.get_chat_member, chat_id=chat_id, user_id=user_id), semaphore)
+    if chat_member.status in ["left", "kicked"]:
+        return None
+    if chat_member.status == "restricted" and not getattr(chat_member, 'is_member', True):
+        return None
+    info = chat_cache.get(chat_id)
+    if info is None or info.is_stale() or not (info.title or info.username):
+        info = await call_info_source(functools.partial(get_chat_info, chat_id), semaphore)
+    return info.display_name(), INFO_STATUS_MAP.get(chat_member.status, chat_member.status)
+
+PUNISHMENT_TYPE_LABELS = {
+    "kick": "🦵 Кік",
+    "ban": "🔨 Бан",
+    "warn": "⚠️ Попередження",
+    "mute": "🔇 Мут"
+}
+INFO_MESSAGE_LIMIT = 4096
+
+# Заголовки звітів /info для перегортання сторінок: (chat_id, message_id) -> рядки заголовка
+info_header_cache = TTLCache(1000, 10 * 60)
+
+# Згадки модераторів: один пакетний запит до telegramuser, промахи — паралельно через API
+async def resolve_moderator_mentions(moderator_ids: set, chat_id: int, semaphore: asyncio.Semaphore) -> dict[int, str]:
+    profiles = await load_user_profiles(moderator_ids)
+    unresolved = [moderator_id for moderator_id in moderator_ids if moderator_id not in profiles]
+    mention_results = await asyncio.gather(
+        *[call_info_source(functools.partial(get_user_mention, moderator_id, chat_id), semaphore)
+          for moderator_id in unresolved],
+        return_exceptions=True
+    )
+    moderator_mentions = {moderator_id: format_user_mention(profile) for moderator_id, profile in profiles.items()}
+    for moderator_id, mention in zip(unresolved, mention_results):
+        moderator_mentions[moderator_id] = mention if isinstance(mention, str) else f"ID: {moderator_id}"
+    return moderator_mentions
+
+# Сторінка історії покарань для /info: (рядки, клавіатура перегортання)
+async def render_punishment_history(user_id: int, chat_id: int, cursor: str | None = None, direction: str = 'next',
+                                    semaphore: asyncio.Semaphore | None = None):
+    semaphore = semaphore or asyncio.Semaphore(INFO_CONCURRENCY)
+    (punishments, next_cursor, prev_cursor), totals = await asyncio.gather(
+        get_punishments(user_id, chat_id, cursor, direction),
+        get_punishment_totals(user_id, chat_id)
+    )
+    if not punishments:
+        return ["✅ **Покарань не знайдено**"], None
+
+    moderator_ids = {p["moderator_id"] for p in punishments if isinstance(p["moderator_id"], int)}
+    moderator_mentions = await resolve_moderator_mentions(moderator_ids, chat_id, semaphore)
+
+    total = sum(totals.values()) or len(punishments)
+    lines = [f"⚖️ **Історія покарань \\({total}\\):**"]
+    if totals:
+        summary = ", ".join(f"{PUNISHMENT_TYPE_LABELS.get(t, t)}: {n}" for t, n in sorted(totals.items()))
+        lines.append(escape_markdown_v2(summary))
+    for p in punishments:
+        punishment_type = PUNISHMENT_TYPE_LABELS.get(p["type"], p["type"])
+        duration = f" \\({p['duration_minutes']} хвилин\\)" if p['duration_minutes'] else ""
+        moderator_id = p["moderator_id"]
+        if moderator_id is None or not isinstance(moderator_id, int):
+            moderator_mention = "Невідомий модератор"
+        else:
+            moderator_mention = moderator_mentions.get(moderator_id) or f"ID: {moderator_id}"
+        reason_escaped = escape_markdown_v2((p['reason'] or '')[:300])
+        moderator_escaped = escape_markdown_v2(str(moderator_mention))
+        timestamp_escaped = escape_markdown_v2(p['timestamp'])
+        lines.append(
+            f"{punishment_type}{duration}\nПричина: {reason_escaped}\nВидав: {moderator_escaped}\nДата: {timestamp_escaped}"
+        )
+
+    buttons = []
+    if prev_cursor:
+        buttons.append(types.InlineKeyboardButton(text="⬅️ Новіші", callback_data=f"info:prev:{user_id}:{prev_cursor}"))
+    if next_cursor:
+        buttons.append(types.InlineKeyboardButton(text="Старіші ➡️", callback_data=f"info:next:{user_id}:{next_cursor}"))
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return lines, keyboard
+
+# Складання тексту /info з урахуванням ліміту Telegram на довжину повідомлення
+def build_info_text(header_lines: list, history_lines: list) -> str:
+    text = '\n'.join(header_lines + history_lines)
+    while len(text) > INFO_MESSAGE_LIMIT and len(history_lines) > 1:
+        history_lines = history_lines[:-1]
+        text = '\n'.join(header_lines + history_lines)
+    return text
+
 async def info_user_action(task: ModerationTask):
     try:
-        async with telethon_client:
-            # 1. Отримати user_id по username
-            try:
-                user = await telethon_client.get_entity(task.username)
-                user_id = user.id
-                logger.info(f"Отримано user_id={user_id} для username={task.username}")
-            except ValueError as e:
-                reply_text = f"Користувач @{escape_markdown_v2(task.username)} не знайдений."
-                await bot.send_message(task.chat_id, reply_text, parse_mode="MarkdownV2")
-                return
-
-        # 2. Історія покарань саме для цього чату
-        punishments = await get_punishments(user_id, task.chat_id)
-        logger.info(f"Запитано історію покарань: user_id={user_id}, chat_id={task.chat_id}, знайдено {len(punishments)} записів")
+        # 1. Отримати user_id по username (локальний індекс, Telethon — тільки при промаху)
+        user_id = await resolve_username(task.username)
+        if user_id is None:
+            reply_text = f"Користувач @{escape_markdown_v2(task.username)} не знайдений."
+            await bot.send_message(task.chat_id, reply_text, parse_mode="MarkdownV2")
+            return
+        logger.info(f"Отримано user_id={user_id} для username={task.username}")
+
+        # 2-4. Перша сторінка історії покарань, статус у поточному чаті та членство в інших чатах — паралельно
+        semaphore = asyncio.Semaphore(INFO_CONCURRENCY)
+        bot_chats = await get_known_bot_chats()
+        other_chats = [other_chat_id for other_chat_id in bot_chats if other_chat_id != task.chat_id]
+        logger.info(f"Знайдено {len(other_chats)} інших чатів для перевірки членства")
+        history, current_member, *membership_results = await asyncio.gather(
+            render_punishment_history(user_id, task.chat_id, semaphore=semaphore),
+            call_info_source(functools.partial(bot.get_chat_member, chat_id=task.chat_id, user_id=user_id), semaphore),
+            *[fetch_chat_membership(other_chat_id, user_id, semaphore) for other_chat_id in other_chats],
+            return_exceptions=True
+        )
+        if isinstance(history, BaseException):
+            logger.error(f"Помилка отримання історії покарань: {history}")
+            history = (["✅ **Покарань не знайдено**"], None)
+        history_lines, keyboard = history
 
-        # 3. Членство у поточному чаті
         current_chat_status = "❌ Не є учасником"
-        status_map = {
-            "creator": "👑 Власник",
-            "administrator": "🛡️ Адміністратор",
-            "member": "✅ Учасник",
-            "restricted": "🚫 Обмежений",
-            "left": "❌ Покинув чат",
-            "kicked": "🦵 Кікнутий"
-        }
-        try:
-            chat_member = await bot.get_chat_member(chat_id=task.chat_id, user_id=user_id)
-            current_chat_status = status_map.get(chat_member.status, f"🔸 {chat_member.status}")
-        except TelegramBadRequest as e:
-            logger.warning(f"Користувач user_id={user_id} не є учасником чату {task.chat_id} або виникла помилка: {e}")
+        if isinstance(current_member, asyncio.TimeoutError):
+            current_chat_status = "⏳ Не вдалося перевірити"
+        elif isinstance(current_member, BaseException):
+            logger.warning(f"Користувач user_id={user_id} не є учасником чату {task.chat_id} або виникла помилка: {current_member}")
+        else:
+            current_chat_status = INFO_STATUS_MAP.get(current_member.status, f"🔸 {current_member.status}")
 
-        # 4. Членство в інших чатах
-        bot_chats = await get_bot_chats()
-        logger.info(f"Знайдено {len(bot_chats)} чатів для перевірки членства")
         chat_memberships = []
-        for other_chat_id in bot_chats:
-            if other_chat_id == task.chat_id:
-                continue
-            try:
-                if await is_user_in_chat(other_chat_id, user_id):
-                    # Статус
-                    try:
-                        chat_member = await bot.get_chat_member(chat_id=other_chat_id, user_id=user_id)
-                        status = status_map.get(chat_member.status, chat_member.status)
-                    except:
-                        status = "✅ Учасник"
-                    # Назва чату
-                    chat_name = f"ID: {other_chat_id}"
-                    try:
-                        chat_info = await bot.get_chat(other_chat_id)
-                        if hasattr(chat_info, "title") and chat_info.title:
-                            chat_name = chat_info.title
-                        elif hasattr(chat_info, "username") and chat_info.username:
-                            chat_name = f"@{chat_info.username}"
-                    except:
-                        pass
-                    chat_memberships.append(f"• {escape_markdown_v2(chat_name)} \\- {status}")
-                await asyncio.sleep(0.5)
-            except Exception as e:
-                logger.error(f"Помилка при перевірці членства в чаті {other_chat_id}: {e}")
-                continue
-
-        # 5. Формування історії покарань
-        punishment_list = []
-        for p in punishments:
-            punishment_type = {
-                "kick": "🦵 Кік",
-                "ban": "🔨 Бан",
-                "warn": "⚠️ Попередження",
-                "mute": "🔇 Мут"
-            }.get(p["type"], p["type"])
-            duration = f" \\({p['duration_minutes']} хвилин\\)" if p['duration_minutes'] else ""
-            moderator_id = p["moderator_id"]
-            if moderator_id is None or not isinstance(moderator_id, int):
-                moderator_mention = "Невідомий модератор"
-            else:
-                moderator_mention = await get_user_mention(moderator_id, task.chat_id) or f"ID: {moderator_id}"
-            reason_escaped = escape_markdown_v2(p['reason'])
-            moderator_escaped = escape_markdown_v2(str(moderator_mention))
-            timestamp_escaped = escape_markdown_v2(p['timestamp'])
-            punishment_text = (
-                f"{punishment_type}{duration}\nПричина: {reason_escaped}\nВидав: {moderator_escaped}\nДата: {timestamp_escaped}"
-            )
-            punishment_list.append(punishment_text)
-
-        # 6. Формування повідомлення
+        timed_out_chats = 0
+        for other_chat_id, result in zip(other_chats, membership_results):
+            if isinstance(result, asyncio.TimeoutError):
+                timed_out_chats += 1
+                logger.warning(f"Тайм-аут перевірки членства в чаті {other_chat_id}")
+            elif isinstance(result, BaseException):
+                logger.error(f"Помилка при перевірці членства в чаті {other_chat_id}: {result}")
+            elif result is not None:
+                chat_name, status = result
+                chat_memberships.append(f"• {escape_markdown_v2(chat_name)} \\- {status}")
+
+        # 5. Формування повідомлення
         escaped_username = escape_markdown_v2(task.username)
         chat_count = len(chat_memberships)
-        punishment_count = len(punishment_list)
         user_info = [
             f"👤 **Інформація про користувача @{escaped_username}**",
             f"🆔 **User ID:** `{user_id}`",
             f"📍 **Статус у цьому чаті:** {current_chat_status}",
-            ""
         ]
+        mute_expires_at = get_active_restriction(user_id, task.chat_id)
+        if mute_expires_at is not None:
+            user_info.append(f"🔇 **Мут до:** {escape_markdown_v2(mute_expires_at.strftime('%Y-%m-%d %H:%M'))} UTC")
+        user_info.append("")
         if chat_memberships:
             user_info.extend([
                 f"🌐 **Членство в інших каналах/чатах \\({chat_count}\\):**",
@@ -1822,16 +5276,15 @@ async def info_user_action(task: ModerationTask):
                 "🌐 **Не є учасником інших відомих каналів/чатів**",
                 ""
             ])
-        if punishment_list:
+        if timed_out_chats:
             user_info.extend([
-                f"⚖️ **Історія покарань \\({punishment_count}\\):**",
-                *punishment_list
+                f"⏳ **Частковий звіт:** {timed_out_chats} чатів не відповіли вчасно",
+                ""
             ])
-        else:
-            user_info.append("✅ **Покарань не знайдено**")
 
-        text = '\n'.join(user_info)
-        reply = await bot.send_message(task.chat_id, text, parse_mode="MarkdownV2")
+        text = build_info_text(user_info, history_lines)
+        reply = await bot.send_message(task.chat_id, text, parse_mode="MarkdownV2", reply_markup=keyboard)
+        info_header_cache.set((task.chat_id, reply.message_id), user_info)
         logger.info(f"Надіслано інформацію про користувача: user_id={user_id}, username={task.username}, chat_id={task.chat_id}")
         await asyncio.sleep(45)
         await safe_delete_message(reply)
@@ -1841,6 +5294,28 @@ async def info_user_action(task: ModerationTask):
         text = escape_markdown_v2(f"Помилка при отриманні info: {str(e)}")
         await bot.send_message(task.chat_id, text, parse_mode="MarkdownV2")
 
+# Перегортання сторінок історії покарань у повідомленні /info
+@dp.callback_query(F.data.startswith('info:'))
+async def info_page_callback(callback: types.CallbackQuery):
+    if not await has_moderator_privileges(callback.from_user.id):
+        await callback.answer("Ви не маєте прав для виконання цієї команди.", show_alert=True)
+        return
+    try:
+        _, direction, user_id, cursor = callback.data.split(':', 3)
+        user_id = int(user_id)
+    except ValueError:
+        await callback.answer()
+        return
+    chat_id = callback.message.chat.id
+    header = info_header_cache.get((chat_id, callback.message.message_id)) or [f"🆔 **User ID:** `{user_id}`", ""]
+    history_lines, keyboard = await render_punishment_history(user_id, chat_id, cursor, direction)
+    try:
+        await callback.message.edit_text(build_info_text(header, history_lines), parse_mode="MarkdownV2",
+                                         reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        logger.warning(f"Не вдалося оновити сторінку /info: {e}")
+    await callback.answer()
+
 async def unban_user_action(task):
     try:
         await bot.unban_chat_member(chat_id=task.chat_id, user_id=task.user_id)
@@ -1871,42 +5346,67 @@ async def unmute_user_action(task):
         await bot.send_message(task.chat_id, f"Не вдалося зняти мут: {e.message}")
 
 async def unwarn_user_action(task):
-    warn_count = await remove_warning(task.user_id, task.chat_id)
+    warn_count = remove_warning(task.user_id, task.chat_id)
     mention = f"@{task.username}" if task.username else f"ID\\:{task.user_id}"
-    if warn_count >= 0:
-        text = escape_markdown_v2(f"Знято попередження з користувача {mention}. Залишилось {warn_count}/3.")
+    if warn_count is None:
+        await bot.send_message(task.chat_id, "Не вдалося зняти попередження: сховище лічильників недоступне. Спробуйте пізніше.")
+    elif warn_count >= 0:
+        text = escape_markdown_v2(f"Знято попередження з користувача {mention}. Залишилось {warn_count}/{MAX_WARNINGS}.")
         await bot.send_message(task.chat_id, text, parse_mode="MarkdownV2")
     else:
         text = escape_markdown_v2(f"У користувача {mention} немає попереджень.")
         await bot.send_message(task.chat_id, text, parse_mode="MarkdownV2")
 
-async def update_all_chat_titles(bot):
-    ssl_context = ssl.create_default_context(cafile=certifi.where())
-    if DB_SSLMODE == 'require':
-        ssl_context.check_hostname = True
-        ssl_context.verify_mode = ssl.CERT_REQUIRED
-    conn = await asyncpg.connect(
-        host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-        ssl=ssl_context if DB_SSLMODE == 'require' else None
-    )
+# Атомарно забирає всі обмеження, що закінчилися: кожне отримує рівно один воркер
+CLAIM_EXPIRED_MUTES_SCRIPT = redis_client.register_script('''
+    local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+    if #due > 0 then
+        redis.call('ZREM', KEYS[1], unpack(due))
+    end
+    return due
+''')
+
+# Планувальник закінчення мутів: прибирає реєстр і повідомляє чат
+async def mute_expiry_worker():
+    while True:
+        await asyncio.sleep(MUTE_EXPIRY_POLL_INTERVAL)
+        try:
+            due = CLAIM_EXPIRED_MUTES_SCRIPT(keys=[MUTES_EXPIRY_KEY], args=[time.time(), 500])
+        except redis.RedisError as e:
+            logger.error(f"Помилка отримання мутів, що закінчилися: {e}")
+            continue
+        for member in due:
+            chat_id, user_id = (int(part) for part in member.split(':'))
+            await execute_write('expire_restriction', user_id, chat_id)
+            try:
+                mention = await get_user_mention(user_id, chat_id) or f"ID\\:{user_id}"
+                await bot.send_message(chat_id, f"⏰ Мут користувача {mention} закінчився\\.", parse_mode="MarkdownV2")
+            except TelegramBadRequest as e:
+                logger.warning(f"Не вдалося повідомити про закінчення мута user_id={user_id} у чаті {chat_id}: {e}")
+            logger.info(f"Мут закінчився: user_id={user_id}, chat_id={chat_id}")
 
-    rows = await conn.fetch("SELECT chat_id FROM chat_settings")
-    for row in rows:
-        chat_id = row['chat_id']
+# Оновлення метаданих чатів, у яких закінчився TTL кешу
+async def update_all_chat_titles(bot):
+    for chat_id, info in list(chat_cache.items()):
+        if not info.is_stale():
+            continue
         try:
             chat = await bot.get_chat(chat_id)
-            chat_title = chat.title
-            if chat_title:  # Обновляем только если есть название!
-                await conn.execute(
-                    "UPDATE chat_settings SET chat_title = $1 WHERE chat_id = $2",
-                    chat_title, chat_id
-                )
+            await remember_chat(chat)
         except Exception as e:
-            print(f"Не удалось получить название для {chat_id}: {e}")
+            logger.warning(f"Не вдалося отримати назву для {chat_id}: {e}")
 
-    await conn.close()
+# Фонове оновлення кешу чатів за TTL
+async def chat_cache_refresher():
+    while True:
+        await asyncio.sleep(max(60, CHAT_CACHE_TTL // 4))
+        try:
+            await update_all_chat_titles(bot)
+        except Exception as e:
+            logger.error(f"Помилка оновлення кешу чатів: {e}")
 
 async def main():
+    write_spool.open()
     await init_db()
     try:
         if telethon_client:
@@ -1930,9 +5430,21 @@ async def main():
         except TelegramBadRequest as e:
             logger.error(f"Помилка перевірки прав бота: {e}")
 
+        await load_chat_cache()
+        await load_username_index()
+        await reconcile_warnings()
+        await load_restrictions()
         await update_all_chat_titles(bot)
         await ensure_all_chats_in_settings()
         asyncio.create_task(moderation_worker())
+        asyncio.create_task(chat_cache_refresher())
+        asyncio.create_task(punishment_partition_maintainer())
+        asyncio.create_task(spool_replayer())
+        asyncio.create_task(warning_mirror())
+        asyncio.create_task(mute_expiry_worker())
+        asyncio.create_task(stats_maintainer())
+        asyncio.create_task(forbidden_words_watcher())
+        asyncio.create_task(flood_sweeper())
 
         await dp.start_polling(bot)
     except Exception as e:
@@ -1942,5 +5454,37 @@ async def main():
         if telethon_client and telethon_client.is_connected():
             await telethon_client.disconnect()
 
+# Розбір дати для CLI
+def parse_cli_date(value: str) -> datetime.datetime:
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"очікується дата YYYY-MM-DD: {value}")
+
+# Точка входу: без аргументів запускає бота, `python bot.py export ...` експортує історію покарань
+def run_cli(argv: list) -> int:
+    parser = argparse.ArgumentParser(prog='bot.py')
+    subparsers = parser.add_subparsers(dest='command')
+    export_parser = subparsers.add_parser('export', help='Експорт історії покарань у стиснений CSV/JSONL')
+    export_parser.add_argument('--chat', type=int, help='ID чату (за замовчуванням усі чати)')
+    export_parser.add_argument('--moderator', type=int, help='ID модератора')
+    export_parser.add_argument('--from', dest='since', type=parse_cli_date, help='Початкова дата YYYY-MM-DD')
+    export_parser.add_argument('--to', dest='until', type=parse_cli_date, help='Кінцева дата YYYY-MM-DD (включно)')
+    export_parser.add_argument('--format', choices=('csv', 'jsonl'), default='csv')
+    export_parser.add_argument('--output', help='Шлях до файлу .gz')
+    args = parser.parse_args(argv)
+
+    if args.command != 'export':
+        asyncio.run(main())
+        return 0
+    until = args.until + datetime.timedelta(days=1) if args.until else None
+    result = asyncio.run(export_punishments(args.format, args.chat, args.moderator, args.since, until, args.output))
+    if result is None:
+        print("Не вдалося експортувати історію покарань.", file=sys.stderr)
+        return 1
+    path, rows = result
+    print(f"Експортовано {rows} записів: {path}")
+    return 0
+
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    sys.exit(run_cli(sys.argv[1:]))
\ No newline at end of file
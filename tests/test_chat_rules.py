@@ -0,0 +1,49 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+
+import bot  # noqa: E402
+
+
+def make_rule(rule_id, pattern, action='delete', priority=0):
+    return bot.ChatRule(id=rule_id, pattern=pattern, action=action, priority=priority)
+
+
+def test_rules_are_combined_into_one_pattern():
+    rule_set = bot.ChatRuleSet([make_rule(1, r'spam'), make_rule(2, r'(?i)casino')])
+    assert rule_set.pattern.pattern == r'(?=(?P<rule_1>spam))|(?=(?P<rule_2>(?i:casino)))'
+    assert rule_set.match("CASINO тут")[0].id == 2
+    assert rule_set.match("SPAM") is None
+    assert rule_set.match("звичайний текст") is None
+
+
+def test_backreferences_are_renumbered():
+    rule_set = bot.ChatRuleSet([make_rule(1, r'(a)(b)\2', priority=2), make_rule(2, r'(\w)\1{3}', priority=1)])
+    assert rule_set.match("abb")[0].id == 1
+    rule, fragment = rule_set.match("ааааа")
+    assert rule.id == 2 and fragment == "аааа"
+    assert rule_set.match("ab ab") is None
+
+
+def test_higher_priority_rule_wins_over_earlier_match():
+    rule_set = bot.ChatRuleSet([
+        make_rule(1, r'call \d+', action='warn', priority=2),
+        make_rule(2, r'\d{3}-\d{4}', action='ban', priority=3),
+    ])
+    rule, fragment = rule_set.match("call 555-1234")
+    assert rule.id == 2 and fragment == "555-1234"
+    assert rule_set.match("call 555")[0].id == 1
+
+
+def test_catastrophic_patterns_are_rejected():
+    for pattern in [r'(a+)+$', r'(\w+\s?)*', r'((ab)*c)+', r'(?:x+y){2,}', r'(a|a)*', r'(\w|\d)+', r'(a|)+']:
+        assert bot.validate_rule_pattern(pattern) is not None, pattern
+    for pattern in [r'\+?380\d{9}', r'(a|b)+', r'(foo|bar)+', r'([+*])+', r'(a+)?', r'[(]a+[)]+', r'(?i)spam']:
+        assert bot.validate_rule_pattern(pattern) is None, pattern
+
+
+def test_rejected_stored_rules_are_skipped():
+    rule_set = bot.ChatRuleSet([make_rule(1, r'(a|a)*$'), make_rule(2, r'spam')])
+    assert rule_set.pattern.pattern == r'(?=(?P<rule_2>spam))'
@@ -0,0 +1,71 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+
+import bot  # noqa: E402
+
+
+# Рядки файлу blocked_domains.txt: домен, виняток для піддомену, лише піддомени, запрошення Telegram
+DOMAIN_LINES = ["example.com", "!shop.example.com", "*.ads.net  # реклама", "+.t.me"]
+
+
+def make_trie():
+    return bot.DomainTrie(bot.parse_domain_rule(line) for line in DOMAIN_LINES)
+
+
+def test_domain_rule_blocks_domain_and_subdomains():
+    trie = make_trie()
+    assert trie.lookup("example.com") == "block"
+    assert trie.lookup("www.EXAMPLE.com.") == "block"
+    assert trie.lookup("a.b.example.com") == "block"
+
+
+def test_suffix_is_not_a_subdomain():
+    trie = make_trie()
+    assert trie.lookup("badexample.com") is None
+    assert trie.lookup("example.com.evil.org") is None
+    assert trie.lookup("com") is None
+
+
+def test_wildcard_rule_matches_only_subdomains():
+    trie = make_trie()
+    assert trie.lookup("ads.net") is None
+    assert trie.lookup("x.ads.net") == "block"
+    assert trie.lookup("a.b.ads.net") == "block"
+
+
+def test_deepest_rule_wins():
+    trie = make_trie()
+    assert trie.lookup("shop.example.com") == "allow"
+    assert trie.lookup("cdn.shop.example.com") == "allow"
+
+
+def test_chat_rules_override_global_list():
+    domain_filter = bot.ChatDomainFilter(make_trie(), [("example.com", "allow"), ("spam.org", "block")])
+    assert domain_filter.first_blocked(["example.com", "t.me"]) is None
+    assert domain_filter.first_blocked(["ok.org", "www.spam.org"]) == "www.spam.org"
+    assert domain_filter.first_blocked([bot.TELEGRAM_INVITE_HOST]) == bot.TELEGRAM_INVITE_HOST
+
+
+def test_domain_rule_parsing():
+    assert bot.parse_domain_rule("# коментар") is None
+    assert bot.parse_domain_rule("  \n") is None
+    assert bot.parse_domain_rule("!Shop.Example.com\n") == ("shop.example.com", "allow")
+
+
+def make_message(text, urls):
+    entities = []
+    for url in urls:
+        offset = text.index(url)
+        entities.append(bot.types.MessageEntity(type='url', offset=len(text[:offset].encode('utf-16-le')) // 2,
+                                                length=len(url.encode('utf-16-le')) // 2))
+    return bot.types.Message(message_id=1, date=0, chat=bot.types.Chat(id=-100, type='supergroup'),
+                             text=text, entities=entities)
+
+
+def test_invite_links_get_their_own_host():
+    urls = ["https://t.me/+AbCdEf", "t.me/joinchat/XyZ", "https://t.me/quantrp", "WWW.Example.com/path"]
+    message = make_message("Заходьте 👉 " + " і ".join(urls), urls)
+    assert bot.extract_link_hosts(message) == [bot.TELEGRAM_INVITE_HOST, bot.TELEGRAM_INVITE_HOST, "t.me", "www.example.com"]
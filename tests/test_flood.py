@@ -0,0 +1,49 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+
+import bot  # noqa: E402
+
+
+
+def test_flood_triggers_when_limit_fits_in_window():
+    detector = bot.FloodDetector(100)
+    assert not any(detector.record(1, 10, 3, 5, now=100.0 + i) for i in range(2))
+    assert detector.record(1, 10, 3, 5, now=102.0)
+
+
+def test_messages_outside_window_expire():
+    detector = bot.FloodDetector(100)
+    for now in [100.0, 104.0, 108.0, 112.0, 116.0]:
+        assert not detector.record(1, 10, 3, 5, now=now)
+    assert not detector.record(1, 10, 3, 5, now=119.0)
+    assert detector.record(1, 10, 3, 5, now=120.0)
+
+
+def test_buffer_resets_after_trigger():
+    detector = bot.FloodDetector(100)
+    for i in range(3):
+        detector.record(1, 10, 3, 5, now=100.0 + i)
+    assert not detector.record(1, 10, 3, 5, now=103.0)
+    assert not detector.record(1, 10, 3, 5, now=103.5)
+    assert detector.record(1, 10, 3, 5, now=104.0)
+
+
+def test_users_and_chats_are_tracked_separately():
+    detector = bot.FloodDetector(100)
+    assert not detector.record(1, 10, 2, 5, now=100.0)
+    assert not detector.record(1, 11, 2, 5, now=100.5)
+    assert not detector.record(2, 10, 2, 5, now=101.0)
+    assert detector.record(1, 10, 2, 5, now=101.5)
+
+
+def test_tracked_buffers_are_bounded_and_swept(monkeypatch):
+    detector = bot.FloodDetector(2)
+    monkeypatch.setattr(bot.time, 'monotonic', lambda: 1000.0)
+    for user_id in range(3):
+        detector.record(1, user_id, 3, 5, now=990.0 + user_id)
+    assert list(detector.buffers) == [(1, 1), (1, 2)]
+    assert detector.sweep(8.5) == 1
+    assert list(detector.buffers) == [(1, 2)]
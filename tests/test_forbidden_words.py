@@ -0,0 +1,68 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+
+import bot  # noqa: E402
+
+FORBIDDEN_WORDS_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'forbidden_words.txt')
+
+# Звичайний український текст, у якому фільтр не повинен знаходити заборонених слів
+UKRAINIAN_TEXT = [
+    "Привіт усім! Ось список правил чату, прочитайте його уважно.",
+    "У мене є підозра, що сервер сьогодні перезавантажать.",
+    "Підозрілий гравець знову зайшов у гру, підозрюваний уже в бані.",
+    "я і ти підемо на подію о сьомій вечора",
+    "Дякую за допомогу, адміністрація відповіла дуже швидко.",
+    "Підкажіть, будь ласка, де знайти розклад подій на тиждень?",
+    "Сьогодні оновлення 2024р. о 10:30, тривалість 15хв.",
+    "Піду подивлюсь, чи працює пошта, потім напишу в особисті.",
+    "Підписуйтесь на наш канал новин проєкту QUANT RP.",
+    "Поліція затримала порушника біля лікарні на проспекті.",
+    "Продаю машину? Ні, продаж заборонений правилами, пам'ятайте.",
+    "Хто піде з нами в рейд на пустелю після обіду?",
+    "Спасибі, друзі, гарної гри та приємного спілкування!",
+    "Депутат, педагог і підприємець обговорили бюджет громади.",
+    "Скриншот прикріпив до повідомлення, перевірте, будь ласка.",
+]
+
+# Замасковані варіанти заборонених слів, які фільтр має знаходити
+OBFUSCATED_WORDS = ["пiдор", "p1dor", "п е д и к", "eблaн", "ПИДОРАС", "п.е.д.и.к"]
+
+
+def make_matcher():
+    return bot.ForbiddenWordMatcher(bot.load_forbidden_words(FORBIDDEN_WORDS_FILE))
+
+
+def test_ukrainian_text_has_no_hits():
+    matcher = make_matcher()
+    for text in UKRAINIAN_TEXT:
+        assert matcher.find(bot.normalize_text(text)) is None, text
+
+
+def test_obfuscated_words_are_found():
+    matcher = make_matcher()
+    for text in OBFUSCATED_WORDS:
+        assert matcher.find(bot.normalize_text(text)) is not None, text
+
+
+def test_short_words_are_not_joined():
+    assert bot.normalize_text("я і ти").text == "я и ти"
+    assert bot.normalize_text("п е д и к").text == "педик"
+
+
+def test_cyrillic_r_is_not_folded_into_p():
+    assert bot.normalize_text("Привіт").text == "привит"
+
+
+def test_chat_matchers_share_the_global_base():
+    base = bot.ForbiddenWordMatcher({"педик", "ебан"})
+    first = bot.ChatWordMatcher(base, ["котик"], ["педик"])
+    second = bot.ChatWordMatcher(base, ["песик"], [])
+    assert first.base is base and second.base is base
+    assert first.extra.words == {"котик"}
+    assert first.find(bot.normalize_text("ти педик")) is None
+    assert first.find(bot.normalize_text("педик і котик"))[0] == "котик"
+    assert first.find(bot.normalize_text("педик, ебан"))[0] == "ебан"
+    assert second.find(bot.normalize_text("ти педик"))[0] == "педик"
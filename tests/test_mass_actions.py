@@ -0,0 +1,25 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+
+import bot  # noqa: E402
+
+
+def test_duration_units():
+    assert bot.parse_mute_duration("30m") == 30
+    assert bot.parse_mute_duration("2h") == 120
+    assert bot.parse_mute_duration("7D") == 7 * 24 * 60
+
+
+def test_duration_requires_a_unit():
+    for token in ["30", "123456789", "", "m", "1.5h", "-5m", "10w", "5 m"]:
+        assert bot.parse_mute_duration(token) is None, token
+
+
+def test_duration_bounds():
+    assert bot.parse_mute_duration("0m") is None
+    assert bot.parse_mute_duration("366d") == bot.MUTE_DURATION_MAX_MINUTES
+    assert bot.parse_mute_duration("367d") is None
+    assert bot.parse_mute_duration("1234567m") is None
@@ -0,0 +1,27 @@
+import datetime
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+
+import bot  # noqa: E402
+
+
+
+def test_cursor_round_trip():
+    for timestamp, row_id in [
+        (datetime.datetime(2024, 5, 1, 12, 30, 15, 123456), 42),
+        (datetime.datetime(1970, 1, 1), 1),
+        (datetime.datetime(1969, 12, 31, 23, 59, 59, 999999), 7),
+        (datetime.datetime(2099, 12, 31, 23, 59, 59), 2 ** 62),
+    ]:
+        cursor = bot.encode_punishment_cursor(timestamp, row_id)
+        assert bot.decode_punishment_cursor(cursor) == (timestamp, row_id)
+
+
+def test_cursor_keeps_keyset_order():
+    first = datetime.datetime(2024, 5, 1, 12, 0)
+    cursors = [(first, 5), (first, 6), (first + datetime.timedelta(microseconds=1), 1)]
+    decoded = [bot.decode_punishment_cursor(bot.encode_punishment_cursor(*cursor)) for cursor in cursors]
+    assert decoded == sorted(decoded) == cursors
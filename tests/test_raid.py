@@ -0,0 +1,69 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+
+import bot  # noqa: E402
+
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def setup_raid(monkeypatch):
+    clock, queued, notices = Clock(1000.0), [], []
+
+    async def send_message(chat_id, text, **kwargs):
+        notices.append((chat_id, text))
+
+    async def raid_monitor(chat_id):
+        pass
+
+    monkeypatch.setattr(bot.time, 'monotonic', clock)
+    monkeypatch.setattr(bot, 'raid_states', {})
+    monkeypatch.setattr(bot, 'RAID_LOCKDOWN', False)
+    monkeypatch.setattr(bot, 'queue_for_review', lambda chat_id, user_ids: queued.append(list(user_ids)))
+    monkeypatch.setattr(bot, 'raid_monitor', raid_monitor)
+    monkeypatch.setattr(bot.bot, 'send_message', send_message)
+    return clock, queued, notices
+
+
+def test_raid_starts_when_limit_joins_fit_in_window(monkeypatch):
+    clock, queued, notices = setup_raid(monkeypatch)
+
+    async def scenario():
+        results = []
+        for user_id in range(bot.RAID_JOIN_LIMIT + 1):
+            results.append(await bot.register_join(-100, user_id))
+            clock.now += 1
+        return results
+
+    results = asyncio.run(scenario())
+    assert results == [False] * (bot.RAID_JOIN_LIMIT - 1) + [True, True]
+    assert queued == [list(range(bot.RAID_JOIN_LIMIT)), [bot.RAID_JOIN_LIMIT]]
+    assert len(notices) == 1
+    state = bot.raid_states[-100]
+    assert state.active and state.pending_welcomes == 2
+
+
+def test_joins_outside_window_do_not_start_a_raid(monkeypatch):
+    clock, queued, notices = setup_raid(monkeypatch)
+    step = bot.RAID_JOIN_WINDOW / (bot.RAID_JOIN_LIMIT - 1) + 0.1
+
+    async def scenario():
+        results = []
+        for user_id in range(bot.RAID_JOIN_LIMIT * 3):
+            results.append(await bot.register_join(-100, user_id))
+            clock.now += step
+        return results
+
+    assert not any(asyncio.run(scenario()))
+    assert queued == [] and notices == []
+    assert len(bot.raid_states[-100].joins) < bot.RAID_JOIN_LIMIT
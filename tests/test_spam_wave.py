@@ -0,0 +1,53 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+
+import bot  # noqa: E402
+
+SPAM_TEXT = "Безкоштовні донат-кейси для всіх гравців QUANT RP, переходьте за посиланням у профілі та забирайте бонус"
+
+# Варіації розсилки, які спамери роблять, щоб обійти точне порівняння
+NEAR_DUPLICATES = [SPAM_TEXT + "!", "🔥 " + SPAM_TEXT, SPAM_TEXT.upper(), SPAM_TEXT.replace(",", ""), SPAM_TEXT[:-1]]
+
+
+def fingerprint(text):
+    return bot.simhash(bot.normalize_text(text).text)
+
+
+def share_band(first, second):
+    return any(a == b for a, b in zip(bot.simhash_bands(first), bot.simhash_bands(second)))
+
+
+def test_near_duplicates_share_a_band():
+    original = fingerprint(SPAM_TEXT)
+    for text in NEAR_DUPLICATES:
+        other = fingerprint(text)
+        assert bot.simhash_distance(original, other) <= bot.SPAM_WAVE_MAX_DISTANCE, text
+        assert share_band(original, other), text
+
+
+def test_unrelated_text_is_far():
+    other = fingerprint("Хто піде з нами в рейд на пустелю після обіду? Збір біля лікарні о сьомій вечора.")
+    assert bot.simhash_distance(fingerprint(SPAM_TEXT), other) > bot.SPAM_WAVE_MAX_DISTANCE
+
+
+def test_fingerprints_within_distance_share_a_band():
+    rng = random.Random(0)
+    for _ in range(500):
+        value = rng.getrandbits(bot.SIMHASH_BITS)
+        other = value
+        for bit in rng.sample(range(bot.SIMHASH_BITS), bot.SPAM_WAVE_MAX_DISTANCE):
+            other ^= 1 << bit
+        assert bot.simhash_distance(value, other) == bot.SPAM_WAVE_MAX_DISTANCE
+        assert share_band(value, other)
+
+
+def test_bands_cover_the_fingerprint():
+    value = fingerprint(SPAM_TEXT)
+    bands = bot.simhash_bands(value)
+    assert len(bands) == bot.SIMHASH_BANDS
+    assert sum(band << (index * bot.SIMHASH_BAND_BITS) for index, band in enumerate(bands)) == value
+
@@ -0,0 +1,61 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+
+import bot  # noqa: E402
+
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = bot.TTLCache(2, 60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = Clock(1000.0)
+    monkeypatch.setattr(bot.time, 'monotonic', clock)
+    cache = bot.TTLCache(10, 60)
+    cache.set('a', 1)
+    clock.now += 59
+    assert cache.get('a') == 1
+    clock.now += 2
+    assert 'a' not in cache
+    assert cache.get('a', 'missing') == 'missing'
+    assert len(cache) == 0
+
+
+def test_set_refreshes_ttl_and_counts_lookups(monkeypatch):
+    clock = Clock(1000.0)
+    monkeypatch.setattr(bot.time, 'monotonic', clock)
+    cache = bot.TTLCache(10, 60)
+    cache.set('a', 1)
+    clock.now += 50
+    cache.set('a', 2)
+    clock.now += 50
+    assert cache.get('a') == 2
+    assert cache.get('b') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_falsy_values_are_cached():
+    cache = bot.TTLCache(10, 60)
+    cache.set('zero', 0)
+    assert cache.get('zero', 'missing') == 0
+    assert cache.pop('zero') == 0
+    assert cache.pop('zero', 'missing') == 'missing'
@@ -0,0 +1,110 @@
+import asyncio
+import contextlib
+import datetime
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+
+import bot  # noqa: E402
+
+AT = datetime.datetime(2024, 5, 1, 12, 0)
+
+
+# З'єднання, яке пам'ятає застосовані id журналу, як таблиця spool_applied
+class FakeConnection:
+    def __init__(self, applied):
+        self.applied = applied
+
+    @contextlib.asynccontextmanager
+    async def _transaction(self):
+        yield
+
+    def transaction(self):
+        return self._transaction()
+
+    async def fetchval(self, sql, record_id):
+        assert sql == bot.SPOOL_APPLIED_SQL
+        if record_id in self.applied:
+            return None
+        self.applied.add(record_id)
+        return True
+
+    async def execute(self, sql, *args):
+        return 'DELETE 0'
+
+    async def close(self):
+        pass
+
+
+def make_spool(tmp_path, count):
+    spool = bot.WriteSpool(str(tmp_path / 'spool.bin'))
+
+    async def fill():
+        for number in range(count):
+            spool.append('test_write', AT, (number,))
+        spool.sync()
+
+    asyncio.run(fill())
+    return spool
+
+
+def test_torn_tail_is_truncated(tmp_path):
+    spool = make_spool(tmp_path, 3)
+    size = os.path.getsize(spool.path)
+    payloads = [payload for _, payload in spool.records()]
+    spool.file.close()
+    with open(spool.path, 'ab') as f:
+        f.write(bot.WriteSpool.HEADER.pack(100) + b'{"op": "te')
+    reopened = bot.WriteSpool(spool.path)
+    reopened.open()
+    assert os.path.getsize(spool.path) == size
+    assert reopened.pending == 3
+    assert [payload for _, payload in reopened.records()] == payloads
+
+
+def test_commit_advances_offset_and_truncates_when_empty(tmp_path):
+    spool = make_spool(tmp_path, 3)
+    offsets = [offset for offset, _ in spool.records()]
+    spool.commit(offsets[1], 2)
+    assert spool.pending == 1
+    assert spool.read_offset() == offsets[1]
+    assert len(list(spool.records())) == 1
+    spool.commit(offsets[2])
+    assert spool.pending == 0
+    assert spool.read_offset() == 0
+    assert os.path.getsize(spool.path) == 0
+
+
+def test_replay_skips_records_applied_before_a_crash(tmp_path, monkeypatch):
+    applied, calls = set(), []
+
+    async def test_write(conn, at, number):
+        calls.append(number)
+
+    async def db_connect(*args, **kwargs):
+        return FakeConnection(applied)
+
+    monkeypatch.setitem(bot.SPOOLABLE_WRITES, 'test_write', test_write)
+    monkeypatch.setattr(bot, 'db_connect', db_connect)
+    spool = make_spool(tmp_path, 3)
+    with open(spool.path, 'rb') as f:
+        content = f.read()
+    monkeypatch.setattr(bot, 'write_spool', spool)
+    asyncio.run(bot.replay_write_spool())
+    assert calls == [0, 1, 2]
+    assert spool.pending == 0
+
+    # Падіння після запису в базу, але до фіксації offset: журнал на диску лишився цілим
+    spool.file.close()
+    with open(spool.path, 'wb') as f:
+        f.write(content)
+    spool.write_offset(0)
+    restarted = bot.WriteSpool(spool.path)
+    restarted.open()
+    assert restarted.pending == 3
+    monkeypatch.setattr(bot, 'write_spool', restarted)
+    asyncio.run(bot.replay_write_spool())
+    assert calls == [0, 1, 2]
+    assert restarted.pending == 0